@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Compares throughput of concurrent single-waiver POST requests with and
+without group commit.
+
+Requires a database configured in the WaiverDB config file (see
+WAIVERDB_CONFIG environment variable) whose tables are dropped and recreated.
+Set MESSAGE_BUS_PUBLISH = False in the config file to measure only storing
+the waivers.
+
+Usage::
+
+    $ DOCS=true DEV=true PYTHONPATH=. python3 benchmarks/group_commit.py [REQUESTS] [THREADS]
+"""
+
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mock import patch
+
+from waiverdb.app import create_app
+from waiverdb.models import db
+
+
+def post_waivers(app, count, threads):
+    client = app.test_client()
+
+    def post(i):
+        data = dict(subject_type='koji_build', subject_identifier='glibc-2.26-%d.fc27' % i,
+                    testcase='dist.rpmdeplint', product_version='fedora-27', waived=True,
+                    comment='it broke')
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                        content_type='application/json')
+        assert r.status_code == 201, r.get_data(as_text=True)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(post, range(count)))
+    return time.monotonic() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+    with patch('waiverdb.auth.get_user', return_value=('foo', {})):
+        app.config['GROUP_COMMIT'] = False
+        elapsed = post_waivers(app, count, threads)
+        print('without group commit: %6.0f waivers/s' % (count / elapsed))
+
+        app.config['GROUP_COMMIT'] = True
+        elapsed = post_waivers(app, count, threads)
+        print('with group commit:    %6.0f waivers/s' % (count / elapsed))
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Compares query plans and latencies of the typical waiver queries with and
+without the composite indexes on the waiver table.
+
+Requires an empty PostgreSQL database which is dropped and recreated.
+
+Usage::
+
+    $ DOCS=true PYTHONPATH=. python3 benchmarks/indexes.py DATABASE_URL [ROWS]
+"""
+
+import sys
+import timeit
+
+from sqlalchemy import create_engine, text, tuple_
+from sqlalchemy.orm import Session
+
+from waiverdb.api_v1 import (
+    _filter_out_obsolete_waivers,
+    _filter_out_obsolete_waivers_by_subject_and_testcase,
+)
+from waiverdb.fields import waiver_columns
+from waiverdb.models import Waiver, db
+from waiverdb.utils import decode_cursor, encode_cursor
+
+COMPOSITE_INDEXES = (
+    'ix_waiver_subject_testcase_product_version',
+    'ix_waiver_timestamp_id',
+)
+
+PACKAGES = 100000
+TESTCASES = 50
+PRODUCT_VERSIONS = 10
+
+
+def seed(session, count):
+    db.metadata.drop_all(session.get_bind())
+    db.metadata.create_all(session.get_bind())
+    # About one waiver in three is obsoleted by a later one.
+    session.execute(text("""
+        INSERT INTO waiver (subject_type, subject_identifier, testcase, username,
+                            product_version, waived, comment, timestamp)
+        SELECT 'koji_build',
+               'pkg' || (i * 7 % :packages) || '-1.0-1.fc' || (30 + i % :versions),
+               'dist.test' || (i % :testcases),
+               'user' || (i % 3),
+               'fedora-' || (30 + i % :versions),
+               i % 4 <> 0,
+               'Waived by the benchmark',
+               timestamp '2020-01-01' + i * interval '1 second'
+        FROM generate_series(1, :count) AS i
+    """), dict(count=count, packages=PACKAGES, testcases=TESTCASES,
+               versions=PRODUCT_VERSIONS))
+    session.execute(text("""
+        INSERT INTO current_waiver
+            (subject_type, subject_identifier, testcase, username, product_version, waiver_id)
+        SELECT subject_type, subject_identifier, testcase, username, product_version, max(id)
+        FROM waiver
+        GROUP BY subject_type, subject_identifier, testcase, username, product_version
+    """))
+    session.commit()
+
+
+def queries(session):
+    """
+    Returns queries built the same way as in waiverdb.api_v1.
+    """
+    query = session.query(*waiver_columns)
+    newest = query.order_by(Waiver.timestamp.desc(), Waiver.id.desc()).limit(5000).all()
+    cursor = decode_cursor(encode_cursor(newest[-1]))
+
+    subject = dict(subject_type='koji_build', subject_identifier='pkg7-1.0-1.fc31')
+    filters = [
+        dict(subject_type='koji_build',
+             subject_identifier='pkg%d-1.0-1.fc%d' % (i * 7 % PACKAGES, 30 + i % PRODUCT_VERSIONS),
+             testcase='dist.test%d' % (i % TESTCASES))
+        for i in range(1, 200)
+    ]
+    fields = ['subject_type', 'subject_identifier', 'testcase']
+    rows = [tuple(f[field] for field in fields) for f in filters]
+
+    return {
+        'GET /waivers/ (first page)':
+            _filter_out_obsolete_waivers(query)
+            .order_by(Waiver.timestamp.desc()).limit(10),
+        'GET /waivers/?after=... (page 500)':
+            _filter_out_obsolete_waivers(query)
+            .filter(tuple_(Waiver.timestamp, Waiver.id) < cursor)
+            .order_by(Waiver.timestamp.desc(), Waiver.id.desc()).limit(10),
+        'GET /waivers/?subject...&testcase&product_version':
+            _filter_out_obsolete_waivers(query.filter_by(
+                testcase='dist.test1', product_version='fedora-31', **subject))
+            .order_by(Waiver.timestamp.desc()).limit(10),
+        'GET /waivers/?subject...&include_obsolete=1':
+            query.filter_by(**subject).order_by(Waiver.timestamp.desc()).limit(10),
+        'POST /waivers/+filtered (199 filters)':
+            _filter_out_obsolete_waivers_by_subject_and_testcase(
+                Waiver.by_value_set(query, fields, rows))
+            .order_by(Waiver.timestamp.desc()),
+    }
+
+
+def measure(session, label):
+    print('=== %s ===' % label)
+    for name, query in queries(session).items():
+        connection = session.connection()
+        compiled = query.statement.compile(dialect=connection.dialect)
+        plan = connection.exec_driver_sql(
+            'EXPLAIN ANALYZE ' + str(compiled), compiled.params).scalars().all()
+        elapsed = min(timeit.repeat(query.all, number=1, repeat=5))
+        print('%-50s %8.2f ms' % (name, elapsed * 1000))
+        for line in plan:
+            print('    ' + line)
+    print()
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    url = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000000
+
+    engine = create_engine(url)
+    session = Session(engine)
+    print('Seeding %d waivers...' % count, file=sys.stderr)
+    seed(session, count)
+
+    for index in COMPOSITE_INDEXES:
+        session.execute(text('DROP INDEX %s' % index))
+    session.execute(text('ANALYZE'))
+    session.commit()
+    measure(session, 'without composite indexes')
+
+    for index in Waiver.__table__.indexes:
+        if index.name in COMPOSITE_INDEXES:
+            index.create(session.connection())
+    session.execute(text('ANALYZE'))
+    session.commit()
+    measure(session, 'with composite indexes')
+
+    session.close()
+    db.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
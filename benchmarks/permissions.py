@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Compares finding permissions matching a test case by checking each of them
+(waiverdb.authorization.match_testcase_permissions) with the compiled
+PermissionMatcher.
+
+Checking each permission is too slow for all the test cases, so it is
+measured only for a sample of them.
+
+Usage::
+
+    $ DOCS=true PYTHONPATH=. python3 benchmarks/permissions.py [PATTERNS] [TESTCASES]
+"""
+
+import random
+import sys
+import time
+
+from waiverdb.authorization import PermissionMatcher, match_testcase_permissions
+
+
+def make_permissions(count):
+    permissions = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            testcases = ['team%d.*' % i]
+        elif kind == 1:
+            testcases = ['team%d.gating' % i, 'team%d.compose.*' % i]
+        elif kind == 2:
+            testcases = ['team%d.*.rpm?eplint' % i]
+        else:
+            testcases = ['team%d.test[0-4]*' % i]
+        permissions.append({
+            'name': 'permission %d' % i,
+            'maintainers': [],
+            'testcases': testcases,
+            'groups': ['group%d' % i],
+            'users': [],
+        })
+    return permissions
+
+
+def make_testcases(count, patterns):
+    suffixes = ['gating', 'compose.boot', 'dist.rpmdeplint', 'test1', 'test7', 'other']
+    return [
+        'team%d.%s.%d' % (random.randrange(patterns), random.choice(suffixes), i)
+        if i % 2 else
+        'team%d.%s' % (random.randrange(patterns), random.choice(suffixes))
+        for i in range(count)
+    ]
+
+
+def main():
+    patterns = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    random.seed(0)
+    permissions = make_permissions(patterns)
+    testcases = make_testcases(count, patterns)
+    sample = testcases[:1000]
+
+    start = time.monotonic()
+    matcher = PermissionMatcher(permissions, cache_size=count)
+    compile_time = time.monotonic() - start
+
+    start = time.monotonic()
+    expected = [list(match_testcase_permissions(testcase, permissions)) for testcase in sample]
+    linear_time = (time.monotonic() - start) / len(sample)
+
+    start = time.monotonic()
+    for testcase in testcases:
+        matcher.match(testcase)
+    matcher_time = (time.monotonic() - start) / count
+
+    start = time.monotonic()
+    for testcase in testcases:
+        matcher.match(testcase)
+    cached_time = (time.monotonic() - start) / count
+
+    assert [matcher.match(testcase) for testcase in sample] == expected
+
+    print('patterns:          %d' % patterns)
+    print('testcases:         %d' % count)
+    print('compile:           %.1f ms' % (compile_time * 1000))
+    print('linear scan:       %.1f us/testcase' % (linear_time * 1e6))
+    print('matcher:           %.1f us/testcase' % (matcher_time * 1e6))
+    print('matcher (cached):  %.1f us/testcase' % (cached_time * 1e6))
+    print('speedup:           %.0fx' % (linear_time / matcher_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Compares loading and serializing waivers as ORM objects using
+flask_restful.marshal() with loading rows of waiver_columns and serializing
+them using waiverdb.fields.serialize_waiver().
+
+Usage::
+
+    $ DOCS=true PYTHONPATH=. python3 benchmarks/serializer.py [ROWS]
+"""
+
+import sys
+import timeit
+
+from flask_restful import marshal
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from waiverdb.fields import serialize_waiver, waiver_columns, waiver_fields
+from waiverdb.models import Waiver
+
+
+def create_session(count):
+    engine = create_engine('sqlite://')
+    Waiver.__table__.create(engine)
+    session = Session(engine)
+    session.execute(Waiver.__table__.insert(), [
+        dict(subject_type='koji_build', subject_identifier='glibc-2.26-%d.fc27' % i,
+             testcase='dist.rpmdeplint', username='foo', product_version='fedora-27',
+             waived=True, comment='it broke')
+        for i in range(count)
+    ])
+    return session
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    session = create_session(count)
+
+    def with_marshal():
+        result = marshal(session.query(Waiver).all(), waiver_fields)
+        session.expunge_all()
+        return result
+
+    def with_serialize_waiver():
+        return [serialize_waiver(row) for row in session.query(*waiver_columns)]
+
+    assert with_marshal() == with_serialize_waiver()
+
+    repeat = 5
+    marshal_time = min(timeit.repeat(with_marshal, number=1, repeat=repeat))
+    serialize_time = min(timeit.repeat(with_serialize_waiver, number=1, repeat=repeat))
+
+    print('rows:             %d' % count)
+    print('marshal:          %.1f ms' % (marshal_time * 1000))
+    print('serialize_waiver: %.1f ms' % (serialize_time * 1000))
+    print('speedup:          %.1fx' % (marshal_time / serialize_time))
+
+
+if __name__ == '__main__':
+    main()
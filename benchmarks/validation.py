@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Compares parsing a list of new waivers item by item with
+flask_restful.reqparse.RequestParser with the compiled parser from
+waiverdb.validation.
+
+Usage::
+
+    $ DOCS=true PYTHONPATH=. python3 benchmarks/validation.py [ITEMS]
+"""
+
+import sys
+import timeit
+
+from waiverdb.api_v1 import CP, RP
+from waiverdb.app import create_app
+
+
+class JsonRequest(object):
+    def __init__(self, data):
+        self.json = data
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = [
+        dict(subject_type='koji_build', subject_identifier='glibc-2.26-%d.fc27' % i,
+             testcase='dist.rpmdeplint', product_version='fedora-27', waived=True,
+             comment='it broke')
+        for i in range(count)
+    ]
+
+    def with_request_parser():
+        return [dict(RP['create_waiver'].parse_args(JsonRequest(item))) for item in data]
+
+    def with_compiled_parser():
+        return CP['create_waiver'].parse_list(data)
+
+    with create_app().app_context():
+        assert with_request_parser() == with_compiled_parser()
+
+        repeat = 5
+        reqparse_time = min(timeit.repeat(with_request_parser, number=1, repeat=repeat))
+        compiled_time = min(timeit.repeat(with_compiled_parser, number=1, repeat=repeat))
+
+    print('items:          %d' % count)
+    print('RequestParser:  %.1f ms' % (reqparse_time * 1000))
+    print('CompiledParser: %.1f ms' % (compiled_time * 1000))
+    print('speedup:        %.1fx' % (reqparse_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,14 @@ def app():
         yield app
 
 
+@pytest.fixture(autouse=True)
+def clear_caches(app):
+    """Do not share cached values between tests."""
+    yield
+    for cache in app.extensions['waiverdb_caches'].values():
+        cache.clear()
+
+
 @pytest.fixture(scope='session')
 def db(app):
     """Session-wide test database."""
@@ -38,6 +46,17 @@ def session(db, monkeypatch):
     connection.close()
 
 
+@pytest.fixture
+def postgresql(session):
+    """
+    Skips tests of features available only with PostgreSQL. Tests run with
+    PostgreSQL if DATABASE_URI is set in the file at WAIVERDB_CONFIG.
+    """
+    if session().get_bind().dialect.name != 'postgresql':
+        pytest.skip('requires PostgreSQL')
+    return session
+
+
 @pytest.fixture
 def client(app):
     """A Flask test client. An instance of :class:`flask.testing.TestClient`
@@ -6,11 +6,17 @@ import json
 import pytest
 from requests import ConnectionError, HTTPError
 from mock import patch, Mock
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
 from stomp.exception import StompException
 
 from .utils import create_waiver
 from waiverdb import __version__
-from waiverdb.models import Waiver
+from waiverdb.api_v1 import get_resultsdb_result, resultsdb_session
+from waiverdb.cache import get_cache
+from waiverdb.models import IdempotencyKey, Waiver
+from waiverdb.models.waivers import current_waiver_watermark
+from waiverdb.utils import estimate_count, json_collection
 
 
 @pytest.fixture
@@ -201,6 +207,55 @@ def test_create_waiver_with_unknown_result_id(mocked_user, mocked_resultsdb, cli
     assert res_data['message'].startswith('Failed looking up result in Resultsdb:')
 
 
+def test_create_multiple_waivers_with_result_ids(mocked_user, mocked_resultsdb, client, session):
+    results = {
+        result_id: {
+            'data': {
+                'type': ['koji_build'],
+                'item': ['somebuild-%d' % result_id],
+            },
+            'testcase': {'name': 'sometest'},
+            'outcome': 'FAILED',
+        }
+        for result_id in (1, 2)
+    }
+    mocked_resultsdb.side_effect = results.get
+    data = [
+        {
+            'result_id': result_id,
+            'product_version': 'fool-1',
+            'waived': True,
+            'comment': 'it broke',
+        }
+        for result_id in (1, 2, 1)
+    ]
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 201
+    assert [w['subject_identifier'] for w in res_data] == [
+        'somebuild-1', 'somebuild-2', 'somebuild-1']
+    # Each distinct result is looked up only once.
+    assert sorted(call.args[0] for call in mocked_resultsdb.call_args_list) == [1, 2]
+
+
+def test_resultsdb_results_are_cached(app):
+    response = Mock()
+    response.json.return_value = {'id': 123}
+    with patch.object(resultsdb_session(), 'request', return_value=response) as request:
+        assert get_resultsdb_result(123) == {'id': 123}
+        assert get_resultsdb_result(123) == {'id': 123}
+    request.assert_called_once_with(
+        'GET', '{0}/results/123'.format(app.config['RESULTSDB_API_URL']),
+        headers={'Content-Type': 'application/json'}, timeout=60)
+
+
+def test_resultsdb_requests_are_retried(app):
+    adapter = resultsdb_session().get_adapter(app.config['RESULTSDB_API_URL'] + '/results/1')
+    assert adapter.max_retries.total == app.config['RESULTSDB_RETRIES']
+    assert 503 in adapter.max_retries.status_forcelist
+
+
 def test_create_waiver_with_no_testcase(mocked_user, client):
     data = {
         'subject_type': 'koji_build',
@@ -357,6 +412,153 @@ def test_pagination_waivers(client, session):
     assert '/waivers/?page=3' in res_data['last']
 
 
+def test_cursor_pagination_waivers(client, session):
+    waivers = [
+        create_waiver(session, subject_type='koji_build', subject_identifier="%d" % i,
+                      testcase="case %d" % i, username='foo %d' % i,
+                      product_version='foo-%d' % i, comment='bla bla bla')
+        for i in range(0, 25)
+    ]
+    expected_ids = [w.id for w in reversed(waivers)]
+
+    r = client.get('/api/v1.0/waivers/?after=')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert [w['id'] for w in res_data['data']] == expected_ids[0:10]
+    assert res_data['prev'] is None
+    assert 'last' not in res_data
+    assert '/waivers/?after=' in res_data['first']
+
+    r = client.get(res_data['next'])
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert [w['id'] for w in res_data['data']] == expected_ids[10:20]
+
+    r = client.get(res_data['next'])
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert [w['id'] for w in res_data['data']] == expected_ids[20:25]
+    assert res_data['next'] is None
+
+    r = client.get(res_data['prev'])
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert [w['id'] for w in res_data['data']] == expected_ids[10:20]
+
+    r = client.get(res_data['prev'])
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert [w['id'] for w in res_data['data']] == expected_ids[0:10]
+    assert res_data['prev'] is None
+
+
+def test_cursor_pagination_keeps_filters(client, session):
+    for i in range(0, 5):
+        create_waiver(session, subject_type='koji_build', subject_identifier="%d" % i,
+                      testcase='case', username='foo', product_version='foo-1')
+        create_waiver(session, subject_type='koji_build', subject_identifier="%d" % i,
+                      testcase='other', username='foo', product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/?testcase=case&limit=2&after=')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert 'testcase=case' in res_data['next']
+    assert 'limit=2' in res_data['next']
+
+    testcases = []
+    url = '/api/v1.0/waivers/?testcase=case&limit=2&after='
+    while url:
+        res_data = json.loads(client.get(url).get_data(as_text=True))
+        testcases.extend(w['testcase'] for w in res_data['data'])
+        url = res_data['next']
+    assert testcases == ['case'] * 5
+
+
+def test_cursor_pagination_with_malformed_cursor(client, session):
+    r = client.get('/api/v1.0/waivers/?after=bad')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert res_data['message']['after'] == "Invalid pagination cursor: 'bad'"
+
+
+def test_cursor_pagination_with_after_and_before(client, session):
+    r = client.get('/api/v1.0/waivers/?after=&before=')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert res_data['message'] == \
+        'after argument should not be used together with before argument'
+
+
+def test_get_waivers_not_modified(client, session):
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    session.commit()
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1')
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    last_modified = r.headers['Last-Modified']
+
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.get_data() == b''
+    assert r.headers['ETag'] == etag
+
+    # If-Modified-Since alone is not enough, a waiver can be created
+    # in the same second as the last one
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1',
+                   headers={'If-Modified-Since': last_modified})
+    assert r.status_code == 200
+    assert r.headers['ETag'] == etag
+
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1',
+                   headers={'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+    assert r.status_code == 200
+
+    # Different query
+    r = client.get('/api/v1.0/waivers/?testcase=testcase2', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    session.commit()
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+    assert len(r.json['data']) == 1
+
+
+def test_get_waivers_modified_by_waiver_with_lower_id(client, session):
+    waiver = create_waiver(session, subject_type='koji_build', subject_identifier='0',
+                           testcase='testcase1', username='foo', product_version='foo-1')
+    session.commit()
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1')
+    etag = r.headers['ETag']
+
+    # Committed after the waiver with a higher id.
+    late_waiver = Waiver('koji_build', '1', 'testcase1', 'foo', 'foo-1')
+    late_waiver.id = waiver.id - 1
+    session.add(late_waiver)
+    session.commit()
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert len(r.json['data']) == 2
+
+
+def test_get_waiver_not_modified(client, session):
+    waiver = create_waiver(session, subject_type='koji_build',
+                           subject_identifier='glibc-2.26-27.fc27',
+                           testcase='testcase1', username='foo', product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/%s' % waiver.id)
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+
+    r = client.get('/api/v1.0/waivers/%s' % waiver.id, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+    r = client.get('/api/v1.0/waivers/%s' % (waiver.id + 1), headers={'If-None-Match': etag})
+    assert r.status_code == 404
+
+
 def test_obsolete_waivers_are_excluded_by_default(client, session):
     create_waiver(session, subject_type='koji_build',
                   subject_identifier='glibc-2.26-27.fc27',
@@ -563,6 +765,21 @@ def test_jsonp(client, session):
     assert 'jsonpcallback' in r.get_data(as_text=True)
 
 
+def test_jsonp_keeps_status_and_headers(client, session):
+    create_waiver(session, subject_type='koji_build',
+                  subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    with patch('waiverdb.api_v1.estimate_count', return_value=1):
+        r = client.get('/api/v1.0/waivers/?count=false&callback=jsonpcallback')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/javascript'
+    assert r.headers['X-Total-Count-Estimate'] == '1'
+    body = r.get_data(as_text=True)
+    assert body.startswith('jsonpcallback(') and body.endswith(')')
+    res_data = json.loads(body[len('jsonpcallback('):-1])
+    assert [w['subject']['item'] for w in res_data['data']] == ['glibc-2.26-27.fc27']
+
+
 def test_healthcheck(client):
     r = client.get('healthcheck')
     assert r.status_code == 200
@@ -593,6 +810,76 @@ def test_filtering_waivers_with_post(client, session):
     assert all(w['subject_identifier'].startswith('python2-2.7.14') for w in res_data['data'])
 
 
+def test_filtering_waivers_with_post_mixed_filters(client, session):
+    for i in range(1, 4):
+        create_waiver(session, subject_type='koji_build',
+                      subject_identifier='python2-2.7.14-%d.fc27' % i,
+                      testcase='case %d' % i, username='person',
+                      product_version='fedora-27', comment='bla bla bla')
+    filters = [
+        {'subject_type': 'koji_build', 'subject_identifier': 'python2-2.7.14-1.fc27'},
+        {'testcase': 'case 2', 'since': '2000-01-01T00:00:00.000000'},
+        {'testcase': 'case 4'},
+    ]
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters}),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert sorted(w['testcase'] for w in res_data['data']) == ['case 1', 'case 2']
+
+
+def test_filtering_waivers_with_post_excludes_obsolete(client, session):
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    new_waiver = create_waiver(session, subject_type='koji_build',
+                               subject_identifier='glibc-2.26-27.fc27',
+                               testcase='testcase1', username='bar',
+                               product_version='foo-2', waived=False)
+    filters = [{'subject_type': 'koji_build',
+                'subject_identifier': 'glibc-2.26-27.fc27',
+                'testcase': 'testcase1'}]
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters}),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert [w['id'] for w in res_data['data']] == [new_waiver.id]
+
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters, 'include_obsolete': True}),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert len(res_data['data']) == 2
+
+
+def test_filtering_waivers_with_post_as_ndjson(client, session):
+    filters = []
+    for i in range(1, 6):
+        filters.append({'subject_type': 'koji_build',
+                        'subject_identifier': 'python2-2.7.14-%d.fc27' % i,
+                        'testcase': 'case %d' % i})
+        create_waiver(session, subject_type='koji_build',
+                      subject_identifier='python2-2.7.14-%d.fc27' % i,
+                      testcase='case %d' % i, username='person',
+                      product_version='fedora-27', comment='bla bla bla')
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters}),
+                    content_type='application/json')
+    expected = json.loads(r.get_data(as_text=True))['data']
+
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters}),
+                    content_type='application/json',
+                    headers={'Accept': 'application/x-ndjson'})
+    assert r.status_code == 200
+    assert r.mimetype == 'application/x-ndjson'
+    lines = r.get_data(as_text=True).splitlines()
+    assert len(lines) == 5
+    assert [json.loads(line) for line in lines] == expected
+
+
 def test_filtering_with_missing_filter(client, session):
     r = client.post('/api/v1.0/waivers/+filtered',
                     data=json.dumps({'somethingelse': 'what'}),
@@ -850,6 +1137,52 @@ def test_create_multiple_waivers(mocked_user, client, session):
     assert session.query(Waiver).count() == 2
 
 
+def test_create_multiple_waivers_in_bulk(mocked_user, client, session):
+    data = [
+        {
+            'subject_type': 'koji_build',
+            'subject_identifier': 'glibc-2.26-%d.fc27' % (i // 2),
+            'testcase': 'testcase1',
+            'product_version': 'fool-1',
+            'waived': i % 2 == 0,
+            'comment': 'it broke',
+        }
+        for i in range(0, 6)
+    ]
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        with patch('waiverdb.events.publish') as mocked_publish:
+            r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                            content_type='application/json')
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 201
+    assert [w['subject_identifier'] for w in res_data] == [
+        w['subject_identifier'] for w in data]
+    assert [w['waived'] for w in res_data] == [w['waived'] for w in data]
+    assert sorted(call.args[0].body['id'] for call in mocked_publish.call_args_list) == \
+        sorted(w['id'] for w in res_data)
+    for call in mocked_publish.call_args_list:
+        assert call.args[0].body in res_data
+
+    inserts = [s for s in statements if s.startswith('INSERT INTO waiver ')]
+    if session().get_bind().dialect.name == 'postgresql':
+        assert len(inserts) == 1
+    # Only the most recent waiver for each subject is current.
+    r = client.get('/api/v1.0/waivers/')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert sorted(w['subject_identifier'] for w in res_data['data']) == [
+        'glibc-2.26-0.fc27', 'glibc-2.26-1.fc27', 'glibc-2.26-2.fc27']
+    assert all(not w['waived'] for w in res_data['data'])
+
+
 def test_create_multiple_waivers_rollback_on_error(mocked_user, client, session):
     item1 = {
         'subject_type': 'koji_build',
@@ -871,6 +1204,173 @@ def test_create_multiple_waivers_rollback_on_error(mocked_user, client, session)
     assert session.query(Waiver).count() == 0
 
 
+def test_create_waiver_with_idempotency_key(mocked_user, client, session):
+    data = {
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    }
+    headers = {'Idempotency-Key': 'request-1'}
+    with patch('waiverdb.events.publish') as mocked_publish:
+        r1 = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                         content_type='application/json', headers=headers)
+        r2 = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                         content_type='application/json', headers=headers)
+    assert r1.status_code == 201
+    assert 'Idempotent-Replayed' not in r1.headers
+    assert r2.status_code == 201
+    assert r2.headers['Idempotent-Replayed'] == 'true'
+    assert json.loads(r2.get_data(as_text=True)) == json.loads(r1.get_data(as_text=True))
+    assert session.query(Waiver).count() == 1
+    assert mocked_publish.call_count == 1
+
+    # Reusing the key for a different request is an error.
+    data['comment'] = 'it broke again'
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json', headers=headers)
+    assert r.status_code == 422
+    assert session.query(Waiver).count() == 1
+
+    # Keys are not shared between users.
+    with patch('waiverdb.auth.get_user', return_value=('bar', {})):
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                        content_type='application/json', headers=headers)
+    assert r.status_code == 201
+    assert session.query(Waiver).count() == 2
+
+
+def test_create_waiver_with_expired_idempotency_key(mocked_user, client, session):
+    data = [{
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    }]
+    headers = {'Idempotency-Key': 'request-1'}
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json', headers=headers)
+    assert r.status_code == 201
+
+    session.query(IdempotencyKey).update({'expires': datetime.datetime.utcnow()})
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json', headers=headers)
+    assert r.status_code == 201
+    assert 'Idempotent-Replayed' not in r.headers
+    assert session.query(Waiver).count() == 2
+    assert session.query(IdempotencyKey).count() == 1
+
+
+def test_create_waiver_with_invalid_idempotency_key(mocked_user, client, session):
+    r = client.post('/api/v1.0/waivers/', data=json.dumps({}),
+                    content_type='application/json', headers={'Idempotency-Key': 'x' * 256})
+    assert r.status_code == 400
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['message'] == 'Idempotency-Key header must have 1 to 255 characters'
+
+
+def test_create_duplicate_waiver(mocked_user, client, session, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'DEDUPLICATE_WAIVERS', True)
+    data = {
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    }
+    with patch('waiverdb.events.publish') as mocked_publish:
+        r1 = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                         content_type='application/json')
+        r2 = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                         content_type='application/json')
+    assert r1.status_code == 201
+    assert 'X-Duplicate-Waivers' not in r1.headers
+    assert r2.status_code == 200
+    assert r2.headers['X-Duplicate-Waivers'] == '1'
+    assert json.loads(r2.get_data(as_text=True)) == json.loads(r1.get_data(as_text=True))
+    assert session.query(Waiver).count() == 1
+    assert mocked_publish.call_count == 1
+
+    # A waiver with a different comment is not a duplicate.
+    data['comment'] = 'it broke again'
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    assert r.status_code == 201
+    assert session.query(Waiver).count() == 2
+
+    # Only the current waiver is compared.
+    data['comment'] = 'it broke'
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    assert r.status_code == 201
+    assert session.query(Waiver).count() == 3
+
+
+def test_create_multiple_waivers_with_duplicates(mocked_user, client, session, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'DEDUPLICATE_WAIVERS', True)
+    existing = create_waiver(session, subject_type='koji_build',
+                             subject_identifier='glibc-2.26-27.fc27', testcase='testcase1',
+                             username='foo', product_version='fool-1', comment='it broke')
+    data = [
+        {
+            'subject_type': 'koji_build',
+            'subject_identifier': subject_identifier,
+            'testcase': 'testcase1',
+            'product_version': 'fool-1',
+            'waived': True,
+            'comment': 'it broke',
+        }
+        for subject_identifier in ('glibc-2.26-27.fc27', 'glibc-2.26-28.fc27',
+                                   'glibc-2.26-28.fc27')
+    ]
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 201
+    assert r.headers['X-Duplicate-Waivers'] == '2'
+    assert res_data[0]['id'] == existing.id
+    assert res_data[1]['id'] == res_data[2]['id'] != existing.id
+    assert session.query(Waiver).count() == 2
+
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    assert r.status_code == 200
+    assert r.headers['X-Duplicate-Waivers'] == '3'
+    assert json.loads(r.get_data(as_text=True)) == res_data
+    assert session.query(Waiver).count() == 2
+
+
+def test_create_duplicate_waiver_without_deduplication(mocked_user, client, session):
+    data = {
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    }
+    for _ in range(2):
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                        content_type='application/json')
+        assert r.status_code == 201
+        assert 'X-Duplicate-Waivers' not in r.headers
+    assert session.query(Waiver).count() == 2
+
+
+@pytest.mark.parametrize('deduplicate', (False, True))
+def test_create_empty_list_of_waivers(mocked_user, client, session, monkeypatch, deduplicate):
+    monkeypatch.setitem(client.application.config, 'DEDUPLICATE_WAIVERS', deduplicate)
+    r = client.post('/api/v1.0/waivers/', data='[]', content_type='application/json')
+    assert r.status_code == 201
+    assert json.loads(r.get_data(as_text=True)) == []
+    assert 'X-Duplicate-Waivers' not in r.headers
+
+
 def test_create_waiver_with_arbitrary_subject_type(mocked_user, client, session):
     data = {
         'subject_type': 'kind-of-magic',
@@ -926,3 +1426,210 @@ def test_create_waiver_failed_event_once(mocked_user, client, session, caplog):
             assert 'Failed to send message (try 2/3)' in caplog.text
             assert 'Failed to send message (try 3/3)' not in caplog.text
             assert 'StompException' in caplog.text
+
+
+def test_waiver_query_results_are_cached(client, session):
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    with patch('waiverdb.api_v1.json_collection', wraps=json_collection) as mocked:
+        r1 = client.get('/api/v1.0/waivers/?testcase=testcase1')
+        r2 = client.get('/api/v1.0/waivers/?testcase=testcase1')
+        assert r1.get_data() == r2.get_data()
+        assert mocked.call_count == 1
+
+        create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                      testcase='testcase1', username='foo', product_version='foo-1')
+        # Waivers are visible to other requests (and processes) once committed.
+        session.commit()
+        r3 = client.get('/api/v1.0/waivers/?testcase=testcase1')
+        assert mocked.call_count == 2
+        assert len(json.loads(r3.get_data(as_text=True))['data']) == 1
+        assert r3.get_data() != r1.get_data()
+
+
+def test_waiver_query_cache_keyed_by_committed_waivers(client, session, monkeypatch):
+    # Like the cache of another process, which is not cleared on commit.
+    monkeypatch.setattr(get_cache('query_result'), 'clear', lambda: None)
+    # Ids are allocated before transactions commit, so a waiver with a lower
+    # id than the most recent one can become visible later.
+    waiver = create_waiver(session, subject_type='koji_build', subject_identifier='0',
+                           testcase='testcase1', username='foo', product_version='foo-1')
+    late_waiver = Waiver('koji_build', '1', 'testcase1', 'foo', 'foo-1')
+    late_waiver.id = waiver.id - 1
+    session.commit()
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1')
+    assert [w['id'] for w in r.json['data']] == [waiver.id]
+
+    session.add(late_waiver)
+    session.commit()
+    r = client.get('/api/v1.0/waivers/?testcase=testcase1')
+    assert sorted(w['id'] for w in r.json['data']) == [late_waiver.id, waiver.id]
+
+
+def test_waiver_watermark_changes_only_with_new_waivers(session):
+    value, _ = current_waiver_watermark(session)
+    session.commit()
+    assert current_waiver_watermark(session)[0] == value
+
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    with patch('waiverdb.events.publish'):
+        session.commit()
+    new_value, updated = current_waiver_watermark(session)
+    assert new_value > value
+    assert updated is not None
+
+
+def test_large_waiver_query_results_are_not_cached(client, session, monkeypatch):
+    cache = get_cache('query_result')
+    monkeypatch.setattr(cache, 'maxweight', 2)
+    for i in range(3):
+        create_waiver(session, subject_type='koji_build', subject_identifier='%d' % i,
+                      testcase='testcase1', username='foo', product_version='foo-1')
+    client.get('/api/v1.0/waivers/?limit=2')
+    assert len(cache) == 1
+    client.post('/api/v1.0/waivers/+filtered', json={'filters': [{'testcase': 'testcase1'}]})
+    assert len(cache) == 1
+
+
+def test_cached_waiver_query_links_match_query_string(client, session):
+    for i in range(2):
+        create_waiver(session, subject_type='koji_build', subject_identifier='%d' % i,
+                      testcase='testcase1', username='foo', product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/?limit=1&callback=evil')
+    assert 'callback=evil' in r.get_data(as_text=True)
+
+    r = client.get('/api/v1.0/waivers/?limit=1')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert 'callback' not in res_data['next']
+    r = client.get('/api/v1.0/waivers/?limit=1&page=1')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['next'] == 'http://localhost/api/v1.0/waivers/?page=2&limit=1'
+
+
+def test_cached_waiver_query_looks_up_version_once(client, session):
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    with patch('waiverdb.api_v1.waiver_watermark') as mocked:
+        r = client.get('/api/v1.0/waivers/')
+    assert r.status_code == 200
+    # Passed from conditional_get() which already looked it up.
+    mocked.assert_not_called()
+
+
+def test_waiver_query_cache_cleared_only_after_new_waivers(session):
+    cache = get_cache('query_result')
+    cache.set('key', 'value')
+    session.commit()
+    assert len(cache) == 1
+
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    with patch('waiverdb.events.publish'):
+        session.commit()
+    assert len(cache) == 0
+
+
+def test_get_waivers_with_fields(client, session):
+    for i in range(0, 3):
+        create_waiver(session, subject_type='koji_build', subject_identifier='%d' % i,
+                      testcase='testcase1', username='foo', product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/?fields=subject_identifier,waived&limit=2')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert res_data['data'] == [
+        {'subject_identifier': '2', 'waived': True},
+        {'subject_identifier': '1', 'waived': True},
+    ]
+    assert 'fields=subject_identifier' in res_data['next']
+
+    r = client.get('/api/v1.0/waivers/?fields=subject_identifier&limit=2&after=')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['data'] == [{'subject_identifier': '2'}, {'subject_identifier': '1'}]
+    r = client.get(res_data['next'])
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['data'] == [{'subject_identifier': '0'}]
+
+
+def test_get_waivers_with_unknown_fields(client, session):
+    r = client.get('/api/v1.0/waivers/?fields=testcase,bogus')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert 'Unknown fields: bogus' in res_data['message']['fields']
+
+
+def test_filtering_waivers_with_fields(client, session):
+    create_waiver(session, subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    filters = [{'subject_type': 'koji_build', 'testcase': 'testcase1'}]
+    fields = ['subject', 'testcase']
+    expected = [{
+        'subject': {'type': 'koji_build', 'item': 'glibc-2.26-27.fc27'},
+        'testcase': 'testcase1',
+    }]
+
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters, 'fields': fields}),
+                    content_type='application/json')
+    assert r.status_code == 200
+    assert json.loads(r.get_data(as_text=True))['data'] == expected
+
+    r = client.post('/api/v1.0/waivers/+filtered',
+                    data=json.dumps({'filters': filters, 'fields': fields}),
+                    content_type='application/json',
+                    headers={'Accept': 'application/x-ndjson'})
+    assert r.status_code == 200
+    assert [json.loads(line) for line in r.get_data(as_text=True).splitlines()] == expected
+
+    r = client.post('/api/v1.0/waivers/+by-subjects-and-testcases',
+                    data=json.dumps({'testcase': 'testcase1', 'fields': fields}),
+                    content_type='application/json')
+    assert r.status_code == 200
+    assert json.loads(r.get_data(as_text=True))['data'] == expected
+
+
+def test_get_waivers_without_count(client, session):
+    for i in range(0, 5):
+        create_waiver(session, subject_type='koji_build', subject_identifier='%d' % i,
+                      testcase='testcase1', username='foo', product_version='foo-1')
+    with patch('flask_sqlalchemy.BaseQuery.count') as mocked_count:
+        r = client.get('/api/v1.0/waivers/?count=false&limit=2')
+        res_data = json.loads(r.get_data(as_text=True))
+        assert r.status_code == 200
+        assert [w['subject_identifier'] for w in res_data['data']] == ['4', '3']
+        assert res_data['prev'] is None
+        assert 'page=2' in res_data['next']
+        assert 'count=false' in res_data['next']
+        assert 'last' not in res_data
+
+        res_data = json.loads(client.get(res_data['next']).get_data(as_text=True))
+        assert [w['subject_identifier'] for w in res_data['data']] == ['2', '1']
+        assert 'page=1' in res_data['prev']
+
+        res_data = json.loads(client.get(res_data['next']).get_data(as_text=True))
+        assert [w['subject_identifier'] for w in res_data['data']] == ['0']
+        assert res_data['next'] is None
+
+        r = client.get('/api/v1.0/waivers/?count=false&limit=2&page=4')
+        res_data = json.loads(r.get_data(as_text=True))
+        assert res_data == {'data': [], 'prev': None, 'next': None, 'first': None}
+    mocked_count.assert_not_called()
+
+    if session().get_bind().dialect.name == 'postgresql':
+        assert int(r.headers['X-Total-Count-Estimate']) >= 0
+    else:
+        assert 'X-Total-Count-Estimate' not in r.headers
+
+
+def test_estimate_count(postgresql):
+    for i in range(3):
+        create_waiver(postgresql, subject_type='koji_build',
+                      subject_identifier='glibc-2.26-%d.fc27' % i,
+                      testcase='testcase1', username='foo', product_version='foo-1')
+    # Up-to-date statistics make the estimate exact for a small table.
+    postgresql.execute(text('ANALYZE waiver'))
+    assert estimate_count(Waiver.query) == Waiver.query.count()
+
+    # Bound parameters are passed to EXPLAIN.
+    query = Waiver.query.filter(Waiver.testcase == 'testcase1').order_by(Waiver.id)
+    assert isinstance(estimate_count(query), int)
@@ -21,14 +21,48 @@ class EnabledMessagedConfig(config.Config):
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
 
+class OutboxMessagingConfig(EnabledMessagedConfig):
+    MESSAGE_OUTBOX = True
+
+
 @mock.patch('waiverdb.app.event.listen')
 def test_disabled_messaging_should_not_register_events(mock_listen):
     app.create_app(DisabledMessagingConfig)
-    assert 0 == mock_listen.call_count
+    mock_listen.assert_called_once_with(
+        SignallingSession, 'after_commit', app.invalidate_result_cache)
 
 
 @mock.patch('waiverdb.app.event.listen')
 def test_enabled_messaging_should_register_events(mock_listen):
     app.create_app(EnabledMessagedConfig)
-    mock_listen.assert_called_once_with(
-        SignallingSession, 'after_commit', app.publish_new_waiver)
+    assert mock_listen.call_args_list == [
+        mock.call(SignallingSession, 'after_commit', app.publish_new_waiver),
+        mock.call(SignallingSession, 'after_commit', app.invalidate_result_cache),
+    ]
+
+
+@mock.patch('waiverdb.app.event.listen')
+def test_outbox_messaging_should_register_events(mock_listen):
+    app.create_app(OutboxMessagingConfig)
+    assert mock_listen.call_args_list == [
+        mock.call(SignallingSession, 'before_commit', app.enqueue_new_waivers),
+        mock.call(SignallingSession, 'after_commit', app.invalidate_result_cache),
+    ]
+
+
+class DisabledCachesConfig(DisabledMessagingConfig):
+    OIDC_TOKEN_CACHE_SIZE = 0
+    RESULT_CACHE_SIZE = 0
+    RESULTSDB_CACHE_SIZE = 0
+    LDAP_CACHE_SIZE = 0
+    LDAP_POOL_SIZE = 0
+
+
+@mock.patch('waiverdb.app.event.listen')
+def test_caches_are_configured_per_app(mock_listen):
+    enabled = app.create_app(DisabledMessagingConfig)
+    disabled = app.create_app(DisabledCachesConfig)
+    assert all(cache.maxsize > 0 for cache in enabled.extensions['waiverdb_caches'].values())
+    assert all(cache.maxsize == 0 for cache in disabled.extensions['waiverdb_caches'].values())
+    assert enabled.extensions['waiverdb_ldap_connections'].maxsize > 0
+    assert disabled.extensions['waiverdb_ldap_connections'].maxsize == 0
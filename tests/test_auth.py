@@ -5,9 +5,28 @@ import pytest
 import gssapi  # noqa
 import mock
 import json
+import time
 from werkzeug.exceptions import Unauthorized
 import waiverdb.auth
 import flask_oidc
+from waiverdb.cache import get_cache
+
+
+@pytest.fixture
+def token_cache(app):
+    cache = get_cache('oidc_token')
+    cache.configure(10, 300)
+    yield cache
+    cache.configure(app.config['OIDC_TOKEN_CACHE_SIZE'], app.config['OIDC_TOKEN_CACHE_TTL'])
+
+
+def bearer_request(token):
+    headers = {'Authorization': 'Bearer %s' % token}
+    request = mock.MagicMock()
+    request.headers.__getitem__.side_effect = headers.__getitem__
+    request.headers.__contains__.side_effect = headers.__contains__
+    request.headers.get.side_effect = headers.get
+    return request
 
 
 @pytest.mark.usefixtures('enable_kerberos')
@@ -25,7 +44,7 @@ class TestGSSAPIAuthentication(object):
     @mock.patch.multiple("gssapi.Credentials",
                          __init__=mock.Mock(return_value=None),
                          __new__=mock.Mock(return_value=None))
-    def test_authorized(self, client, monkeypatch):
+    def test_authorized(self, client, session, monkeypatch):
         monkeypatch.setenv('KRB5_KTNAME', '/etc/foo.keytab')
         data = {
             'subject': {'type': 'koji_build', 'item': 'glibc-2.26-27.fc27'},
@@ -84,6 +103,41 @@ class TestOIDCAuthentication(object):
         user, header = waiverdb.auth.get_user(request)
         assert user == name
 
+    @mock.patch.object(flask_oidc.OpenIDConnect, '_get_token_info')
+    def test_valid_token_is_cached(self, mocked_get_token, session, token_cache):
+        mocked_get_token.return_value = {'active': True, 'username': 'Son Goku',
+                                         'scope': 'openid waiverdb_scope',
+                                         'exp': time.time() + 3600}
+        for _ in range(3):
+            user, header = waiverdb.auth.get_user(bearer_request('foobar'))
+            assert user == 'Son Goku'
+        mocked_get_token.assert_called_once_with('foobar')
+        assert len(token_cache) == 1
+
+        # Other tokens are validated.
+        user, header = waiverdb.auth.get_user(bearer_request('other'))
+        assert mocked_get_token.call_count == 2
+
+    @mock.patch.object(flask_oidc.OpenIDConnect, '_get_token_info')
+    def test_expiring_token_is_not_cached(self, mocked_get_token, session, token_cache):
+        mocked_get_token.return_value = {'active': True, 'username': 'Son Goku',
+                                         'scope': 'openid waiverdb_scope',
+                                         'exp': time.time() + 10}
+        for _ in range(2):
+            waiverdb.auth.get_user(bearer_request('foobar'))
+        assert mocked_get_token.call_count == 2
+        assert len(token_cache) == 0
+
+    @mock.patch.object(flask_oidc.OpenIDConnect, '_get_token_info')
+    def test_invalid_token_is_not_cached(self, mocked_get_token, session, token_cache):
+        mocked_get_token.return_value = {'active': False, 'username': 'Son Goku',
+                                         'scope': 'openid waiverdb_scope'}
+        for _ in range(2):
+            with pytest.raises(Unauthorized):
+                waiverdb.auth.get_user(bearer_request('invalid'))
+        assert mocked_get_token.call_count == 2
+        assert len(token_cache) == 0
+
 
 @pytest.mark.usefixtures('enable_ssl')
 class TestSSLAuthentication(object):
@@ -1,5 +1,90 @@
-from waiverdb.api_v1 import permissions
-from waiverdb.authorization import match_testcase_permissions
+import json
+import sys
+import time
+
+import pytest
+from mock import Mock, patch
+from sqlalchemy import func
+from werkzeug.exceptions import BadGateway, ServiceUnavailable, Unauthorized
+
+from waiverdb.api_v1 import WaiversResource, permission_matcher, permissions
+from waiverdb.authorization import (
+    PermissionMatcher,
+    get_ldap_connections,
+    match_testcase_permissions,
+    verify_authorization,
+)
+from waiverdb.cache import get_cache
+from waiverdb.jobs import process_next_job
+from waiverdb.models import Waiver
+
+
+class LDAPError(Exception):
+    pass
+
+
+class ServerDown(LDAPError):
+    pass
+
+
+@pytest.fixture
+def ldap(app):
+    """
+    Fake python-ldap module with a connection finding groups of users in
+    ``ldap.groups``.
+    """
+    ldap = Mock(LDAPError=LDAPError, SERVER_DOWN=ServerDown, SCOPE_SUBTREE=2)
+    ldap.groups = {}
+
+    def search_s(base, scope, search_string, attributes):
+        return [
+            ('cn={},{}'.format(group, base), {'cn': [group.encode('utf-8')]})
+            for group in ldap.groups.get((base, search_string), [])
+        ]
+
+    ldap.initialize.return_value.search_s.side_effect = search_s
+    with patch.dict(sys.modules, {'ldap': ldap}):
+        yield ldap
+    get_ldap_connections().close()
+
+
+@pytest.fixture
+def ldap_cache(app):
+    cache = get_cache('ldap_membership')
+    cache.configure(10, 300)
+    yield cache
+    cache.configure(app.config['LDAP_CACHE_SIZE'], app.config['LDAP_CACHE_TTL'])
+
+
+@pytest.fixture
+def ldap_pool(app, ldap):
+    """
+    Pool of at most two LDAP connections. Each new connection is appended to
+    ``ldap.connections``.
+    """
+    search_s = ldap.initialize.return_value.search_s.side_effect
+    ldap.connections = []
+
+    def initialize(ldap_host):
+        con = Mock()
+        con.search_s.side_effect = search_s
+        ldap.connections.append(con)
+        return con
+
+    ldap.initialize.side_effect = initialize
+    pool = get_ldap_connections()
+    pool.configure(2, 0.1, 300, 30)
+    yield pool
+    pool.configure(
+        app.config['LDAP_POOL_SIZE'], app.config['LDAP_TIMEOUT'],
+        app.config['LDAP_POOL_MAX_IDLE'], app.config['LDAP_POOL_CHECK_IDLE'])
+
+
+PERMISSIONS = [{'testcases': ['testcase1'], 'groups': ['qa'], 'users': []}]
+LDAP_SEARCHES = [
+    {'BASE': 'ou=Groups,dc=example,dc=com'},
+    {'BASE': 'ou=Other,dc=example,dc=com', 'SEARCH_STRING': '(member={user})'},
+]
 
 
 def test_permissions_mapping_compat(app, monkeypatch):
@@ -67,3 +152,309 @@ def test_match_testcase_permissions():
         == [permissions[1]]
     assert list(match_testcase_permissions("kernel-qe.test1", permissions)) \
         == [permissions[0]]
+
+
+def test_permission_matcher_matches_like_linear_scan():
+    permissions = [
+        {"name": "exact", "testcases": ["dist.rpmdeplint"], "groups": ["a"]},
+        {"name": "prefix", "testcases": ["dist.*", "other.test"], "groups": ["b"]},
+        {"name": "wildcards", "testcases": ["*.rpm?eplint", "dist.[a-r]*lint"], "groups": ["c"]},
+        {"name": "everything", "testcases": ["*"], "groups": ["d"]},
+        {"name": "unclosed", "testcases": ["dist.[abc"], "groups": ["e"]},
+        {"name": "no testcases", "groups": ["f"]},
+        {"name": "^kernel-qe", "_testcase_regex_pattern": "^kernel-qe", "groups": ["g"]},
+        {"name": "group", "_testcase_regex_pattern": r"(rpm|deb)lint$", "groups": ["h"]},
+        {"name": "reference", "_testcase_regex_pattern": r"(\w)\1", "groups": ["i"]},
+    ]
+    testcases = [
+        "dist.rpmdeplint", "dist.rpmdeplint2", "dist.abicheck", "dist.", "dist",
+        "other.test", "other.test2", "kernel-qe.test1", "my.kernel-qe", "test.deblint",
+        "dist.[abc", "", "aa",
+    ]
+    matcher = PermissionMatcher(permissions)
+    for testcase in testcases:
+        expected = list(match_testcase_permissions(testcase, permissions))
+        assert matcher.match(testcase) == expected, testcase
+        # cached
+        assert matcher.match(testcase) == expected, testcase
+
+    assert [p["name"] for p in matcher.match("dist.rpmdeplint")] == [
+        "exact", "prefix", "wildcards", "everything"]
+
+
+def test_permission_matcher_cache():
+    permissions = [{"name": "prefix", "testcases": ["dist.*"], "groups": []}]
+    matcher = PermissionMatcher(permissions, cache_size=1)
+    with patch.object(matcher, '_match_indexes', wraps=matcher._match_indexes) as match:
+        assert matcher.match("dist.a") == permissions
+        assert matcher.match("dist.a") == permissions
+        assert match.call_count == 1
+        assert matcher.match("other") == []
+        assert matcher.match("dist.a") == permissions
+        assert match.call_count == 3
+
+
+def test_permission_matcher_recompiled(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PERMISSIONS', [
+        {"name": "a", "testcases": ["a.*"], "users": ["alice"]}])
+    matcher = permission_matcher()
+    assert permission_matcher() is matcher
+    assert [p["name"] for p in matcher.match("a.test")] == ["a"]
+
+    monkeypatch.setitem(app.config, 'PERMISSIONS', [
+        {"name": "b", "testcases": ["b.*"], "users": ["alice"]}])
+    assert permission_matcher() is not matcher
+    assert permission_matcher().match("a.test") == []
+
+
+def test_ldap_membership_is_cached(app, ldap, ldap_cache):
+    ldap.groups[('ou=Other,dc=example,dc=com', '(member=alice)')] = ['qa']
+    for _ in range(3):
+        assert verify_authorization(
+            'alice', 'testcase1', PERMISSIONS, 'ldap://ldap.example.com', LDAP_SEARCHES)
+
+    ldap.initialize.assert_called_once_with('ldap://ldap.example.com')
+    search_s = ldap.initialize.return_value.search_s
+    assert search_s.call_count == len(LDAP_SEARCHES)
+    assert len(ldap_cache) == len(LDAP_SEARCHES)
+
+
+def test_ldap_membership_negative_caching(app, ldap, ldap_cache, monkeypatch):
+    def verify():
+        return verify_authorization(
+            'bob', 'testcase1', PERMISSIONS, 'ldap://ldap.example.com', LDAP_SEARCHES)
+
+    search_s = ldap.initialize.return_value.search_s
+    with pytest.raises(Unauthorized, match="Couldn't find user bob in LDAP"):
+        verify()
+    assert search_s.call_count == len(LDAP_SEARCHES)
+
+    # Searches finding no groups are cached too.
+    ldap.groups[('ou=Groups,dc=example,dc=com', '(memberUid=bob)')] = ['qa']
+    with pytest.raises(Unauthorized, match="Couldn't find user bob in LDAP"):
+        verify()
+    assert search_s.call_count == len(LDAP_SEARCHES)
+
+    # Until LDAP_CACHE_NEGATIVE_TTL expires.
+    ldap_cache.clear()
+    monkeypatch.setitem(app.config, 'LDAP_CACHE_NEGATIVE_TTL', 0)
+    ldap.groups.clear()
+    with pytest.raises(Unauthorized):
+        verify()
+    ldap.groups[('ou=Groups,dc=example,dc=com', '(memberUid=bob)')] = ['qa']
+    assert verify()
+    assert search_s.call_count == 2 * len(LDAP_SEARCHES) + 1
+
+
+def test_ldap_membership_cache_disabled(app, ldap):
+    ldap.groups[('ou=Groups,dc=example,dc=com', '(memberUid=alice)')] = ['qa']
+    for _ in range(2):
+        assert verify_authorization(
+            'alice', 'testcase1', PERMISSIONS, 'ldap://ldap.example.com', LDAP_SEARCHES)
+    assert ldap.initialize.call_count == 2
+    assert ldap.initialize.return_value.search_s.call_count == 2
+    # Connections are not pooled in tests (LDAP_POOL_SIZE = 0).
+    assert ldap.initialize.return_value.unbind_s.call_count == 2
+
+
+def test_ldap_errors_are_not_cached(app, ldap, ldap_cache):
+    ldap.initialize.return_value.search_s.side_effect = ServerDown()
+    for _ in range(2):
+        with pytest.raises(Exception, match='The LDAP server is not reachable.'):
+            verify_authorization(
+                'alice', 'testcase1', PERMISSIONS, 'ldap://ldap.example.com', LDAP_SEARCHES)
+    # Each search is retried once.
+    assert ldap.initialize.return_value.search_s.call_count == 4
+    assert len(ldap_cache) == 0
+
+
+def verify_alice(ldap):
+    ldap.groups[('ou=Groups,dc=example,dc=com', '(memberUid=alice)')] = ['qa']
+    return verify_authorization(
+        'alice', 'testcase1', PERMISSIONS, 'ldap://ldap.example.com', LDAP_SEARCHES)
+
+
+def test_ldap_connections_are_reused(app, ldap, ldap_pool):
+    for _ in range(3):
+        assert verify_alice(ldap)
+
+    assert len(ldap.connections) == 1
+    con = ldap.connections[0]
+    assert con.search_s.call_count == 3
+    # Recently used connections are not checked.
+    con.whoami_s.assert_not_called()
+    con.unbind_s.assert_not_called()
+
+
+def test_ldap_idle_connection_is_checked(app, ldap, ldap_pool):
+    ldap_pool.configure(2, 0.1, 300, 0)
+    for _ in range(3):
+        assert verify_alice(ldap)
+
+    assert len(ldap.connections) == 1
+    assert ldap.connections[0].whoami_s.call_count == 2
+
+
+def test_ldap_dead_connection_is_replaced(app, ldap, ldap_pool):
+    ldap_pool.configure(2, 0.1, 300, 0)
+    assert verify_alice(ldap)
+    ldap.connections[0].whoami_s.side_effect = ServerDown()
+
+    assert verify_alice(ldap)
+    assert len(ldap.connections) == 2
+    ldap.connections[0].unbind_s.assert_called_once()
+    ldap.connections[1].search_s.assert_called_once()
+
+
+def test_ldap_connection_is_closed_after_error(app, ldap, ldap_pool):
+    ldap.initialize.side_effect = None
+    ldap.initialize.return_value.search_s.side_effect = ServerDown()
+    with pytest.raises(BadGateway, match='The LDAP server is not reachable.'):
+        verify_alice(ldap)
+    # The failed connection and the one used for the retry are closed.
+    assert ldap.initialize.call_count == 2
+    assert ldap.initialize.return_value.unbind_s.call_count == 2
+
+    ldap.initialize.return_value.search_s.side_effect = None
+    ldap.initialize.return_value.search_s.return_value = [
+        ('cn=qa,ou=Groups,dc=example,dc=com', {'cn': [b'qa']})]
+    assert verify_alice(ldap)
+    assert ldap.initialize.call_count == 3
+
+
+def test_ldap_search_is_retried_on_new_connection(app, ldap, ldap_pool):
+    ldap_host = 'ldap://ldap.example.com'
+    # Two idle connections to a restarted server.
+    with ldap_pool.connection(ldap, ldap_host), ldap_pool.connection(ldap, ldap_host):
+        pass
+    for con in ldap.connections:
+        con.search_s.side_effect = ServerDown()
+
+    assert verify_alice(ldap)
+    assert len(ldap.connections) == 3
+    ldap.connections[0].unbind_s.assert_called_once()
+    ldap.connections[1].unbind_s.assert_called_once()
+    ldap.connections[2].search_s.assert_called_once()
+    ldap.connections[2].unbind_s.assert_not_called()
+
+
+def test_ldap_pool_is_bounded(app, ldap, ldap_pool):
+    ldap_host = 'ldap://ldap.example.com'
+    with ldap_pool.connection(ldap, ldap_host) as con1, \
+            ldap_pool.connection(ldap, ldap_host) as con2:
+        assert con1 is not con2
+        with pytest.raises(ServiceUnavailable):
+            with ldap_pool.connection(ldap, ldap_host):
+                pass
+
+    with ldap_pool.connection(ldap, ldap_host) as con3:
+        assert con3 in (con1, con2)
+    assert len(ldap.connections) == 2
+
+
+def test_ldap_connections_are_not_limited_without_pool(app, ldap, ldap_pool):
+    ldap_pool.configure(0, 0.1, 300, 30)
+    ldap_host = 'ldap://ldap.example.com'
+    with ldap_pool.connection(ldap, ldap_host) as con1, \
+            ldap_pool.connection(ldap, ldap_host) as con2, \
+            ldap_pool.connection(ldap, ldap_host) as con3:
+        assert len({con1, con2, con3}) == 3
+    for con in ldap.connections:
+        con.unbind_s.assert_called_once()
+
+
+def test_ldap_stale_connections_are_closed_on_timeout(app, ldap, ldap_pool):
+    with ldap_pool.connection(ldap, 'ldap://ldap1.example.com'):
+        with ldap_pool.connection(ldap, 'ldap://ldap1.example.com'):
+            ldap_pool.maxsize = 1
+        # The idle connection is dropped to make room for the other host,
+        # but the one still in use keeps the pool full.
+        with pytest.raises(ServiceUnavailable):
+            with ldap_pool.connection(ldap, 'ldap://ldap2.example.com'):
+                pass
+        ldap.connections[1].unbind_s.assert_called_once()
+    assert len(ldap.connections) == 2
+
+
+def test_ldap_idle_connections_expire(app, ldap, ldap_pool):
+    ldap_pool.configure(2, 0.1, 0.01, 0)
+    assert verify_alice(ldap)
+    time.sleep(0.02)
+    assert verify_alice(ldap)
+
+    assert len(ldap.connections) == 2
+    ldap.connections[0].unbind_s.assert_called_once()
+    ldap.connections[0].whoami_s.assert_not_called()
+
+
+@pytest.fixture
+def ldap_permissions(app, ldap, monkeypatch):
+    monkeypatch.setitem(app.config, 'PERMISSIONS', PERMISSIONS + [
+        {'testcases': ['testcase2'], 'groups': [], 'users': ['bob']},
+    ])
+    monkeypatch.setitem(app.config, 'LDAP_HOST', 'ldap://ldap.example.com')
+    monkeypatch.setitem(app.config, 'LDAP_SEARCHES', LDAP_SEARCHES)
+    ldap.groups[('ou=Groups,dc=example,dc=com', '(memberUid=alice)')] = ['qa']
+    ldap.groups[('ou=Groups,dc=example,dc=com', '(memberUid=bob)')] = ['devel']
+    with patch('waiverdb.auth.get_user', return_value=('bodhi', {})):
+        yield
+
+
+def waiver_batch():
+    return [
+        {
+            'subject_type': 'koji_build',
+            'subject_identifier': 'glibc-2.26-%d.fc27' % i,
+            'testcase': testcase,
+            'username': username,
+            'product_version': 'fool-1',
+            'waived': True,
+            'comment': 'it broke',
+        }
+        for i in range(10)
+        for username, testcase in [('alice', 'testcase1'), ('bob', 'testcase2')]
+    ]
+
+
+def test_batch_authorization_once_per_user_and_testcase(client, session, ldap_permissions):
+    with patch.object(WaiversResource, '_verify_authorization',
+                      autospec=True, side_effect=WaiversResource._verify_authorization) \
+            as verify:
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(waiver_batch()),
+                        content_type='application/json')
+
+    assert r.status_code == 201, r.get_data(as_text=True)
+    waiver_ids = [w['id'] for w in json.loads(r.get_data(as_text=True))]
+    assert len(set(waiver_ids)) == 20
+    assert session.query(Waiver).filter(Waiver.id.in_(waiver_ids)).count() == 20
+    assert sorted(call.args[1:] for call in verify.call_args_list) == [
+        ('alice', 'testcase1'), ('bob', 'testcase2')]
+
+
+def test_batch_authorization_failure(client, session, ldap_permissions):
+    data = waiver_batch()
+    data[5]['testcase'] = 'testcase1'
+    last_waiver_id = session.query(func.max(Waiver.id)).scalar() or 0
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+
+    assert r.status_code == 401
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['message'] == \
+        'You are not authorized to submit a waiver for the test case testcase1'
+    assert session.query(Waiver).filter(Waiver.id > last_waiver_id).count() == 0
+
+
+def test_job_authorization_failure(client, session, ldap_permissions):
+    data = waiver_batch()[:4]
+    data[3]['testcase'] = 'testcase1'
+    client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                content_type='application/json', headers={'Prefer': 'respond-async'})
+
+    with patch('waiverdb.events.publish'):
+        job = process_next_job(session)
+
+    assert [item['status'] for item in json.loads(job.result)] == [
+        'created', 'created', 'created', 'failed']
+    assert json.loads(job.result)[3]['error'] == \
+        'You are not authorized to submit a waiver for the test case testcase1'
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+from mock import patch
+
+import waiverdb.monitor as monitor
+from waiverdb.cache import Cache
+
+
+def counter_value(counter, name):
+    return counter.labels(name)._value.get()
+
+
+def test_cache_get_and_set():
+    cache = Cache('test_get_and_set')
+    assert cache.get('a') is None
+    assert cache.get('a', 'default') == 'default'
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert counter_value(monitor.cache_hit_counter, 'test_get_and_set') == 1
+    assert counter_value(monitor.cache_miss_counter, 'test_get_and_set') == 2
+
+
+def test_cache_evicts_least_recently_used():
+    cache = Cache('test_lru', maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert counter_value(monitor.cache_eviction_counter, 'test_lru') == 1
+
+
+@patch('waiverdb.cache.time.monotonic')
+def test_cache_items_expire(mock_monotonic):
+    cache = Cache('test_ttl', ttl=10)
+    mock_monotonic.return_value = 100
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    mock_monotonic.return_value = 109
+    assert cache.get('a') == 1
+    mock_monotonic.return_value = 110
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    mock_monotonic.return_value = 120
+    assert cache.get('b') is None
+    assert len(cache) == 0
+
+
+def test_cache_evicts_by_weight():
+    cache = Cache('test_weight', maxweight=10)
+    cache.set('a', 1, weight=4)
+    cache.set('b', 2, weight=4)
+    cache.set('a', 3, weight=5)
+    assert len(cache) == 2
+    cache.set('c', 4, weight=3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 3
+    assert cache.get('c') == 4
+
+    # Values heavier than the limit are not cached at all.
+    cache.set('d', 5, weight=11)
+    assert cache.get('d') is None
+    assert len(cache) == 2
+
+
+def test_cache_disabled():
+    cache = Cache('test_disabled', maxsize=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_cache_clear():
+    cache = Cache('test_clear')
+    cache.set('a', 1)
+    cache.configure(maxsize=10, ttl=10)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    cache.clear()
+    assert cache.get('a') is None
@@ -2,9 +2,22 @@
 
 """This module contains tests for :mod:`waiverdb.events`."""
 from __future__ import unicode_literals
+import datetime
+import json
+
 from fedora_messaging import api, testing
+from fedora_messaging.exceptions import ConnectionException
 from flask_restful import marshal
-from waiverdb.models import Waiver
+from mock import patch
+
+from .utils import create_waiver
+from waiverdb.events import (
+    dispatch_outbox_messages,
+    enqueue_new_waivers,
+    purge_outbox_messages,
+)
+from waiverdb.models import OutboxMessage, Waiver
+from waiverdb.models.waivers import bulk_insert_waivers
 from waiverdb.fields import waiver_fields
 
 
@@ -53,3 +66,127 @@ def test_publish_new_waiver_with_fedmsg_for_proxy_user(session):
     )
     with testing.mock_sends(expected_msg):
         sesh.commit()
+
+
+def create_outbox_messages(session, count):
+    messages = [OutboxMessage(body=json.dumps({'id': i})) for i in range(count)]
+    session.add_all(messages)
+    session.flush()
+    return messages
+
+
+def test_enqueue_new_waivers(session):
+    waiver = Waiver(
+        subject_type='koji_build',
+        subject_identifier='glibc-2.26-27.fc27',
+        testcase='testcase1',
+        username='jcline',
+        product_version='something',
+        waived=True,
+        comment='This is a comment',
+    )
+    sesh = session()
+    sesh.add(waiver)
+    enqueue_new_waivers(sesh)
+
+    messages = sesh.query(OutboxMessage).all()
+    assert len(messages) == 1
+    assert json.loads(messages[0].body) == marshal(waiver, waiver_fields)
+    assert messages[0].sent is None
+
+    # Messages are not enqueued again on the next commit.
+    enqueue_new_waivers(sesh)
+    assert sesh.query(OutboxMessage).count() == 1
+
+
+def test_dispatch_outbox_messages(app, session):
+    messages = create_outbox_messages(session, 3)
+    with testing.mock_sends(*[
+            api.Message(topic='waiverdb.waiver.new', body={'id': i}) for i in range(2)]):
+        assert dispatch_outbox_messages(session(), 2) == 2
+    assert [bool(m.sent) for m in messages] == [True, True, False]
+    assert [m.attempts for m in messages] == [1, 1, 0]
+
+    with testing.mock_sends(api.Message(topic='waiverdb.waiver.new', body={'id': 2})):
+        assert dispatch_outbox_messages(session(), 2) == 1
+    assert all(m.sent for m in messages)
+
+    assert dispatch_outbox_messages(session(), 2) == 0
+
+
+def test_dispatch_outbox_messages_failure(app, session):
+    messages = create_outbox_messages(session, 3)
+    with patch('waiverdb.events.publish', side_effect=[None, ConnectionException('down')]):
+        assert dispatch_outbox_messages(session(), 10) == 1
+    assert [bool(m.sent) for m in messages] == [True, False, False]
+    assert [m.attempts for m in messages] == [1, 1, 0]
+    assert 'down' in messages[1].error
+
+    with patch('waiverdb.events.publish'):
+        assert dispatch_outbox_messages(session(), 10) == 2
+    assert all(m.sent for m in messages)
+    assert [m.attempts for m in messages] == [1, 2, 1]
+    assert messages[1].error is None
+
+
+def test_purge_outbox_messages(app, session):
+    messages = create_outbox_messages(session, 2)
+    messages[0].sent = datetime.datetime(2020, 1, 1)
+    messages[1].sent = datetime.datetime(2020, 1, 3)
+    assert purge_outbox_messages(session(), datetime.datetime(2020, 1, 2)) == 1
+    assert session.query(OutboxMessage).all() == [messages[1]]
+
+
+def test_enqueue_new_waivers_inserted_in_bulk(session):
+    waivers = [
+        Waiver(subject_type='koji_build', subject_identifier='glibc-2.26-%d.fc27' % i,
+               testcase='testcase1', username='jcline', product_version='something',
+               waived=True, comment='This is a comment')
+        for i in range(3)
+    ]
+    sesh = session()
+    bulk_insert_waivers(sesh, waivers)
+    enqueue_new_waivers(sesh)
+
+    messages = sesh.query(OutboxMessage).order_by(OutboxMessage.id).all()
+    assert [json.loads(m.body) for m in messages] == [
+        marshal(waiver, waiver_fields) for waiver in waivers]
+
+
+def test_publish_only_new_waivers(session):
+    sesh = session()
+    old_waiver = create_waiver(session, subject_type='koji_build',
+                               subject_identifier='glibc-2.26-27.fc27',
+                               testcase='testcase1', username='jcline',
+                               product_version='something')
+    old_msg = api.Message(
+        topic='waiverdb.waiver.new',
+        body=marshal(old_waiver, waiver_fields)
+    )
+    with testing.mock_sends(old_msg):
+        sesh.commit()
+    assert sesh.query(Waiver).filter(Waiver.id == old_waiver.id).one() == old_waiver
+
+    waiver = Waiver(
+        subject_type='koji_build',
+        subject_identifier='glibc-2.26-28.fc27',
+        testcase='testcase1',
+        username='jcline',
+        product_version='something',
+        waived=True,
+        comment='This is a comment',
+    )
+    sesh.add(waiver)
+    sesh.flush()
+
+    expected_msg = api.Message(
+        topic='waiverdb.waiver.new',
+        body=marshal(waiver, waiver_fields)
+    )
+    with testing.mock_sends(expected_msg):
+        sesh.commit()
+
+    # Nothing is published if no waiver was created.
+    assert sesh.query(Waiver).filter(Waiver.id.in_([old_waiver.id, waiver.id])).count() == 2
+    with testing.mock_sends():
+        sesh.commit()
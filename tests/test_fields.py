@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import json
+
+import pytest
+from flask_restful import marshal
+
+from .utils import create_waiver
+from waiverdb.fields import (
+    serialize_waiver,
+    valid_field_names,
+    waiver_columns,
+    waiver_fields,
+    waiver_projection,
+)
+from waiverdb.models import Waiver
+
+
+@pytest.mark.parametrize('subject_type,scenario,proxied_by', [
+    ('koji_build', None, None),
+    ('compose', 'scenario1', 'bodhi'),
+])
+def test_serialize_waiver_matches_marshal(session, subject_type, scenario, proxied_by):
+    waiver = create_waiver(session, subject_type=subject_type,
+                           subject_identifier='glibc-2.26-27.fc27',
+                           testcase='testcase1', username='foo', product_version='foo-1',
+                           comment='it broke', proxied_by=proxied_by, scenario=scenario)
+    row = session.query(*waiver_columns).filter(Waiver.id == waiver.id).one()
+    expected = json.dumps(marshal(waiver, waiver_fields))
+    assert json.dumps(serialize_waiver(waiver)) == expected
+    assert json.dumps(serialize_waiver(row)) == expected
+
+
+def test_waiver_projection(session):
+    waiver = create_waiver(session, subject_type='compose',
+                           subject_identifier='Fedora-9000-19700101.n.18',
+                           testcase='testcase1', username='foo', product_version='foo-1')
+    names = ['subject', 'waived', 'subject_type', 'timestamp']
+    columns, serialize = waiver_projection(names)
+    assert [column.key for column in columns] == [
+        'subject_type', 'subject_identifier', 'waived', 'timestamp']
+
+    row = session.query(*columns).filter(Waiver.id == waiver.id).one()
+    expected = serialize_waiver(waiver)
+    assert serialize(row) == {name: expected[name] for name in names}
+    assert list(serialize(row)) == names
+
+
+def test_waiver_projection_all_fields():
+    assert waiver_projection(None) == (waiver_columns, serialize_waiver)
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('testcase,waived', ['testcase', 'waived']),
+    (' testcase , testcase,', ['testcase']),
+    (['id', 'comment'], ['id', 'comment']),
+    ('', None),
+    ([], None),
+])
+def test_valid_field_names(value, expected):
+    assert valid_field_names(value) == expected
+
+
+@pytest.mark.parametrize('value', ['testcase,bogus', [1], {'id': True}])
+def test_invalid_field_names(value):
+    with pytest.raises(ValueError):
+        valid_field_names(value)
@@ -0,0 +1,175 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from mock import Mock, patch
+
+import waiverdb.api_v1
+from waiverdb.group_commit import GroupCommit
+from waiverdb.models import Waiver
+
+
+def submit_concurrently(group_commit, items, commit):
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        futures = [executor.submit(group_commit.submit, item, commit) for item in items]
+    return futures
+
+
+def test_group_commit_coalesces_concurrent_items():
+    group_commit = GroupCommit(window=5, max_size=4)
+    commit = Mock(side_effect=lambda items: [item * 2 for item in items])
+
+    futures = submit_concurrently(group_commit, [1, 2, 3, 4], commit)
+
+    # The group is committed as soon as it is full.
+    commit.assert_called_once()
+    assert sorted(commit.call_args.args[0]) == [1, 2, 3, 4]
+    assert [future.result() for future in futures] == [2, 4, 6, 8]
+
+
+def test_group_commit_starts_new_group_after_window():
+    group_commit = GroupCommit(window=0, max_size=100)
+    commit = Mock(side_effect=lambda items: items)
+
+    assert group_commit.submit(1, commit) == 1
+    assert group_commit.submit(2, commit) == 2
+    assert [call.args[0] for call in commit.call_args_list] == [[1], [2]]
+
+
+def test_group_commit_raises_error_in_all_threads():
+    group_commit = GroupCommit(window=5, max_size=3)
+    commit = Mock(side_effect=RuntimeError('database is gone'))
+
+    futures = submit_concurrently(group_commit, [1, 2, 3], commit)
+
+    commit.assert_called_once()
+    for future in futures:
+        with pytest.raises(RuntimeError, match='database is gone'):
+            future.result()
+
+
+def test_group_commit_waits_for_leader():
+    group_commit = GroupCommit(window=5, max_size=2)
+    committing = threading.Event()
+    finish = threading.Event()
+
+    def commit(items):
+        committing.set()
+        finish.wait(5)
+        return items
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        first = executor.submit(group_commit.submit, 1, commit)
+        second = executor.submit(group_commit.submit, 2, commit)
+        assert committing.wait(5)
+        # A new group is started while the full one is being committed.
+        group_commit.window = 0
+        third = executor.submit(group_commit.submit, 3, lambda items: items)
+        assert not first.done()
+        assert not second.done()
+        finish.set()
+
+    assert {first.result(), second.result()} == {1, 2}
+    assert third.result() == 3
+
+
+def test_create_waiver_with_group_commit(client, session, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'GROUP_COMMIT', True)
+    data = {
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    }
+    with patch('waiverdb.auth.get_user', return_value=('foo', {})), \
+            patch.object(client.application.extensions['waiverdb_group_commit'], 'window', 0), \
+            patch('waiverdb.events.publish') as mocked_publish:
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                        content_type='application/json')
+
+    assert r.status_code == 201
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['username'] == 'foo'
+    waiver = session.query(Waiver).get(res_data['id'])
+    assert waiver.username == 'foo'
+    assert waiver.testcase == 'testcase1'
+    assert mocked_publish.call_count == 1
+
+
+def post_waivers_concurrently(app, subjects):
+    def post(subject):
+        data = {
+            'subject_type': 'koji_build',
+            'subject_identifier': subject,
+            'testcase': 'testcase1',
+            'product_version': 'fool-1',
+            'waived': True,
+            'comment': 'it broke',
+        }
+        return app.test_client().post(
+            '/api/v1.0/waivers/', data=json.dumps(data), content_type='application/json')
+
+    with ThreadPoolExecutor(max_workers=len(subjects)) as executor:
+        return [executor.submit(post, subject) for subject in subjects]
+
+
+@pytest.fixture
+def concurrent_group_commit(app, session, monkeypatch):
+    monkeypatch.setitem(app.config, 'GROUP_COMMIT', True)
+    monkeypatch.setitem(app.config, 'MESSAGE_PUBLISHER', 'stomp')
+    group_commit = app.extensions['waiverdb_group_commit']
+    with patch('waiverdb.auth.get_user', return_value=('foo', {})), \
+            patch.object(group_commit, 'window', 5), \
+            patch.object(group_commit, 'max_size', 3):
+        yield
+
+
+def test_concurrent_waivers_with_group_commit(app, session, concurrent_group_commit):
+    commits = []
+    commit_waivers = waiverdb.api_v1._commit_waivers
+
+    def record_commit(waivers):
+        commits.append([waiver.subject_identifier for waiver in waivers])
+        return commit_waivers(waivers)
+
+    subjects = ['glibc-2.26-%d.fc27' % i for i in range(3)]
+    with patch('waiverdb.api_v1._commit_waivers', side_effect=record_commit), \
+            patch('waiverdb.events._send_stomp_message_with_retry') as mocked_send:
+        futures = post_waivers_concurrently(app, subjects)
+        responses = [future.result() for future in futures]
+
+    # A single request committed waivers of all the requests.
+    assert len(commits) == 1
+    assert sorted(commits[0]) == subjects
+
+    # Each request got its own waiver.
+    results = [json.loads(r.get_data(as_text=True)) for r in responses]
+    assert [r.status_code for r in responses] == [201, 201, 201]
+    assert [result['subject']['item'] for result in results] == subjects
+    for result in results:
+        waiver = session.query(Waiver).get(result['id'])
+        assert waiver.subject_identifier == result['subject']['item']
+
+    # Messages of all the waivers are published after the single commit.
+    mocked_send.assert_called_once()
+    bodies = mocked_send.call_args[0][0]
+    assert sorted(body['id'] for body in bodies) == sorted(result['id'] for result in results)
+
+
+def test_concurrent_waivers_fail_with_group_commit(app, session, concurrent_group_commit):
+    subjects = ['glibc-2.26-%d.fc27' % i for i in range(3)]
+    with patch('waiverdb.api_v1.bulk_insert_waivers',
+               side_effect=RuntimeError('database is down')), \
+            patch('waiverdb.events._send_stomp_message_with_retry') as mocked_send:
+        futures = post_waivers_concurrently(app, subjects)
+        for future in futures:
+            with pytest.raises(RuntimeError, match='database is down'):
+                future.result()
+
+    mocked_send.assert_not_called()
+    assert session.query(Waiver).filter(Waiver.subject_identifier.in_(subjects)).count() == 0
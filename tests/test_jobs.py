@@ -0,0 +1,203 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+import json
+
+import pytest
+from mock import patch
+
+from waiverdb.jobs import process_next_job
+from waiverdb.models import Waiver, WaiverJob
+
+
+@pytest.fixture
+def mocked_user():
+    with patch('waiverdb.auth.get_user', return_value=('foo', {})):
+        yield 'foo'
+
+
+def waiver_data(**kwargs):
+    data = {
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    }
+    data.update(kwargs)
+    return data
+
+
+def submit(client, data, **headers):
+    return client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                       content_type='application/json',
+                       headers=dict(headers, Prefer='respond-async'))
+
+
+def job_waivers(session, job):
+    """Returns waivers created by the job."""
+    waiver_ids = [item['waiver_id'] for item in json.loads(job.result) if 'waiver_id' in item]
+    return session.query(Waiver).filter(Waiver.id.in_(waiver_ids)).order_by(Waiver.id).all()
+
+
+def test_submit_job(mocked_user, client, session):
+    waiver_count = session.query(Waiver).count()
+    r = submit(client, waiver_data())
+    assert r.status_code == 202
+    res_data = json.loads(r.get_data(as_text=True))
+    job = session.query(WaiverJob).get(res_data['id'])
+    assert job.username == 'foo'
+    assert res_data == {
+        'id': job.id,
+        'status': 'pending',
+        'url': 'http://localhost/api/v1.0/jobs/{}'.format(job.id),
+    }
+    assert r.headers['Location'] == res_data['url']
+    assert session.query(Waiver).count() == waiver_count
+
+    r = client.get(res_data['url'])
+    assert r.status_code == 200
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['status'] == 'pending'
+    assert res_data['username'] == 'foo'
+    assert res_data['items'] is None
+    assert res_data['attempts'] == 0
+
+
+def test_submit_invalid_job(mocked_user, client, session):
+    job_count = session.query(WaiverJob).count()
+    r = submit(client, [waiver_data(), {}])
+    assert r.status_code == 400
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['message'] == {'waived': 'Missing required parameter in the JSON body'}
+    assert session.query(WaiverJob).count() == job_count
+
+    r = submit(client, waiver_data(), **{'Idempotency-Key': 'request-1'})
+    assert r.status_code == 400
+    assert session.query(WaiverJob).count() == job_count
+
+
+def test_process_job(mocked_user, client, session):
+    data = [
+        waiver_data(),
+        waiver_data(subject_identifier='glibc-2.26-28.fc27'),
+        # Only superusers can create waivers for other users.
+        waiver_data(username='bar'),
+    ]
+    r = submit(client, data)
+    res_data = json.loads(r.get_data(as_text=True))
+
+    with patch('waiverdb.events.publish') as mocked_publish:
+        job = process_next_job(session)
+    assert job.id == res_data['id']
+    assert job.status == 'done'
+
+    waivers = job_waivers(session, job)
+    assert [w.subject_identifier for w in waivers] == ['glibc-2.26-27.fc27', 'glibc-2.26-28.fc27']
+    assert mocked_publish.call_count == 2
+
+    r = client.get(res_data['url'])
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['status'] == 'done'
+    assert res_data['finished'] is not None
+    assert res_data['items'] == [
+        {'status': 'created', 'waiver_id': waivers[0].id},
+        {'status': 'created', 'waiver_id': waivers[1].id},
+        {'status': 'failed', 'error': 'user foo does not have the proxyuser ability'},
+    ]
+    assert res_data['error'] is None
+
+
+def test_process_job_with_duplicates(mocked_user, client, session, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'DEDUPLICATE_WAIVERS', True)
+    submit(client, [waiver_data(), waiver_data()])
+
+    with patch('waiverdb.events.publish'):
+        job = process_next_job(session)
+
+    waiver, = job_waivers(session, job)
+    assert json.loads(job.result) == [
+        {'status': 'created', 'waiver_id': waiver.id},
+        {'status': 'duplicate', 'waiver_id': waiver.id},
+    ]
+
+
+def test_process_failed_job(mocked_user, client, session, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'JOB_MAX_ATTEMPTS', 2)
+    waiver_count = session.query(Waiver).count()
+    r = submit(client, waiver_data(result_id=123, subject_type=None, subject_identifier=None,
+                                   testcase=None))
+    job_id = json.loads(r.get_data(as_text=True))['id']
+    error = '503 Service Unavailable: Failed looking up result in Resultsdb: timeout'
+
+    with patch('waiverdb.api_v1.get_resultsdb_result', side_effect=RuntimeError('timeout')):
+        job = process_next_job(session)
+        assert job.id == job_id
+        assert job.status == 'pending'
+        assert job.attempts == 1
+        assert job.error == error
+        assert job.finished is None
+        assert job.next_attempt > datetime.datetime.utcnow()
+
+        # The job is not retried before the next attempt time.
+        assert process_next_job(session) is None
+
+        job.next_attempt = datetime.datetime.utcnow()
+        session.commit()
+        job = process_next_job(session)
+
+    assert job.id == job_id
+    assert job.status == 'failed'
+    assert job.attempts == 2
+    assert job.error == error
+    assert job.finished is not None
+    assert session.query(Waiver).count() == waiver_count
+
+
+def test_process_job_after_retry(mocked_user, client, session):
+    r = submit(client, waiver_data(result_id=123, subject_type=None, subject_identifier=None,
+                                   testcase=None))
+    job_id = json.loads(r.get_data(as_text=True))['id']
+
+    with patch('waiverdb.api_v1.get_resultsdb_result', side_effect=RuntimeError('timeout')):
+        job = process_next_job(session)
+    assert job.status == 'pending'
+
+    job.next_attempt = datetime.datetime.utcnow()
+    session.commit()
+    result = {
+        'data': {'type': ['koji_build'], 'item': ['glibc-2.26-27.fc27']},
+        'testcase': {'name': 'testcase1'},
+    }
+    with patch('waiverdb.api_v1.get_resultsdb_result', return_value=result), \
+            patch('waiverdb.events.publish'):
+        job = process_next_job(session)
+
+    assert job.id == job_id
+    assert job.status == 'done'
+    assert job.attempts == 1
+    assert job.error is None
+    waiver, = job_waivers(session, job)
+    assert waiver.testcase == 'testcase1'
+
+
+def test_process_job_with_client_error_is_not_retried(mocked_user, client, session):
+    r = submit(client, waiver_data(result_id=123, subject_type=None, subject_identifier=None,
+                                   testcase=None))
+    job_id = json.loads(r.get_data(as_text=True))['id']
+
+    with patch('waiverdb.jobs.create_job_waivers', side_effect=ValueError('bad job')):
+        job = process_next_job(session)
+
+    assert job.id == job_id
+    assert job.status == 'failed'
+    assert job.attempts == 1
+    assert job.error == 'bad job'
+
+
+def test_get_unknown_job(client, session):
+    r = client.get('/api/v1.0/jobs/123')
+    assert r.status_code == 404
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['message'] == 'Job not found'
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+
+from mock import patch
+
+from .utils import create_waiver
+from waiverdb.manage import (
+    check_current_waivers,
+    dispatch_messages,
+    process_jobs,
+    purge_idempotency_keys,
+)
+from waiverdb.models import CurrentWaiver, IdempotencyKey, OutboxMessage, WaiverJob
+
+
+def test_check_current_waivers(app, session):
+    old_waiver = create_waiver(session, subject_type='koji_build',
+                               subject_identifier='glibc-2.26-27.fc27',
+                               testcase='testcase1', username='foo', product_version='foo-1')
+    waiver = create_waiver(session, subject_type='koji_build',
+                           subject_identifier='glibc-2.26-27.fc27',
+                           testcase='testcase1', username='foo', product_version='foo-1')
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(check_current_waivers)
+    assert result.exit_code == 0
+    assert result.output == 'The current_waiver table is consistent.\n'
+
+    session.query(CurrentWaiver).delete()
+    result = runner.invoke(check_current_waivers)
+    assert result.exit_code == 1
+    assert 'Missing current waiver: ' in result.output
+
+    result = runner.invoke(check_current_waivers, ['--fix'])
+    assert result.exit_code == 0
+    assert 'The current_waiver table was rebuilt.' in result.output
+    current = session.query(CurrentWaiver.waiver_id).filter(
+        CurrentWaiver.waiver_id.in_([old_waiver.id, waiver.id])).all()
+    assert [waiver_id for waiver_id, in current] == [waiver.id]
+
+
+def test_dispatch_messages(app, session):
+    session.add_all([OutboxMessage(body='{"id": %d}' % i) for i in range(3)])
+    session.flush()
+    runner = app.test_cli_runner()
+
+    with patch('waiverdb.events.publish') as mocked_publish:
+        result = runner.invoke(dispatch_messages, ['--once', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert result.output == 'Published 2 messages.\nPublished 1 messages.\n'
+    assert [call.args[0].body for call in mocked_publish.call_args_list] == [
+        {'id': 0}, {'id': 1}, {'id': 2}]
+    assert session.query(OutboxMessage).filter(OutboxMessage.sent.is_(None)).count() == 0
+
+
+def test_purge_idempotency_keys(app, session):
+    now = datetime.datetime.utcnow()
+    for key, expires in (('a', now - datetime.timedelta(seconds=1)),
+                         ('b', now + datetime.timedelta(hours=1))):
+        session.add(IdempotencyKey(key=key, username='foo', request_hash='0' * 64,
+                                   response='{}', expires=expires))
+    session.commit()
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(purge_idempotency_keys)
+    assert result.exit_code == 0
+    assert result.output == 'Deleted 1 expired idempotency keys.\n'
+    assert [k.key for k in session.query(IdempotencyKey).all()] == ['b']
+
+
+def test_process_jobs(app, session):
+    job = WaiverJob(username='foo', request='[]')
+    session.add(job)
+    session.commit()
+    job_id = job.id
+    runner = app.test_cli_runner()
+
+    with patch('waiverdb.manage.purge_jobs') as purge_jobs:
+        result = runner.invoke(process_jobs, ['--once', '--workers', '1'])
+    assert result.exit_code == 0, result.output
+    assert result.output == 'Processed job {} (done).\n'.format(job_id)
+    assert purge_jobs.call_count == 1
+    job = session.query(WaiverJob).get(job_id)
+    assert job.status == 'done'
+    assert job.result == '[]'
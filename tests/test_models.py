@@ -1,8 +1,17 @@
 # SPDX-License-Identifier: GPL-2.0+
 
 import pytest
+from mock import patch
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 
-from waiverdb.models.waivers import subject_dict_to_type_identifier
+from .utils import create_waiver
+from waiverdb.models import CurrentWaiver, Waiver
+from waiverdb.models.waivers import (
+    bulk_insert_waivers,
+    subject_dict_to_type_identifier,
+    update_current_waivers,
+)
 
 
 @pytest.mark.parametrize('subject,expected_type,expected_identifier', [
@@ -23,3 +32,101 @@ def test_subject_dict_to_type_identifier(subject, expected_type, expected_identi
     subject_type, subject_identifier = subject_dict_to_type_identifier(subject)
     assert subject_type == expected_type
     assert subject_identifier == expected_identifier
+
+
+def test_current_waiver_points_to_most_recent_waiver(session):
+    old_waiver = create_waiver(session, subject_type='koji_build',
+                               subject_identifier='glibc-2.26-27.fc27',
+                               testcase='testcase1', username='foo', product_version='foo-1')
+    other_waiver = create_waiver(session, subject_type='koji_build',
+                                 subject_identifier='glibc-2.26-27.fc27',
+                                 testcase='testcase1', username='bar', product_version='foo-1')
+    new_waiver = create_waiver(session, subject_type='koji_build',
+                               subject_identifier='glibc-2.26-27.fc27',
+                               testcase='testcase1', username='foo', product_version='foo-1')
+    waiver_ids = [old_waiver.id, other_waiver.id, new_waiver.id]
+    current = session.query(CurrentWaiver.waiver_id).filter(
+        CurrentWaiver.waiver_id.in_(waiver_ids)).order_by(CurrentWaiver.waiver_id).all()
+    assert [waiver_id for waiver_id, in current] == [other_waiver.id, new_waiver.id]
+
+    # Updating with an older waiver keeps the more recent one current.
+    update_current_waivers(session.connection(), [{
+        'id': old_waiver.id,
+        'subject_type': 'koji_build',
+        'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1',
+        'username': 'foo',
+        'product_version': 'foo-1',
+    }])
+    current = session.query(CurrentWaiver.waiver_id).filter(
+        CurrentWaiver.waiver_id.in_(waiver_ids)).order_by(CurrentWaiver.waiver_id).all()
+    assert [waiver_id for waiver_id, in current] == [other_waiver.id, new_waiver.id]
+
+
+def test_waiver_timestamp_is_required(session):
+    # Keyset pagination by (timestamp, id) would skip waivers without timestamp.
+    statement = Waiver.__table__.insert().values(
+        subject_type='koji_build', subject_identifier='glibc-2.26-27.fc27',
+        testcase='testcase1', username='foo', product_version='foo-1', waived=True,
+        timestamp=None)
+    with pytest.raises(IntegrityError):
+        session.execute(statement)
+
+
+def test_by_value_set_does_not_grow_with_number_of_rows(session):
+    rows = [('koji_build', 'case %d' % i) for i in range(1000)]
+    query = Waiver.by_value_set(Waiver.query, ['subject_type', 'testcase'], rows + rows)
+    statement = query.statement.compile(dialect=postgresql.dialect())
+    assert 'unnest(' in str(statement)
+    assert len(statement.params) == 2
+    assert sorted(sorted(values) for values in statement.params.values()) == [
+        sorted(r[1] for r in rows),
+        ['koji_build'] * len(rows),
+    ]
+
+
+def test_by_value_set_matches_rows(postgresql):
+    waivers = [
+        create_waiver(postgresql, subject_type='koji_build',
+                      subject_identifier='glibc-2.26-%d.fc27' % i,
+                      testcase=testcase, username='foo', product_version='foo-1')
+        for i in range(3)
+        for testcase in ('testcase1', 'testcase2')
+    ]
+    waiver_ids = [waiver.id for waiver in waivers]
+    rows = [
+        ('glibc-2.26-0.fc27', 'testcase1'),
+        ('glibc-2.26-2.fc27', 'testcase2'),
+        ('glibc-2.26-2.fc27', 'testcase2'),
+        ('glibc-2.26-0.fc27', 'testcase3'),
+    ]
+    query = Waiver.query.filter(Waiver.id.in_(waiver_ids)).order_by(Waiver.id)
+    query = Waiver.by_value_set(query, ['subject_identifier', 'testcase'], rows)
+    assert query.all() == [waivers[0], waivers[5]]
+
+
+def test_bulk_insert_waivers_allocates_ids_in_order(postgresql):
+    session = postgresql()
+    waivers = [
+        Waiver(subject_type='koji_build', subject_identifier='glibc-2.26-%d.fc27' % (i // 2),
+               testcase='testcase1', username='foo', product_version='foo-1',
+               waived=True, comment='comment %d' % i)
+        for i in range(5)
+    ]
+    with patch('waiverdb.models.waivers.BULK_INSERT_BATCH_SIZE', 2):
+        bulk_insert_waivers(session, waivers)
+
+    # Ids are allocated in the order of waivers, not of rows returned by INSERT.
+    waiver_ids = [waiver.id for waiver in waivers]
+    assert None not in waiver_ids
+    assert waiver_ids == sorted(waiver_ids)
+    assert all(waiver.timestamp is not None for waiver in waivers)
+    assert not session.new
+
+    session.expire_all()
+    stored = session.query(Waiver).filter(Waiver.id.in_(waiver_ids)).order_by(Waiver.id).all()
+    assert [waiver.comment for waiver in stored] == ['comment %d' % i for i in range(5)]
+    current = session.query(CurrentWaiver.waiver_id).filter(
+        CurrentWaiver.waiver_id.in_(waiver_ids)).order_by(CurrentWaiver.waiver_id).all()
+    assert [waiver_id for waiver_id, in current] == [
+        waiver_ids[1], waiver_ids[3], waiver_ids[4]]
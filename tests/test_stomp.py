@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""Tests publishing messages via STOMP against an in-process STOMP server."""
+
+import json
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+from mock import patch
+
+from waiverdb.events import publish_new_waiver
+from waiverdb.models import Waiver
+from waiverdb.utils import stomp_connections
+
+
+class StompHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.connections.append(self.request)
+        buffer = b''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b'\0' in buffer:
+                frame, buffer = buffer.split(b'\0', 1)
+                if not self.handle_frame(frame.lstrip(b'\r\n').decode('utf-8')):
+                    return
+
+    def handle_frame(self, frame):
+        head, body = frame.split('\n\n', 1)
+        command, *header_lines = head.split('\n')
+        headers = dict(line.split(':', 1) for line in header_lines)
+        if command in ('CONNECT', 'STOMP'):
+            self.send('CONNECTED\nversion:1.1\nheart-beat:0,0\n\n\0')
+        elif command == 'SEND':
+            self.server.frames.append((headers, body))
+        elif command == 'DISCONNECT':
+            self.send('RECEIPT\nreceipt-id:%s\n\n\0' % headers['receipt'])
+            return False
+        return True
+
+    def send(self, data):
+        self.request.sendall(data.encode('utf-8'))
+
+
+class StompServer(socketserver.ThreadingTCPServer):
+    """
+    Minimal STOMP broker which records received SEND frames.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super(StompServer, self).__init__(('127.0.0.1', 0), StompHandler)
+        self.connections = []
+        self.frames = []
+
+    def drop_connections(self):
+        for conn in self.connections:
+            conn.shutdown(socket.SHUT_RDWR)
+
+
+@pytest.fixture
+def stomp_server():
+    server = StompServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    stomp_connections.close()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stomp_config(app, stomp_server):
+    config = dict(
+        MESSAGE_PUBLISHER='stomp',
+        STOMP_RETRY_DELAY_SECONDS=0,
+        STOMP_CONFIGS={
+            'destination': '/topic/VirtualTopic.eng.waiverdb.waiver.new',
+            'connection': {
+                'host_and_ports': [stomp_server.server_address],
+            },
+        },
+    )
+    with patch.dict(app.config, config):
+        yield config
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+def publish_waiver(session, subject_identifier):
+    waiver = Waiver(
+        subject_type='koji_build',
+        subject_identifier=subject_identifier,
+        testcase='testcase1',
+        username='jcline',
+        product_version='something',
+        waived=True,
+        comment='This is a comment',
+    )
+    sesh = session()
+    sesh.add(waiver)
+    sesh.flush()
+    publish_new_waiver(sesh)
+
+
+def test_stomp_connection_is_reused(session, stomp_server, stomp_config):
+    publish_waiver(session, 'glibc-2.26-1.fc27')
+    publish_waiver(session, 'glibc-2.26-2.fc27')
+
+    wait_for(lambda: len(stomp_server.frames) == 2)
+    assert len(stomp_server.connections) == 1
+    assert [json.loads(body)['subject_identifier'] for _, body in stomp_server.frames] == [
+        'glibc-2.26-1.fc27', 'glibc-2.26-2.fc27']
+    headers, _ = stomp_server.frames[0]
+    assert headers['destination'] == '/topic/VirtualTopic.eng.waiverdb.waiver.new'
+    assert stomp_connections.healthy
+
+
+def test_stomp_reconnects_after_connection_is_lost(session, stomp_server, stomp_config):
+    publish_waiver(session, 'glibc-2.26-1.fc27')
+    wait_for(lambda: len(stomp_server.frames) == 1)
+
+    stomp_server.drop_connections()
+    wait_for(lambda: not stomp_connections.is_connected())
+
+    publish_waiver(session, 'glibc-2.26-2.fc27')
+    wait_for(lambda: len(stomp_server.frames) == 2)
+    assert len(stomp_server.connections) == 2
+    assert stomp_connections.healthy
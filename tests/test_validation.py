@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import pytest
+from flask_restful import reqparse
+from werkzeug.exceptions import HTTPException
+
+from waiverdb.api_v1 import CP, RP
+from waiverdb.validation import CompiledParser
+
+
+def parse(parse_args):
+    try:
+        return dict(parse_args())
+    except HTTPException as e:
+        return e.code, e.data
+
+
+@pytest.mark.parametrize('name, data', [
+    ('create_waiver', {
+        'subject_type': 'koji_build', 'subject_identifier': 'glibc-2.26-27.fc27',
+        'testcase': 'testcase1', 'product_version': 'fool-1', 'waived': True,
+        'comment': 'it broke',
+    }),
+    ('create_waiver', {
+        'subject': {'type': 'koji_build', 'item': 'glibc-2.26-27.fc27'},
+        'testcase': 'testcase1', 'product_version': 'fool-1', 'waived': 'false',
+        'comment': 'it broke', 'username': 'bar', 'scenario': None,
+    }),
+    ('create_waiver', {
+        'result_id': '123', 'product_version': 1, 'waived': 0, 'comment': None,
+    }),
+    ('create_waiver', {'result_id': 'abc', 'waived': True}),
+    ('create_waiver', {'subject': 'glibc', 'waived': True}),
+    ('create_waiver', {'product_version': 'fool-1', 'comment': 'it broke'}),
+    ('create_waiver', {'waived': True, 'comment': 'it broke'}),
+    ('create_waiver', {}),
+    ('create_waiver', None),
+    ('filter_waivers', {'filters': [{'testcase': 'testcase1'}], 'fields': 'id,testcase'}),
+    ('filter_waivers', {'filters': [{}]}),
+    ('filter_waivers', {'filters': [], 'include_obsolete': 1}),
+    ('filter_waivers', {'filters': [{'testcase': 'testcase1'}], 'fields': ['nope']}),
+    ('get_waivers_by_subjects_and_testcase', {
+        'results': [{'subject': {'type': 'koji_build'}, 'testcase': 'testcase1'}],
+        'since': '2017-02-13T23:37:58.193281', 'proxied_by': 1,
+    }),
+    ('get_waivers_by_subjects_and_testcase', {'results': [{'subject': 'koji_build'}]}),
+    ('get_waivers_by_subjects_and_testcase', {'since': 'yesterday'}),
+    ('get_waivers_by_subjects_and_testcase', {}),
+])
+def test_compiled_parser_matches_request_parser(app, name, data):
+    with app.test_request_context(json=data):
+        expected = parse(RP[name].parse_args)
+    assert parse(lambda: CP[name].parse(data)) == expected
+
+
+def test_compiled_parser_parses_list(app):
+    data = [
+        {'result_id': 1, 'product_version': 'fool-1', 'waived': True, 'comment': 'it broke'},
+        {'result_id': 2, 'product_version': 'fool-1', 'waived': False},
+    ]
+    with pytest.raises(HTTPException) as excinfo:
+        CP['create_waiver'].parse_list(data)
+    assert excinfo.value.code == 400
+    assert excinfo.value.data == {
+        'message': {'comment': 'Missing required parameter in the JSON body'}}
+
+    data[1]['comment'] = 'it broke'
+    assert [args['result_id'] for args in CP['create_waiver'].parse_list(data)] == [1, 2]
+
+
+def test_compiled_parser_rejects_unsupported_arguments():
+    parser = reqparse.RequestParser()
+    parser.add_argument('since', location='args')
+    with pytest.raises(ValueError, match="Argument 'since' is not in JSON body"):
+        CompiledParser(parser)
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('testcase', action='append', location='json')
+    with pytest.raises(ValueError, match="Option 'action' of argument 'testcase'"):
+        CompiledParser(parser)
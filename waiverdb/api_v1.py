@@ -1,31 +1,78 @@
 # SPDX-License-Identifier: GPL-2.0+
 
 import datetime
+import hashlib
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from flask import Blueprint, request, current_app
-from flask_restful import Resource, Api, reqparse, marshal_with, marshal
+from flask_restful import Resource, Api, inputs, reqparse, marshal_with
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from werkzeug.exceptions import (
     BadRequest,
     Forbidden,
+    HTTPException,
+    NotFound,
     ServiceUnavailable,
+    UnprocessableEntity,
 )
-from sqlalchemy.sql.expression import func, and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import and_, exists, or_
 
 from waiverdb import __version__
-from waiverdb.authorization import match_testcase_permissions, verify_authorization
-from waiverdb.models import db
-from waiverdb.models.waivers import Waiver, subject_dict_to_type_identifier
-from waiverdb.utils import json_collection, jsonp
-from waiverdb.fields import waiver_fields
+from waiverdb.authorization import PermissionMatcher, verify_authorization
+from waiverdb.cache import get_cache
+from waiverdb.group_commit import get_group_commit
+from waiverdb.models import db, IdempotencyKey, WaiverJob
+from waiverdb.models.waivers import (
+    CurrentWaiver,
+    Waiver,
+    bulk_insert_waivers,
+    current_waiver_watermark,
+    find_duplicate_waivers,
+    subject_dict_to_type_identifier,
+    value_set_supported,
+)
+from waiverdb.utils import (
+    conditional_get,
+    decode_cursor,
+    estimate_count,
+    json_collection,
+    json_cursor_collection,
+    jsonp,
+    ndjson_collection,
+    wants_ndjson,
+)
+from waiverdb.fields import (
+    serialize_job,
+    serialize_waiver,
+    valid_field_names,
+    waiver_fields,
+    waiver_projection,
+)
+from waiverdb.validation import CompiledParser
 import waiverdb.auth
+import waiverdb.monitor as monitor
 
 api_v1 = (Blueprint('api_v1', __name__))
 api = Api(api_v1)
-requests_session = requests.Session()
 log = logging.getLogger(__name__)
 
+# Filter dict keys in +filtered requests compared for equality with a column
+FILTER_EQUALITY_FIELDS = (
+    'subject_type',
+    'subject_identifier',
+    'testcase',
+    'scenario',
+    'product_version',
+    'username',
+    'proxied_by',
+)
+
 
 def valid_dict(value):
     if not isinstance(value, dict):
@@ -33,13 +80,135 @@ def valid_dict(value):
     return value
 
 
+def configure_resultsdb(app):
+    """
+    Sets up the session for requests to ResultsDB of the application, with
+    its connection pool and retries.
+    """
+    config = app.config
+    retry = Retry(
+        total=config['RESULTSDB_RETRIES'],
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config['RESULTSDB_MAX_WORKERS'],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount(config['RESULTSDB_API_URL'], adapter)
+    app.extensions['waiverdb_resultsdb_session'] = session
+
+
+def resultsdb_session():
+    """
+    Returns the session for requests to ResultsDB of the current application.
+    """
+    return current_app.extensions['waiverdb_resultsdb_session']
+
+
 def get_resultsdb_result(result_id):
-    response = requests_session.request('GET', '{0}/results/{1}'.format(
-        current_app.config['RESULTSDB_API_URL'], result_id),
-        headers={'Content-Type': 'application/json'},
-        timeout=60)
-    response.raise_for_status()
-    return response.json()
+    url = '{0}/results/{1}'.format(current_app.config['RESULTSDB_API_URL'], result_id)
+    cache = get_cache('resultsdb_result')
+    result = cache.get(url)
+    if result is None:
+        with monitor.resultsdb_lookup_latency.time():
+            response = resultsdb_session().request(
+                'GET', url, headers={'Content-Type': 'application/json'}, timeout=60)
+        response.raise_for_status()
+        result = response.json()
+        cache.set(url, result)
+    return result
+
+
+def get_resultsdb_results(result_ids):
+    """
+    Looks up the results in ResultsDB concurrently.
+
+    Returns dict mapping each result id to a future of
+    :func:`get_resultsdb_result`.
+    """
+    result_ids = set(result_ids)
+    if not result_ids:
+        return {}
+
+    app = current_app._get_current_object()
+
+    def get_result(result_id):
+        with app.app_context():
+            return get_resultsdb_result(result_id)
+
+    max_workers = min(len(result_ids), current_app.config['RESULTSDB_MAX_WORKERS'])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return {
+            result_id: executor.submit(get_result, result_id)
+            for result_id in result_ids
+        }
+
+
+def _commit_waivers(waivers):
+    """
+    Stores new waivers from concurrent requests in a single transaction (see
+    :mod:`waiverdb.group_commit`).
+
+    Returns list of the serialized waivers.
+    """
+    bulk_insert_waivers(db.session, waivers)
+    db.session.flush()
+    # Serialized before commit, which would expire the waivers.
+    result = [serialize_waiver(waiver) for waiver in waivers]
+    db.session.commit()
+    return result
+
+
+def _prefers_async():
+    """
+    Returns True if the client prefers asynchronous processing of the
+    request (RFC 7240).
+    """
+    preferences = request.headers.get('Prefer', '').split(',')
+    return any(preference.strip().lower() == 'respond-async' for preference in preferences)
+
+
+def create_job_waivers(job):
+    """
+    Creates waivers submitted asynchronously in the current transaction.
+
+    Waivers which cannot be created because of a client error, for example
+    because the user is not permitted to waive the test case, are reported as
+    failed and the others are created.
+
+    Returns list with result of each waiver of the job.
+    """
+    resource = WaiversResource()
+    all_args = json.loads(job.request)
+
+    results = []
+    waivers = []
+    for item in resource._create_waivers(all_args, job.username):
+        if isinstance(item, HTTPException):
+            # Server errors (e.g. unreachable LDAP or ResultsDB) fail the job.
+            if item.code >= 500:
+                raise item
+            results.append({'status': 'failed', 'error': item.description})
+        else:
+            waivers.append(item)
+            results.append(None)
+
+    created, new_waivers = resource._deduplicate(waivers)
+    bulk_insert_waivers(db.session, new_waivers)
+    db.session.flush()
+
+    items = iter(zip(waivers, created))
+    for i, result in enumerate(results):
+        if result is None:
+            waiver, current = next(items)
+            results[i] = {
+                'status': 'created' if current is waiver else 'duplicate',
+                'waiver_id': current.id,
+            }
+    return results
 
 
 def valid_results_list(results):
@@ -90,16 +259,62 @@ def reqparse_since(since):
     return start, end
 
 
+def reqparse_cursor(cursor):
+    """
+    Parses the 'after' and 'before' query parameters, which are opaque keyset
+    pagination tokens taken from the 'next' and 'prev' links.
+
+    An empty value requests the first page. Only one of the parameters can
+    be given in a request.
+
+    Returns a tuple (timestamp, id) or None.
+    """
+    if not cursor:
+        return None
+    return decode_cursor(cursor)
+
+
 def permissions():
     """
     Return PERMISSIONS configuration.
     PERMISSION_MAPPING converted to the new format.
     """
-    permissions_config = current_app.config.get('PERMISSIONS')
+    return permission_matcher().permissions
+
+
+def permission_matcher():
+    """
+    Returns :class:`PermissionMatcher` for the current permissions.
+
+    The permissions are compiled when the application is created (see
+    :func:`compile_permissions`) and again only if the configuration options
+    are replaced.
+    """
+    source, matcher = current_app.extensions['waiverdb_permissions']
+    if any(a is not b for a, b in zip(source, _permissions_source(current_app.config))):
+        matcher = compile_permissions(current_app)
+    return matcher
+
+
+def compile_permissions(app):
+    """
+    Compiles permissions from the application configuration.
+    """
+    matcher = PermissionMatcher(_permissions(app.config), app.config['PERMISSION_CACHE_SIZE'])
+    app.extensions['waiverdb_permissions'] = (_permissions_source(app.config), matcher)
+    return matcher
+
+
+def _permissions_source(config):
+    return (config.get('PERMISSIONS'), config.get('PERMISSION_MAPPING'))
+
+
+def _permissions(config):
+    permissions_config = config.get('PERMISSIONS')
     if permissions_config:
         return permissions_config
 
-    permission_mapping = current_app.config.get('PERMISSION_MAPPING')
+    permission_mapping = config.get('PERMISSION_MAPPING')
     if permission_mapping:
         return [
             {
@@ -115,21 +330,128 @@ def permissions():
     return []
 
 
+def waiver_version(waiver_id):
+    """
+    Returns id and timestamp of the given waiver, if it exists.
+    """
+    waiver = db.session.query(Waiver.id, Waiver.timestamp)\
+        .filter(Waiver.id == waiver_id).first()
+    return waiver or (None, None)
+
+
+def waiver_watermark():
+    """
+    Returns value and time of the last change of the waiver watermark, which
+    changes whenever new waivers are committed (see
+    :class:`waiverdb.models.WaiverWatermark`).
+
+    Waivers are never modified, so this changes whenever the response of any
+    waiver query may change.
+    """
+    return current_waiver_watermark(db.session)
+
+
+def _cached_result(name, args, create, watermark=None):
+    """
+    Returns result of ``create()`` cached for the given request arguments.
+
+    The key contains the raw query string too, because links to other pages
+    in the result are built from it.
+
+    Results are valid only until new waivers are committed. Optional
+    ``watermark`` is the value of the waiver watermark, if the caller already
+    knows it (see :func:`waiver_watermark`). It must be looked up before the
+    result is created.
+    """
+    if watermark is None:
+        watermark, _ = waiver_watermark()
+    key = (
+        name,
+        request.host_url,
+        tuple(sorted(request.args.items(multi=True))),
+        json.dumps(args, sort_keys=True, default=str),
+        watermark,
+    )
+    cache = get_cache('query_result')
+    result = cache.get(key)
+    if result is None:
+        result = create()
+        body = result[0] if isinstance(result, tuple) else result
+        cache.set(key, result, weight=max(1, len(body['data'])))
+    return result
+
+
+def _homogeneous_filter_fields(filters):
+    """
+    Returns sorted list of fields used in the filters if all filters compare
+    the same fields with strings for equality, otherwise returns None.
+
+    Such filters can be matched as a set of values with
+    :meth:`Waiver.by_value_set`.
+    """
+    fields = set(filters[0])
+    if not fields or not fields.issubset(FILTER_EQUALITY_FIELDS):
+        return None
+    for filter_ in filters:
+        if set(filter_) != fields or not all(isinstance(v, str) for v in filter_.values()):
+            return None
+    return sorted(fields)
+
+
+def _filter_by_clauses(query, filters):
+    """
+    Filters waivers matching at least one of the filter dicts by OR-ing a
+    clause for each of them.
+    """
+    clauses = []
+    for filter_ in filters:
+        inner_clauses = []
+        for field in FILTER_EQUALITY_FIELDS:
+            if field in filter_:
+                inner_clauses.append(getattr(Waiver, field) == filter_[field])
+        if 'since' in filter_:
+            try:
+                since_start, since_end = reqparse_since(filter_['since'])
+            except ValueError as e:
+                raise BadRequest({'since': str(e)})
+            if since_start:
+                inner_clauses.append(Waiver.timestamp >= since_start)
+            if since_end:
+                inner_clauses.append(Waiver.timestamp <= since_end)
+        clauses.append(and_(*inner_clauses))
+    return query.filter(or_(*clauses))
+
+
 def _filter_out_obsolete_waivers(query):
     """
     Filters out obsolete waivers.
 
     A waiver is obsolete if there exist another one that is more recent with
     same subject, test case name, username and product_version.
+
+    The most recent waivers are tracked in the CurrentWaiver table, so this
+    is a join on its unique waiver_id index.
     """
-    subquery = db.session.query(func.max(Waiver.id)).group_by(
-        Waiver.subject_type,
-        Waiver.subject_identifier,
-        Waiver.testcase,
-        Waiver.username,
-        Waiver.product_version,
-    )
-    return query.filter(Waiver.id.in_(subquery))
+    return query.join(CurrentWaiver, CurrentWaiver.waiver_id == Waiver.id)
+
+
+def _filter_out_obsolete_waivers_by_subject_and_testcase(query):
+    """
+    Filters out obsolete waivers, ignoring username and product_version.
+
+    A waiver is obsolete if there exist another one that is more recent with
+    same subject and test case name.
+
+    The most recent such waiver is necessarily also current for its username
+    and product_version, so only current waivers need to be compared.
+    """
+    newer = aliased(CurrentWaiver)
+    return _filter_out_obsolete_waivers(query).filter(~exists().where(and_(
+        newer.subject_type == Waiver.subject_type,
+        newer.subject_identifier == Waiver.subject_identifier,
+        newer.testcase == Waiver.testcase,
+        newer.waiver_id > Waiver.id,
+    )))
 
 
 # RP contains request parsers (reqparse.RequestParser).
@@ -162,6 +484,14 @@ RP['get_waivers'].add_argument('since', type=reqparse_since, location='args')
 RP['get_waivers'].add_argument('page', default=1, type=int, location='args')
 RP['get_waivers'].add_argument('limit', default=10, type=int, location='args')
 RP['get_waivers'].add_argument('proxied_by', location='args')
+RP['get_waivers'].add_argument('fields', type=valid_field_names, location='args')
+# If false, the total number of waivers is not counted
+RP['get_waivers'].add_argument('count', type=inputs.boolean, default=True, location='args')
+# Keyset pagination, replaces 'page' if either is present
+RP['get_waivers'].add_argument('after', type=reqparse_cursor, store_missing=False,
+                               location='args')
+RP['get_waivers'].add_argument('before', type=reqparse_cursor, store_missing=False,
+                               location='args')
 
 RP['get_permissions'] = reqparse.RequestParser()
 RP['get_permissions'].add_argument('testcase', location='args')
@@ -169,6 +499,7 @@ RP['get_permissions'].add_argument('testcase', location='args')
 RP['filter_waivers'] = reqparse.RequestParser()
 RP['filter_waivers'].add_argument('filters', type=valid_filter_list, required=True, location='json')
 RP['filter_waivers'].add_argument('include_obsolete', type=bool, default=False, location='json')
+RP['filter_waivers'].add_argument('fields', type=valid_field_names, location='json')
 
 RP['get_waivers_by_subjects_and_testcase'] = rp = reqparse.RequestParser()
 rp.add_argument('results', type=valid_results_list, location='json')
@@ -178,20 +509,19 @@ rp.add_argument('username', type=str, location='json')
 rp.add_argument('proxied_by', location='json')
 rp.add_argument('since', type=reqparse_since, location='json')
 rp.add_argument('include_obsolete', type=bool, default=False, location='json')
+rp.add_argument('fields', type=valid_field_names, location='json')
 
-
-class DummyJsonRequest(object):
-    """
-    Can be passed to reqparse.RequestParser.parse_args() instead of current
-    request.
-    """
-    def __init__(self, data):
-        self.json = data
+# CP contains the request parsers for JSON bodies compiled ahead of time.
+CP = {
+    name: CompiledParser(RP[name])
+    for name in ('create_waiver', 'filter_waivers', 'get_waivers_by_subjects_and_testcase')
+}
 
 
 class WaiversResource(Resource):
+    @conditional_get(waiver_watermark, pass_version=True)
     @jsonp
-    def get(self):
+    def get(self, version=None):
         """
         Get waiver records.
 
@@ -225,6 +555,18 @@ class WaiversResource(Resource):
 
         :query int page: The page to get.
         :query int limit: Limit the number of items returned.
+        :query boolean count: If false, matching waivers are not counted,
+            which saves a database query. The response then does not contain
+            the "last" link and the "next" link is present only if there are
+            more waivers. Defaults to true.
+        :query string after: Use keyset pagination and get the page of waivers
+            older than the given cursor. The cursor is opaque and should be
+            taken from the "next" link of a previous response. If empty, the
+            first page is returned. The "page" parameter is ignored and the
+            response does not contain the "last" link.
+        :query string before: Use keyset pagination and get the page of
+            waivers newer than the given cursor taken from the "prev" link of a
+            previous response. It cannot be combined with "after".
         :query string subject_type: Only include waivers for the given subject type.
         :query string subject_identifier: Only include waivers for the given subject identifier.
         :query string testcase: Only include waivers for the given test case name.
@@ -240,11 +582,27 @@ class WaiversResource(Resource):
             by a comma to retrieve a range (e.g. 2017-03-16T13:40:05+00:00,
             2017-03-16T13:40:15+00:00)
         :query boolean include_obsolete: If true, obsolete waivers will be included.
+        :query string fields: Comma-separated list of fields to include in
+            each waiver (e.g. ``subject_type,subject_identifier,testcase``).
+            By default all fields are included.
+        :reqheader If-None-Match: ETag of a previous response for the same URL.
+        :resheader ETag: Changes whenever the response may change.
+        :resheader Last-Modified: Time when waivers were last created.
+        :resheader X-Total-Count-Estimate: Approximate number of matching
+            waivers estimated by the database from table statistics. Only
+            present with ``count=false`` and a PostgreSQL database.
         :statuscode 200: If the query was valid and no problems were encountered.
             Note that the response may still contain 0 waivers.
+        :statuscode 304: No waivers were created since the previous response.
         :statuscode 400: The request was malformed and could not be processed.
         """
         args = RP['get_waivers'].parse_args()
+        if 'after' in args and 'before' in args:
+            raise BadRequest('after argument should not be used together with before argument')
+        return _cached_result(
+            'get_waivers', args, lambda: self._get_waivers(args), watermark=version)
+
+    def _get_waivers(self, args):
         query = Waiver.query.order_by(Waiver.timestamp.desc())
 
         if args['subject_type']:
@@ -270,17 +628,29 @@ class WaiversResource(Resource):
         if not args['include_obsolete']:
             query = _filter_out_obsolete_waivers(query)
 
+        if 'after' in args or 'before' in args:
+            return json_cursor_collection(
+                query, args.get('after'), args.get('before'), args['limit'], args['fields'])
+
         query = query.order_by(Waiver.timestamp.desc())
-        return json_collection(query, args['page'], args['limit'])
+        if args['count']:
+            return json_collection(query, args['page'], args['limit'], args['fields'])
+
+        result = json_collection(query, args['page'], args['limit'], args['fields'], count=False)
+        estimate = estimate_count(query)
+        if estimate is None:
+            return result
+        return result, 200, {'X-Total-Count-Estimate': str(estimate)}
 
     @jsonp
-    @marshal_with(waiver_fields)
     def post(self):
         """
         Create a new waiver or multiple waivers.
 
         To create multiple waivers, pass list of dict instead. Response also
-        contains list on success.
+        contains list on success. All waivers in the list are validated
+        before any of them is stored, and they are stored with a single
+        statement per thousand waivers.
 
         **Sample request**:
 
@@ -340,31 +710,151 @@ class WaiversResource(Resource):
         :json string product_version: The product version string.
         :json string comment: A comment explaining the waiver.
         :json string username: Username on whose behalf the caller is proxying.
+        :reqheader Idempotency-Key: Unique key of the request (up to 255
+            characters). If a request with the same key and body was already
+            successful, the waivers are not created again and the original
+            response is returned.
+        :resheader Idempotent-Replayed: ``true`` if the response is the
+            original response to a request with the same Idempotency-Key.
+        :resheader X-Duplicate-Waivers: Number of waivers which were not
+            created because they are the same as the current waivers (only if
+            the ``DEDUPLICATE_WAIVERS`` option is enabled). The current
+            waivers are returned instead.
+        :reqheader Prefer: ``respond-async`` to create the waivers
+            asynchronously. The request is only validated and the response
+            contains the status URL of the job creating the waivers (see
+            :http:get:`/api/v1.0/jobs/(int:job_id)`).
+        :resheader Location: Status URL of the asynchronous job.
+        :statuscode 200: All waivers are the same as the current waivers and
+            none was created.
         :statuscode 201: The waiver was successfully created.
+        :statuscode 202: The waivers will be created asynchronously.
+        :statuscode 422: The Idempotency-Key was already used for a different
+            request.
         """
 
         user, headers = waiverdb.auth.get_user(request)
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None:
+            if not idempotency_key or len(idempotency_key) > 255:
+                raise BadRequest('Idempotency-Key header must have 1 to 255 characters')
+            request_hash = hashlib.sha256(request.get_data()).hexdigest()
+            replay = self._replay_response(user, idempotency_key, request_hash, headers)
+            if replay is not None:
+                return replay
+
         data = request.get_json(force=True)
 
+        if _prefers_async():
+            if idempotency_key is not None:
+                raise BadRequest('Idempotency-Key header cannot be used with Prefer: respond-async')
+            if isinstance(data, list):
+                all_args = CP['create_waiver'].parse_list(data)
+            else:
+                all_args = [CP['create_waiver'].parse(request.json)]
+            job = WaiverJob(username=user, request=json.dumps(all_args))
+            db.session.add(job)
+            db.session.commit()
+            url = api.url_for(JobResource, job_id=job.id, _external=True)
+            headers = dict(headers, Location=url)
+            return {'id': job.id, 'status': job.status, 'url': url}, 202, headers
+
         if isinstance(data, list):
-            result = []
-            for sub_data in data:
-                sub_request = DummyJsonRequest(sub_data)
-                args = RP['create_waiver'].parse_args(sub_request)
-                one_result = self._create_waiver(args, user)
-                result.append(one_result)
-            db.session.add_all(result)
+            all_args = CP['create_waiver'].parse_list(data)
+            waivers = self._create_waivers(all_args, user)
+            for item in waivers:
+                if isinstance(item, HTTPException):
+                    raise item
+            waivers, new_waivers = self._deduplicate(waivers)
+            bulk_insert_waivers(db.session, new_waivers)
+            db.session.flush()
+            result = [serialize_waiver(waiver) for waiver in waivers]
         else:
-            args = RP['create_waiver'].parse_args()
-            result = self._create_waiver(args, user)
-            db.session.add(result)
-
+            args = CP['create_waiver'].parse(request.json)
+            waiver = self._create_waiver(args, user)
+            (waiver,), new_waivers = self._deduplicate([waiver])
+            if new_waivers and idempotency_key is None and current_app.config['GROUP_COMMIT']:
+                result = get_group_commit().submit(waiver, _commit_waivers)
+                return result, 201, headers
+            db.session.add_all(new_waivers)
+            db.session.flush()
+            result = serialize_waiver(waiver)
+            waivers = [waiver]
+
+        if len(new_waivers) < len(waivers):
+            headers = dict(headers, **{
+                'X-Duplicate-Waivers': str(len(waivers) - len(new_waivers))})
+        if waivers and not new_waivers:
+            # All waivers are duplicates, nothing is stored, so there is
+            # nothing to replay either.
+            db.session.commit()
+            return result, 200, headers
+
+        if idempotency_key is not None:
+            expires = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+            db.session.add(IdempotencyKey(
+                key=idempotency_key, username=user, request_hash=request_hash,
+                response=json.dumps(result), expires=expires))
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # Concurrent request with the same key was committed first.
+                db.session.rollback()
+                replay = self._replay_response(user, idempotency_key, request_hash, headers)
+                if replay is None:
+                    raise
+                return replay
+
+        # Serialized before commit, which would expire the waivers.
         db.session.commit()
 
         return result, 201, headers
 
+    def _deduplicate(self, waivers):
+        """
+        Replaces new waivers duplicating the current ones, if
+        DEDUPLICATE_WAIVERS is enabled.
+
+        Returns the list of waivers for the response and the list of the new
+        waivers to insert.
+        """
+        if not current_app.config['DEDUPLICATE_WAIVERS']:
+            return waivers, waivers
+
+        duplicates = find_duplicate_waivers(db.session, waivers)
+        new_waivers = [
+            waiver for waiver, duplicate in zip(waivers, duplicates) if duplicate is None]
+        waivers = [
+            waiver if duplicate is None else duplicate
+            for waiver, duplicate in zip(waivers, duplicates)
+        ]
+        return waivers, new_waivers
+
+    def _replay_response(self, user, key, request_hash, headers):
+        """
+        Returns the stored response to a request with the same Idempotency-Key
+        or None if there is no such request or the key expired.
+        """
+        stored = IdempotencyKey.query.filter_by(username=user, key=key).first()
+        if stored is None:
+            return None
+
+        if stored.expires <= datetime.datetime.utcnow():
+            db.session.delete(stored)
+            db.session.flush()
+            return None
+
+        if stored.request_hash != request_hash:
+            raise UnprocessableEntity(
+                'Idempotency-Key was already used for a different request')
+
+        headers = dict(headers, **{'Idempotent-Replayed': 'true'})
+        return json.loads(stored.response), 201, headers
+
     def _verify_authorization(self, user, testcase):
-        if not permissions():
+        matcher = permission_matcher()
+        if not matcher.permissions:
             return True
 
         ldap_host = current_app.config.get('LDAP_HOST')
@@ -376,9 +866,91 @@ class WaiversResource(Resource):
                     'LDAP_SEARCH_STRING', '(memberUid={user})'
                 )
                 ldap_searches = [{'BASE': ldap_base, 'SEARCH_STRING': ldap_search_string}]
-        return verify_authorization(user, testcase, permissions(), ldap_host, ldap_searches)
+        return verify_authorization(user, testcase, matcher, ldap_host, ldap_searches)
+
+    def _verify_authorizations(self, pairs):
+        """
+        Verifies authorization of each distinct pair (user, testcase).
 
-    def _create_waiver(self, args, user):
+        Pairs of different users are verified concurrently, since each of
+        them may need to look up groups of the user in LDAP.
+
+        Returns dict mapping the pairs which are not authorized to the
+        HTTPException raised for them.
+        """
+        if not permission_matcher().permissions:
+            return {}
+
+        testcases_by_user = {}
+        for user, testcase in pairs:
+            testcases_by_user.setdefault(user, set()).add(testcase)
+
+        def verify(user, testcases):
+            errors = {}
+            for testcase in sorted(testcases):
+                try:
+                    self._verify_authorization(user, testcase)
+                except HTTPException as e:
+                    errors[(user, testcase)] = e
+            return errors
+
+        if len(testcases_by_user) == 1:
+            return verify(*testcases_by_user.popitem())
+
+        app = current_app._get_current_object()
+
+        def verify_in_app_context(user, testcases):
+            with app.app_context():
+                return verify(user, testcases)
+
+        errors = {}
+        max_workers = min(len(testcases_by_user), current_app.config['LDAP_MAX_WORKERS'])
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(verify_in_app_context, user, testcases)
+                for user, testcases in testcases_by_user.items()
+            ]
+            for future in futures:
+                errors.update(future.result())
+        return errors
+
+    def _create_waivers(self, all_args, user):
+        """
+        Returns list with new Waiver or HTTPException (the reason the waiver
+        cannot be created) for each of the parsed arguments.
+
+        Authorization is verified only once for each distinct effective user
+        and test case.
+        """
+        resultsdb_results = get_resultsdb_results(
+            args['result_id'] for args in all_args if args['result_id'])
+
+        items = []
+        for args in all_args:
+            try:
+                items.append(self._create_waiver(
+                    args, user, resultsdb_results, authorize=False))
+            except HTTPException as e:
+                items.append(e)
+
+        errors = self._verify_authorizations({
+            (item.username, item.testcase) for item in items if isinstance(item, Waiver)})
+        return [
+            errors.get((item.username, item.testcase), item) if isinstance(item, Waiver)
+            else item
+            for item in items
+        ]
+
+    def _create_waiver(self, args, user, resultsdb_results=None, authorize=True):
+        """
+        Returns new Waiver from parsed arguments.
+
+        Optional ``resultsdb_results`` maps result ids to futures of results
+        already being looked up by :func:`get_resultsdb_results`.
+
+        If ``authorize`` is False, the caller is responsible for
+        verifying that the user is allowed to waive the test case.
+        """
         proxied_by = None
         if args.get('username'):
             if user not in current_app.config['SUPERUSERS']:
@@ -391,8 +963,12 @@ class WaiversResource(Resource):
             if args['subject'] or args['testcase'] or args['scenario']:
                 raise BadRequest('result_id argument should not be used together with arguments: '
                                  '"subject", "testcase" or "scenario"')
+            result_id = args.pop('result_id')
             try:
-                result = get_resultsdb_result(args.pop('result_id'))
+                if resultsdb_results and result_id in resultsdb_results:
+                    result = resultsdb_results[result_id].result()
+                else:
+                    result = get_resultsdb_result(result_id)
             except requests.HTTPError as e:
                 if e.response.status_code == 404:
                     raise BadRequest('Result id not found in Resultsdb')
@@ -434,7 +1010,8 @@ class WaiversResource(Resource):
         if not args['testcase']:
             raise BadRequest({'testcase': 'Missing required parameter in the JSON body'})
 
-        self._verify_authorization(user, args['testcase'])
+        if authorize:
+            self._verify_authorization(user, args['testcase'])
 
         # brew-build is an alias for koji_build
         if args['subject_type'] == 'brew-build':
@@ -454,6 +1031,7 @@ class WaiversResource(Resource):
 
 
 class WaiverResource(Resource):
+    @conditional_get(waiver_version)
     @jsonp
     @marshal_with(waiver_fields)
     def get(self, waiver_id):
@@ -462,7 +1040,10 @@ class WaiverResource(Resource):
 
         :param int waiver_id: The waiver's database ID.
 
+        :reqheader If-None-Match: ETag of a previous response for the same URL.
+        :resheader ETag: Identifies the waiver.
         :statuscode 200: The waiver was found and returned.
+        :statuscode 304: The waiver was already retrieved.
         :statuscode 404: No waiver exists with that ID.
         """
         try:
@@ -471,9 +1052,55 @@ class WaiverResource(Resource):
             raise type(NotFound)('Waiver not found')
 
 
+class JobResource(Resource):
+    @jsonp
+    def get(self, job_id):
+        """
+        Get status of waivers submitted asynchronously (see
+        :http:post:`/api/v1.0/waivers/`).
+
+        Items contain result of each waiver once the job is processed: status
+        ``created`` with ``waiver_id`` of the new waiver, ``duplicate`` with
+        ``waiver_id`` of the current waiver (see ``DEDUPLICATE_WAIVERS``
+        option) or ``failed`` with ``error``.
+
+        **Sample response**:
+
+        .. sourcecode:: none
+
+           HTTP/1.1 200 OK
+           Content-Type: application/json
+
+           {
+               "id": 5,
+               "username": "jcline",
+               "status": "done",
+               "created": "2017-03-16T17:42:04.209638",
+               "finished": "2017-03-16T17:42:05.001216",
+               "items": [
+                   {"status": "created", "waiver_id": 15},
+                   {"status": "duplicate", "waiver_id": 12},
+                   {"status": "failed", "error": "Result id not found in Resultsdb"}
+               ],
+               "error": null,
+               "attempts": 0
+           }
+
+        :param int job_id: The job's database ID.
+        :statuscode 200: The job was found and returned. Its status is
+            ``pending``, ``done`` or ``failed`` (with ``error``). A pending
+            job with non-zero ``attempts`` failed because of a server error
+            (reported in ``error``) and will be retried.
+        :statuscode 404: No job exists with that ID.
+        """
+        job = WaiverJob.query.get(job_id)
+        if job is None:
+            raise NotFound('Job not found')
+        return serialize_job(job)
+
+
 class FilteredWaiversResource(Resource):
 
-    @marshal_with(waiver_fields, envelope='data')
     def post(self):
         """
         Get waiver records, filtered by some criteria.
@@ -485,6 +1112,11 @@ class FilteredWaiversResource(Resource):
         Note that the response is not paginated (that is, *all* waivers are
         returned in the 'data' key, even if there is a large number of them).
 
+        For a large number of waivers, request the ``application/x-ndjson``
+        content type with the ``Accept`` header. The response is then
+        streamed as newline-delimited JSON, one waiver object per line,
+        without the 'data' envelope.
+
         **Sample request**:
 
         .. sourcecode:: http
@@ -539,44 +1171,36 @@ class FilteredWaiversResource(Resource):
             within the filter dict are the same as the filtering
             parameters accepted by :http:get:`/api/v1.0/waivers/`.
         :json boolean include_obsolete: If true, obsolete waivers will be included.
+        :json list fields: List of fields to include in each waiver. By
+            default all fields are included.
+        :reqheader Accept: ``application/json`` (default) or
+            ``application/x-ndjson``.
         :statuscode 200: Returns matching waivers, if any.
         :statuscode 400: The request was malformed (invalid filter critera).
         """
-        args = RP['filter_waivers'].parse_args()
+        args = CP['filter_waivers'].parse(request.json)
+        if wants_ndjson():
+            return ndjson_collection(self._filtered_query(args), args['fields'])
+
+        def create():
+            columns, serialize = waiver_projection(args['fields'])
+            query = self._filtered_query(args).with_entities(*columns)
+            return {'data': [serialize(row) for row in query]}
+
+        return _cached_result('filter_waivers', args, create)
+
+    def _filtered_query(self, args):
         query = Waiver.query.order_by(Waiver.timestamp.desc())
-        clauses = []
-        for filter_ in args['filters']:
-            inner_clauses = []
-            if 'subject_type' in filter_:
-                inner_clauses.append(Waiver.subject_type == filter_['subject_type'])
-            if 'subject_identifier' in filter_:
-                inner_clauses.append(Waiver.subject_identifier == filter_['subject_identifier'])
-            if 'testcase' in filter_:
-                inner_clauses.append(Waiver.testcase == filter_['testcase'])
-            if 'scenario' in filter_:
-                inner_clauses.append(Waiver.scenario == filter_['scenario'])
-            if 'product_version' in filter_:
-                inner_clauses.append(Waiver.product_version == filter_['product_version'])
-            if 'username' in filter_:
-                inner_clauses.append(Waiver.username == filter_['username'])
-            if 'proxied_by' in filter_:
-                inner_clauses.append(Waiver.proxied_by == filter_['proxied_by'])
-            if 'since' in filter_:
-                try:
-                    since_start, since_end = reqparse_since(filter_['since'])
-                except ValueError as e:
-                    raise BadRequest({'since': str(e)})
-                if since_start:
-                    inner_clauses.append(Waiver.timestamp >= since_start)
-                if since_end:
-                    inner_clauses.append(Waiver.timestamp <= since_end)
-            clauses.append(and_(*inner_clauses))
-        query = query.filter(or_(*clauses))
+        filters = args['filters']
+        fields = _homogeneous_filter_fields(filters)
+        if fields and value_set_supported(query):
+            rows = [tuple(filter_[field] for field in fields) for filter_ in filters]
+            query = Waiver.by_value_set(query, fields, rows)
+        else:
+            query = _filter_by_clauses(query, filters)
         if not args['include_obsolete']:
-            subquery = db.session.query(func.max(Waiver.id))\
-                .group_by(Waiver.subject_type, Waiver.subject_identifier, Waiver.testcase)
-            query = query.filter(Waiver.id.in_(subquery))
-        return query.all()
+            query = _filter_out_obsolete_waivers_by_subject_and_testcase(query)
+        return query
 
 
 class GetWaiversBySubjectsAndTestcases(Resource):
@@ -627,7 +1251,7 @@ class GetWaiversBySubjectsAndTestcases(Resource):
                 ]
            }
         """
-        args = RP['get_waivers_by_subjects_and_testcase'].parse_args()
+        args = CP['get_waivers_by_subjects_and_testcase'].parse(request.json)
         query = Waiver.query.order_by(Waiver.timestamp.desc())
         if args['results']:
             query = Waiver.by_results(query, args['results'])
@@ -647,7 +1271,8 @@ class GetWaiversBySubjectsAndTestcases(Resource):
             query = _filter_out_obsolete_waivers(query)
 
         query = query.order_by(Waiver.timestamp.desc())
-        return {'data': marshal(query.all(), waiver_fields)}
+        columns, serialize = waiver_projection(args['fields'])
+        return {'data': [serialize(row) for row in query.with_entities(*columns)]}
 
 
 class AboutResource(Resource):
@@ -753,7 +1378,7 @@ class PermissionsResource(Resource):
         args = RP['get_permissions'].parse_args()
         testcase = args['testcase']
         if testcase:
-            return list(match_testcase_permissions(testcase, permissions()))
+            return permission_matcher().match(testcase)
 
         return permissions()
 
@@ -767,6 +1392,7 @@ class MonitorResource(Resource):
 # set up the Api resource routing here
 api.add_resource(WaiversResource, '/waivers/')
 api.add_resource(WaiverResource, '/waivers/<int:waiver_id>')
+api.add_resource(JobResource, '/jobs/<int:job_id>')
 api.add_resource(FilteredWaiversResource, '/waivers/+filtered')
 api.add_resource(GetWaiversBySubjectsAndTestcases, '/waivers/+by-subjects-and-testcases')
 api.add_resource(AboutResource, '/about', strict_slashes=False)
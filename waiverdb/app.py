@@ -14,9 +14,12 @@ from sqlalchemy import event
 from sqlalchemy.exc import ProgrammingError
 import requests
 
-from waiverdb.events import publish_new_waiver
+from waiverdb.cache import configure_caches
+from waiverdb.group_commit import configure_group_commit
+from waiverdb.events import enqueue_new_waivers, invalidate_result_cache, publish_new_waiver
 from waiverdb.logger import init_logging
-from waiverdb.api_v1 import api_v1
+from waiverdb.api_v1 import api_v1, compile_permissions, configure_resultsdb
+from waiverdb.authorization import configure_ldap_connections
 from waiverdb.models import db
 from waiverdb.utils import json_error
 from flask_oidc import OpenIDConnect
@@ -116,6 +119,11 @@ def create_app(config_obj=None):
                                   'migrations')
     Migrate(app, db, directory=migrations_dir)
     # register blueprints
+    configure_caches(app)
+    configure_ldap_connections(app)
+    configure_resultsdb(app)
+    compile_permissions(app)
+    configure_group_commit(app)
     app.register_blueprint(api_v1, url_prefix="/api/v1.0")
     app.add_url_rule('/healthcheck', view_func=healthcheck)
     register_event_handlers(app)
@@ -153,8 +161,12 @@ def register_event_handlers(app):
         app (flask.Flask): The Flask object with the configured scoped session
             attached as the ``session`` attribute.
     """
+    # A workaround for https://github.com/mitsuhiko/flask-sqlalchemy/pull/364
+    # can be removed after python-flask-sqlalchemy is upgraded to 2.2
+    from flask_sqlalchemy import SignallingSession
     if app.config['MESSAGE_BUS_PUBLISH']:
-        # A workaround for https://github.com/mitsuhiko/flask-sqlalchemy/pull/364
-        # can be removed after python-flask-sqlalchemy is upgraded to 2.2
-        from flask_sqlalchemy import SignallingSession
-        event.listen(SignallingSession, 'after_commit', publish_new_waiver)
+        if app.config['MESSAGE_OUTBOX']:
+            event.listen(SignallingSession, 'before_commit', enqueue_new_waivers)
+        else:
+            event.listen(SignallingSession, 'after_commit', publish_new_waiver)
+    event.listen(SignallingSession, 'after_commit', invalidate_result_cache)
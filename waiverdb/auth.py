@@ -2,12 +2,16 @@
 
 
 import base64
+import hashlib
 import os
+import time
 if not os.getenv('DOCS'):   # installing gssapi causing a problem for documentation building
     import gssapi
 from flask import current_app, Response, g
 from werkzeug.exceptions import Unauthorized, Forbidden
 
+from waiverdb.cache import get_cache
+
 
 # Inspired by https://github.com/mkomitee/flask-kerberos/blob/master/flask_kerberos.py
 # Later cleaned and ported to python-gssapi
@@ -39,6 +43,42 @@ def process_gssapi_request(token):
         raise Forbidden("Authentication failed")
 
 
+def validate_oidc_token(token, required_scopes):
+    """
+    Validates the OIDC token and returns its information.
+
+    Information of valid tokens is cached in the ``oidc_token`` cache of the
+    application, keyed by a hash of the token,
+    for at most ``OIDC_TOKEN_CACHE_TTL`` seconds and only until
+    ``OIDC_TOKEN_EXPIRY_MARGIN`` seconds before the token expires, so that a
+    token used by many requests is introspected only once.
+    """
+    cache = get_cache('oidc_token')
+    key = None
+    if cache.maxsize:
+        key = (hashlib.sha256(token.encode('utf-8')).hexdigest(), tuple(required_scopes))
+        token_info = cache.get(key)
+        if token_info is not None:
+            g.oidc_token_info = token_info
+            return token_info
+
+    validity = current_app.oidc.validate_token(token, required_scopes)
+    if validity is not True:
+        raise Unauthorized(validity)
+    token_info = g.oidc_token_info
+
+    if key is None:
+        return token_info
+
+    ttl = current_app.config['OIDC_TOKEN_CACHE_TTL']
+    if 'exp' in token_info:
+        expires_in = token_info['exp'] - time.time()
+        ttl = min(ttl, expires_in - current_app.config['OIDC_TOKEN_EXPIRY_MARGIN'])
+    if ttl > 0:
+        cache.set(key, token_info, ttl=ttl)
+    return token_info
+
+
 def get_user(request):
     user = None
     headers = dict()
@@ -54,10 +94,7 @@ def get_user(request):
             'openid',
             current_app.config['OIDC_REQUIRED_SCOPE'],
         ]
-        validity = current_app.oidc.validate_token(token, required_scopes)
-        if validity is not True:
-            raise Unauthorized(validity)
-        user = g.oidc_token_info['username']
+        user = validate_oidc_token(token, required_scopes)['username']
     elif current_app.config['AUTH_METHOD'] == 'Kerberos':
         if 'Authorization' not in request.headers:
             response = Response('Unauthorized', 401, {'WWW-Authenticate': 'Negotiate'})
@@ -1,23 +1,45 @@
 # SPDX-License-Identifier: GPL-2.0+
 
 import logging
+import os
 import re
-from fnmatch import fnmatch
+import threading
+import time
+from contextlib import contextmanager
+from fnmatch import fnmatch, translate
 
+from flask import current_app
 from werkzeug.exceptions import (
     BadGateway,
     InternalServerError,
+    ServiceUnavailable,
     Unauthorized,
 )
 
+from waiverdb.cache import Cache, get_cache
+import waiverdb.monitor as monitor
+
 log = logging.getLogger(__name__)
 
+DEFAULT_LDAP_SEARCH_STRING = '(memberUid={user})'
+
+# Characters with special meaning in fnmatch patterns
+_WILDCARD = re.compile(r'[*?[]')
+# Constructs which would refer to a wrong group in merged regular expressions
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+class LDAPServerDown(BadGateway):
+    """
+    Raised if the LDAP server is not reachable.
+    """
+
 
 def get_group_membership(ldap, user, con, ldap_search):
     try:
         results = con.search_s(
             ldap_search['BASE'], ldap.SCOPE_SUBTREE,
-            ldap_search.get('SEARCH_STRING', '(memberUid={user})').format(user=user), ['cn']
+            ldap_search.get('SEARCH_STRING', DEFAULT_LDAP_SEARCH_STRING).format(user=user), ['cn']
         )
         return [group[1]['cn'][0].decode('utf-8') for group in results]
     except KeyError:
@@ -25,12 +47,256 @@ def get_group_membership(ldap, user, con, ldap_search):
         raise InternalServerError('LDAP_SEARCHES parameter should contain the BASE key')
     except ldap.SERVER_DOWN:
         log.exception('The LDAP server is not reachable.')
-        raise BadGateway('The LDAP server is not reachable.')
+        raise LDAPServerDown('The LDAP server is not reachable.')
     except ldap.LDAPError:
         log.exception('Some error occurred initializing the LDAP connection.')
         raise Unauthorized('Some error occurred initializing the LDAP connection.')
 
 
+class LDAPConnectionPool(object):
+    """
+    Thread-safe pool of LDAP connections reused by subsequent authorizations
+    in the process, so that a search does not need a new TCP (and TLS)
+    connection. Each application has its own pool (see
+    :func:`configure_ldap_connections`).
+
+    A connection idle for more than ``check_idle`` seconds is checked with a
+    "Who am I?" request before it is reused and it is replaced with a new one
+    if the check fails or if it was idle for more than ``max_idle`` seconds.
+    A connection is closed after any error while it was used, e.g. when the
+    server is down, so the next search reconnects.
+
+    Args:
+        maxsize (int): Maximum number of open connections. If all of them
+            are in use, threads wait for a free one. Zero disables the pool,
+            a new connection is then opened for each use.
+        timeout (float): Seconds to wait for a free connection, and network
+            and operation timeout of the connections.
+        max_idle (float): Seconds after which idle connections are closed.
+        check_idle (float): Seconds after which idle connections are checked
+            before they are reused.
+    """
+    def __init__(self, maxsize=4, timeout=10, max_idle=300, check_idle=30):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self._condition = threading.Condition()
+        # Tuples (connection, host, time when it was released)
+        self._idle = []
+        # Number of open connections, including the ones in use
+        self._size = 0
+        self._pid = os.getpid()
+
+    def configure(self, maxsize, timeout, max_idle, check_idle):
+        with self._condition:
+            self.maxsize = maxsize
+            self.timeout = timeout
+            self.max_idle = max_idle
+            self.check_idle = check_idle
+            self._close_idle()
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Closes idle connections.
+        """
+        with self._condition:
+            self._close_idle()
+
+    @contextmanager
+    def connection(self, ldap, ldap_host):
+        """
+        Yields an LDAP connection to the host, returned to the pool when done
+        or closed if an error is raised.
+        """
+        con = self.acquire(ldap, ldap_host)
+        try:
+            yield con
+        except BaseException:
+            self.release(con, ldap_host, reuse=False)
+            raise
+        self.release(con, ldap_host)
+
+    def acquire(self, ldap, ldap_host, fresh=False):
+        """
+        Returns an LDAP connection to the host, which must be passed to
+        :meth:`release` when done.
+
+        If ``fresh`` is True, a new connection is opened and idle connections
+        to the host are closed, e.g. because the server was restarted.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            stale = []
+            try:
+                with self._condition:
+                    self._check_pid()
+                    con, released = self._take(ldap_host, deadline, fresh, stale)
+            finally:
+                self._close(stale)
+            if con is None:
+                break
+            if time.monotonic() - released <= self.check_idle or self._is_alive(ldap, con):
+                return con
+            self.release(con, ldap_host, reuse=False)
+
+        try:
+            return self._connect(ldap, ldap_host)
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, con, ldap_host, reuse=True):
+        """
+        Returns the connection to the pool, or closes it if ``reuse`` is
+        False, e.g. after an error.
+        """
+        with self._condition:
+            if self._pid != os.getpid():
+                return
+            if reuse and self.maxsize:
+                self._idle.append((con, ldap_host, time.monotonic()))
+                con = None
+            else:
+                self._size -= 1
+            self._condition.notify()
+        if con is not None:
+            self._close([con])
+
+    def _take(self, ldap_host, deadline, fresh, stale):
+        """
+        Returns an idle connection to the host with the time when it was
+        released, or (None, None) if a slot for a new connection was
+        reserved. Connections to close are appended to ``stale``.
+        """
+        now = time.monotonic()
+        while self._idle and self._idle[0][2] + self.max_idle < now:
+            self._discard_idle(0, stale)
+        if fresh:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][1] == ldap_host:
+                    self._discard_idle(i, stale)
+
+        while True:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][1] == ldap_host:
+                    con, _, released = self._idle.pop(i)
+                    return con, released
+
+            # Without the pool, the number of connections is not limited.
+            if not self.maxsize or self._size < self.maxsize:
+                self._size += 1
+                return None, None
+
+            if self._idle:
+                # Make room for a connection to a different host.
+                self._discard_idle(0, stale)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ServiceUnavailable('No LDAP connection is available.')
+            self._condition.wait(remaining)
+
+    def _discard_idle(self, index, stale):
+        stale.append(self._idle.pop(index)[0])
+        self._size -= 1
+
+    def _connect(self, ldap, ldap_host):
+        monitor.ldap_connect_counter.inc()
+        try:
+            con = ldap.initialize(ldap_host)
+            con.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+            con.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        except ldap.LDAPError:
+            log.exception('Some error occurred initializing the LDAP connection.')
+            raise Unauthorized('Some error occurred initializing the LDAP connection.')
+        return con
+
+    def _is_alive(self, ldap, con):
+        try:
+            con.whoami_s()
+        except ldap.LDAPError:
+            log.warning('Reconnecting to LDAP server', exc_info=True)
+            return False
+        return True
+
+    def _close(self, connections):
+        for con in connections:
+            try:
+                con.unbind_s()
+            except Exception:
+                log.warning('Failed to close LDAP connection', exc_info=True)
+
+    def _close_idle(self):
+        stale = [con for con, _, _ in self._idle]
+        self._idle = []
+        self._size -= len(stale)
+        self._close(stale)
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Connections inherited from parent process belong to the parent.
+            self._idle = []
+            self._size = 0
+            self._pid = os.getpid()
+
+
+def configure_ldap_connections(app):
+    """
+    Creates the pool of LDAP connections of the application.
+    """
+    app.extensions['waiverdb_ldap_connections'] = LDAPConnectionPool(
+        app.config['LDAP_POOL_SIZE'], app.config['LDAP_TIMEOUT'],
+        app.config['LDAP_POOL_MAX_IDLE'], app.config['LDAP_POOL_CHECK_IDLE'])
+
+
+def get_ldap_connections():
+    """
+    Returns the pool of LDAP connections of the current application.
+    """
+    return current_app.extensions['waiverdb_ldap_connections']
+
+
+def get_cached_group_membership(ldap, user, connect, ldap_host, ldap_search):
+    """
+    Returns groups of the user found by the LDAP search, cached in the
+    ``ldap_membership`` cache of the application.
+
+    Function ``connect`` is called to get the LDAP connection only if the
+    search is not cached. If the server is not reachable, the search is
+    retried once on a new connection returned by ``connect(fresh=True)``.
+    Searches finding no groups are cached for ``LDAP_CACHE_NEGATIVE_TTL``
+    seconds.
+    """
+    key = (
+        ldap_host,
+        user,
+        ldap_search.get('BASE'),
+        ldap_search.get('SEARCH_STRING', DEFAULT_LDAP_SEARCH_STRING),
+    )
+    cache = get_cache('ldap_membership')
+    groups = cache.get(key)
+    if groups is None:
+        try:
+            groups = _search_group_membership(ldap, user, connect(), ldap_search)
+        except LDAPServerDown:
+            # The server may have closed the connection, e.g. after restart.
+            log.warning('Retrying LDAP search on a new connection')
+            groups = _search_group_membership(ldap, user, connect(fresh=True), ldap_search)
+        ttl = None if groups else current_app.config['LDAP_CACHE_NEGATIVE_TTL']
+        cache.set(key, groups, ttl=ttl)
+    return groups
+
+
+def _search_group_membership(ldap, user, con, ldap_search):
+    with monitor.ldap_search_latency.time():
+        return tuple(get_group_membership(ldap, user, con, ldap_search))
+
+
 def match_testcase_permissions(testcase, permissions):
     for permission in permissions:
         if "testcases" in permission:
@@ -48,13 +314,132 @@ def match_testcase_permissions(testcase, permissions):
             yield permission
 
 
+class PermissionMatcher(object):
+    """
+    Permissions compiled for finding the ones matching a test case, same as
+    :func:`match_testcase_permissions` but without checking each of them:
+
+    * ``testcases`` patterns without wildcards are looked up in a dict,
+    * other ``testcases`` patterns are stored in a trie under their literal
+      prefix (up to the first wildcard), so only patterns with a prefix of
+      the test case are checked, and patterns like ``prefix*`` need no
+      further check,
+    * regular expressions from deprecated ``PERMISSION_MAPPING`` are merged
+      into one which rules out test cases matching none of them at once.
+
+    Permissions matching recently looked up test cases are cached.
+
+    Args:
+        permissions (list): Permissions in the ``PERMISSIONS`` format.
+        cache_size (int): Maximum number of cached test cases. Zero disables
+            the cache.
+    """
+    def __init__(self, permissions, cache_size=1024):
+        self.permissions = permissions
+        self._exact = {}
+        self._trie = {}
+        # Tuples (permission index, compiled regular expression)
+        self._merged_regexes = []
+        self._other_regexes = []
+        self._merged_regex = None
+        self._cache = Cache('permission_match', cache_size, ttl=float('inf'))
+
+        for index, permission in enumerate(permissions):
+            if "testcases" in permission:
+                for pattern in permission["testcases"]:
+                    self._add_testcase_pattern(index, pattern)
+            elif "_testcase_regex_pattern" in permission:
+                pattern = permission["_testcase_regex_pattern"]
+                regexes = (
+                    self._other_regexes if _GROUP_REFERENCE.search(pattern)
+                    else self._merged_regexes
+                )
+                regexes.append((index, re.compile(pattern)))
+
+        if self._merged_regexes:
+            try:
+                self._merged_regex = re.compile('|'.join(
+                    '(?:{})'.format(regex.pattern) for _, regex in self._merged_regexes))
+            except re.error:
+                # E.g. the same group name or global flags in more patterns
+                self._other_regexes += self._merged_regexes
+                self._merged_regexes = []
+
+    def _add_testcase_pattern(self, index, pattern):
+        wildcard = _WILDCARD.search(pattern)
+        if wildcard is None:
+            self._exact.setdefault(pattern, []).append(index)
+            return
+
+        prefix = pattern[:wildcard.start()]
+        node = self._trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+
+        if pattern[wildcard.start():] == '*':
+            regex = None
+        else:
+            regex = re.compile(translate(pattern))
+        # Empty key cannot clash with characters of the test case.
+        node.setdefault('', []).append((index, regex))
+
+    def match(self, testcase):
+        """
+        Returns the list of permissions matching the test case, in the
+        configured order.
+        """
+        matching = self._cache.get(testcase)
+        if matching is None:
+            indexes = self._match_indexes(testcase)
+            matching = [self.permissions[index] for index in sorted(indexes)]
+            self._cache.set(testcase, matching)
+        return matching
+
+    def _match_indexes(self, testcase):
+        indexes = set(self._exact.get(testcase, ()))
+
+        node = self._trie
+        depth = 0
+        while node is not None:
+            for index, regex in node.get('', ()):
+                if regex is None or regex.match(testcase):
+                    indexes.add(index)
+            if depth == len(testcase):
+                break
+            node = node.get(testcase[depth])
+            depth += 1
+
+        if self._merged_regex is not None and self._merged_regex.search(testcase):
+            for index, regex in self._merged_regexes:
+                if regex.search(testcase):
+                    indexes.add(index)
+
+        for index, regex in self._other_regexes:
+            if regex.search(testcase):
+                indexes.add(index)
+
+        return indexes
+
+
 def verify_authorization(user, testcase, permissions, ldap_host, ldap_searches):
+    """
+    Returns True if the user is allowed to waive the test case, otherwise
+    raises Unauthorized.
+
+    Argument ``permissions`` is either a list of permissions or
+    :class:`PermissionMatcher`.
+    """
     if not (ldap_host and ldap_searches):
         raise InternalServerError(('LDAP_HOST and LDAP_SEARCHES also need to be defined '
                                    'if PERMISSIONS is defined.'))
 
+    if isinstance(permissions, PermissionMatcher):
+        matching_permissions = permissions.match(testcase)
+    else:
+        matching_permissions = match_testcase_permissions(testcase, permissions)
+
     allowed_groups = []
-    for permission in match_testcase_permissions(testcase, permissions):
+    for permission in matching_permissions:
         if user in permission.get('users', []):
             return True
         allowed_groups += permission.get('groups', [])
@@ -65,19 +450,37 @@ def verify_authorization(user, testcase, permissions, ldap_host, ldap_searches):
         raise InternalServerError(('If PERMISSIONS is defined, '
                                    'python-ldap needs to be installed.'))
 
-    try:
-        con = ldap.initialize(ldap_host)
-    except ldap.LDAPError:
-        log.exception('Some error occurred initializing the LDAP connection.')
-        raise Unauthorized('Some error occurred initializing the LDAP connection.')
+    pool = get_ldap_connections()
+    con = None
+
+    def connect(fresh=False):
+        nonlocal con
+        if con is not None and fresh:
+            # Close the failed connection instead of returning it to the pool.
+            pool.release(con, ldap_host, reuse=False)
+            con = None
+        if con is None:
+            con = pool.acquire(ldap, ldap_host, fresh=fresh)
+        return con
+
+    allowed_groups = set(allowed_groups)
     group_membership = set()
+    try:
+        for cur_ldap_search in ldap_searches:
+            group_membership.update(
+                get_cached_group_membership(ldap, user, connect, ldap_host, cur_ldap_search)
+            )
+            if group_membership & allowed_groups:
+                break
+    except BaseException:
+        if con is not None:
+            pool.release(con, ldap_host, reuse=False)
+        raise
+    if con is not None:
+        pool.release(con, ldap_host)
 
-    for cur_ldap_search in ldap_searches:
-        group_membership.update(
-            get_group_membership(ldap, user, con, cur_ldap_search)
-        )
-        if group_membership & set(allowed_groups):
-            return True
+    if group_membership & allowed_groups:
+        return True
 
     if not group_membership:
         raise Unauthorized(f'Couldn\'t find user {user} in LDAP')
@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Simple per-process caches.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+import waiverdb.monitor as monitor
+
+
+class Cache(object):
+    """
+    Thread-safe bounded LRU cache with expiring items.
+
+    Hits, misses and evictions are counted in :mod:`waiverdb.monitor` with
+    the ``cache`` label set to ``name``.
+
+    Args:
+        name (str): Name of the cache used in metrics.
+        maxsize (int): Maximum number of items. Zero disables the cache.
+        ttl (float): Number of seconds after which items expire.
+        maxweight (int): Maximum total weight of items (see :meth:`set`),
+            None for no limit.
+    """
+    def __init__(self, name, maxsize=128, ttl=300, maxweight=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self._items = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, ttl):
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._items.clear()
+            self._weight = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value or ``default`` if the key is not cached or
+        the value expired.
+        """
+        if not self.maxsize:
+            return default
+
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires, value, _ = item
+                if expires > now:
+                    self._items.move_to_end(key)
+                    monitor.cache_hit_counter.labels(self.name).inc()
+                    return value
+                self._remove(key)
+                monitor.cache_eviction_counter.labels(self.name).inc()
+
+        monitor.cache_miss_counter.labels(self.name).inc()
+        return default
+
+    def set(self, key, value, ttl=None, weight=1):
+        """
+        Caches the value, evicting the least recently used values if the
+        cache is full.
+
+        Optional ``ttl`` overrides the default expiration for the value.
+        Optional ``weight`` is the size of the value counted towards
+        ``maxweight``. Values heavier than ``maxweight`` are not cached.
+        """
+        if not self.maxsize:
+            return
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (expires, value, weight)
+            self._weight += weight
+            while len(self._items) > self.maxsize or (
+                    self.maxweight is not None and self._weight > self.maxweight):
+                self._remove(next(iter(self._items)))
+                monitor.cache_eviction_counter.labels(self.name).inc()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._weight = 0
+
+    def _remove(self, key):
+        _, _, weight = self._items.pop(key)
+        self._weight -= weight
+
+    def __len__(self):
+        return len(self._items)
+
+
+# Caches created for each application by configure_caches(), mapped to the
+# options with their maximum size and TTL.
+APP_CACHES = {
+    # Results of waiver queries. Keys contain the waiver watermark, so values
+    # cached in other processes never outlive a new waiver.
+    'query_result': ('RESULT_CACHE_SIZE', 'RESULT_CACHE_TTL'),
+    # Results looked up in ResultsDB by id. Keys contain the ResultsDB API URL.
+    'resultsdb_result': ('RESULTSDB_CACHE_SIZE', 'RESULTSDB_CACHE_TTL'),
+    # Groups of users found by each of LDAP_SEARCHES. Keys contain the LDAP
+    # host.
+    'ldap_membership': ('LDAP_CACHE_SIZE', 'LDAP_CACHE_TTL'),
+    # Information of valid OIDC tokens. Keys contain a hash of the token.
+    'oidc_token': ('OIDC_TOKEN_CACHE_SIZE', 'OIDC_TOKEN_CACHE_TTL'),
+}
+
+
+# Options with the maximum total weight of the values of some APP_CACHES.
+APP_CACHE_WEIGHTS = {
+    # Weight of a result is the number of waivers in it.
+    'query_result': 'RESULT_CACHE_MAX_WAIVERS',
+}
+
+
+def configure_caches(app):
+    """
+    Creates caches of the application, configured by its options.
+    """
+    app.extensions['waiverdb_caches'] = {
+        name: Cache(name, app.config[size_option], app.config[ttl_option],
+                    app.config[APP_CACHE_WEIGHTS[name]] if name in APP_CACHE_WEIGHTS else None)
+        for name, (size_option, ttl_option) in APP_CACHES.items()
+    }
+
+
+def get_cache(name):
+    """
+    Returns cache of the current application (see :data:`APP_CACHES`).
+    """
+    return current_app.extensions['waiverdb_caches'][name]
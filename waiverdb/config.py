@@ -26,12 +26,77 @@ class Config(object):
     MESSAGE_BUS_PUBLISH = True
     # Specify fedmsg or stomp for publishing messages
     MESSAGE_PUBLISHER = 'fedmsg'
+    # Set this to True to store messages in the database in the same
+    # transaction as new waivers instead of publishing them after commit.
+    # The messages are published by "waiverdb dispatch-messages".
+    MESSAGE_OUTBOX = False
     SQLALCHEMY_TRACK_MODIFICATIONS = True
     # A list of users are allowed to create waivers on behalf of other users.
     SUPERUSERS = []
     PERMISSIONS = []
     # Deprecated permission mapping
     PERMISSION_MAPPING = {}
+    # Maximum number of test cases with cached matching permissions per process
+    # (zero disables the cache).
+    PERMISSION_CACHE_SIZE = 4096
+    # Per-process cache for results of GET /waivers/ and POST /waivers/+filtered.
+    # Maximum number of cached results (zero disables the cache), seconds
+    # after which they expire, and maximum number of waivers in all cached
+    # results (larger results are not cached).
+    RESULT_CACHE_SIZE = 128
+    RESULT_CACHE_TTL = 300
+    RESULT_CACHE_MAX_WAIVERS = 10000
+    # Lookups of results in ResultsDB for waivers created with result_id:
+    # maximum number of concurrent lookups (and pooled connections), number of
+    # retries of failed requests, and caching of the results.
+    RESULTSDB_MAX_WORKERS = 10
+    RESULTSDB_RETRIES = 3
+    RESULTSDB_CACHE_SIZE = 1024
+    RESULTSDB_CACHE_TTL = 300
+    # Seconds for which a request creating waivers with an Idempotency-Key
+    # header can be retried without creating the waivers again.
+    IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+    # Number of attempts to process an asynchronous waiver job failing with a
+    # server error (e.g. ResultsDB or LDAP is not reachable) before the job
+    # fails, and seconds to wait before the first retry (doubled after each
+    # further attempt).
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_DELAY = 60
+    # Set this to True to return the current waiver instead of creating a new
+    # one if they differ only in the timestamp.
+    DEDUPLICATE_WAIVERS = False
+    # Set this to True to store single waivers created by concurrent requests
+    # (threads of a server process) in a single transaction. The first request
+    # waits up to GROUP_COMMIT_WINDOW seconds for at most GROUP_COMMIT_MAX_SIZE
+    # waivers.
+    GROUP_COMMIT = False
+    GROUP_COMMIT_WINDOW = 0.005
+    GROUP_COMMIT_MAX_SIZE = 100
+    # Per-process cache for groups of users found in LDAP. Maximum number of
+    # cached searches (zero disables the cache), seconds after which they
+    # expire, and seconds after which searches finding no group expire.
+    LDAP_CACHE_SIZE = 1024
+    LDAP_CACHE_TTL = 300
+    LDAP_CACHE_NEGATIVE_TTL = 60
+    # Per-process pool of LDAP connections reused for authorization. Maximum
+    # number of open connections (zero disables the pool), seconds to wait for
+    # a free connection (also used as LDAP network and operation timeout),
+    # seconds after which idle connections are closed, and seconds after which
+    # idle connections are checked before they are reused.
+    LDAP_POOL_SIZE = 4
+    LDAP_TIMEOUT = 10
+    LDAP_POOL_MAX_IDLE = 300
+    LDAP_POOL_CHECK_IDLE = 30
+    # Maximum number of users whose authorization is verified concurrently when
+    # creating multiple waivers at once.
+    LDAP_MAX_WORKERS = 4
+    # Per-process cache for valid OIDC tokens, so that a token used by many
+    # requests is introspected only once. Maximum number of cached tokens (zero
+    # disables the cache), seconds after which they expire, and seconds before
+    # the expiration of the token itself after which it is validated again.
+    OIDC_TOKEN_CACHE_SIZE = 1024
+    OIDC_TOKEN_CACHE_TTL = 300
+    OIDC_TOKEN_EXPIRY_MARGIN = 30
 
 
 class ProductionConfig(Config):
@@ -66,5 +131,8 @@ class TestingConfig(Config):
     OIDC_REQUIRED_SCOPE = 'waiverdb_scope'
     OIDC_RESOURCE_SERVER_ONLY = True
     SUPERUSERS = ['bodhi']
+    LDAP_CACHE_SIZE = 0
+    LDAP_POOL_SIZE = 0
+    OIDC_TOKEN_CACHE_SIZE = 0
 
     CORS_ORIGINS = 'https://bodhi.fedoraproject.org'
@@ -9,10 +9,11 @@ using the :func:`sqlalchemy.event.listen` function.
     https://docs.sqlalchemy.org/en/latest/orm/events.html
 """
 
+import datetime
 import logging
 import time
+from contextlib import contextmanager
 
-from flask_restful import marshal
 import stomp
 import json
 import waiverdb.monitor as monitor
@@ -20,25 +21,26 @@ import waiverdb.monitor as monitor
 from fedora_messaging.api import Message, publish
 from fedora_messaging.exceptions import PublishReturned, ConnectionException
 from flask import current_app
-from waiverdb.fields import waiver_fields
-from waiverdb.models import Waiver
+from waiverdb.cache import get_cache
+from waiverdb.fields import serialize_waiver
+from waiverdb.models import OutboxMessage
+from waiverdb.models.waivers import pop_new_waivers, waivers_inserted
 from waiverdb.utils import stomp_connection
 
 _log = logging.getLogger(__name__)
 
 MAX_STOMP_RETRY = 3
 STOMP_RETRY_DELAY_SECONDS = 5
+FEDMSG_TOPIC = 'waiverdb.waiver.new'
 
 
-def _send_stomp_message(session):
+def _send_stomp_message(bodies):
     with stomp_connection() as conn:
         stomp_configs = current_app.config.get('STOMP_CONFIGS')
-        for row in session.identity_map.values():
+        for body in bodies:
             monitor.messaging_tx_to_send_counter.inc()
-            if not isinstance(row, Waiver):
-                continue
-            _log.debug('Publishing a message for %r', row)
-            msg = json.dumps(marshal(row, waiver_fields))
+            _log.debug('Publishing a message for waiver %r', body['id'])
+            msg = json.dumps(body)
             kwargs = dict(body=msg, headers={}, destination=stomp_configs['destination'])
             if stomp.__version__[0] < 4:
                 kwargs['message'] = kwargs.pop('body')  # On EL7, different sig.
@@ -51,11 +53,11 @@ def _send_stomp_message(session):
                 raise
 
 
-def _send_stomp_message_with_retry(session, max_retry, retry_delay):
+def _send_stomp_message_with_retry(bodies, max_retry, retry_delay):
     for i in range(max_retry):
         time.sleep(i * retry_delay)
         try:
-            _send_stomp_message(session)
+            _send_stomp_message(bodies)
         except stomp.exception.StompException:
             _log.exception('Failed to send message (try %s/%s)', i + 1, max_retry)
         else:
@@ -101,21 +103,25 @@ def publish_new_waiver(session):
     _log.debug('The publish_new_waiver SQLAlchemy event has been activated (%r)',
                current_app.config['MESSAGE_PUBLISHER'])
 
+    # Only waivers inserted in the committed transaction are published, not
+    # every waiver loaded in the session.
+    bodies = [serialize_waiver(waiver) for waiver in pop_new_waivers(session)]
+    if not bodies:
+        return
+
     if current_app.config['MESSAGE_PUBLISHER'] == 'stomp':
         max_retry = current_app.config.get('MAX_STOMP_RETRY', MAX_STOMP_RETRY)
         retry_delay = current_app.config.get('STOMP_RETRY_DELAY_SECONDS', STOMP_RETRY_DELAY_SECONDS)
-        _send_stomp_message_with_retry(session, max_retry=max_retry, retry_delay=retry_delay)
+        _send_stomp_message_with_retry(bodies, max_retry=max_retry, retry_delay=retry_delay)
 
     elif current_app.config['MESSAGE_PUBLISHER'] == 'fedmsg':
-        for row in session.identity_map.values():
+        for body in bodies:
             monitor.messaging_tx_to_send_counter.inc()
-            if not isinstance(row, Waiver):
-                continue
-            _log.debug('Publishing a message for %r', row)
+            _log.debug('Publishing a message for waiver %r', body['id'])
             try:
                 msg = Message(
-                    topic='waiverdb.waiver.new',
-                    body=marshal(row, waiver_fields)
+                    topic=FEDMSG_TOPIC,
+                    body=body
                 )
                 publish(msg)
                 monitor.messaging_tx_sent_ok_counter.inc()
@@ -134,3 +140,135 @@ def publish_new_waiver(session):
     else:
         _log.warning('Unhandled MESSAGE_PUBLISHER %r', current_app.config['MESSAGE_PUBLISHER'])
         monitor.messaging_tx_failed_counter.inc()
+
+
+def invalidate_result_cache(session):
+    """
+    A post-commit event hook that drops cached query results in this process
+    if the transaction inserted waivers, because they may have changed them.
+
+    This event is designed to be registered with a session factory::
+
+        >>> from sqlalchemy.event import listen
+        >>> listen(MyScopedSession, 'after_commit', invalidate_result_cache)
+
+    Args:
+        session (sqlalchemy.orm.Session): The session that was committed to the
+            database.
+    """
+    if waivers_inserted(session):
+        get_cache('query_result').clear()
+
+
+def enqueue_new_waivers(session):
+    """
+    A pre-commit event hook that stores a message for each new waiver in the
+    outbox, in the same transaction as the waivers. The messages are
+    published later by :func:`dispatch_outbox_messages`, so the request does
+    not wait for the message bus and no message is lost if the process dies
+    after commit.
+
+    This event is designed to be registered with a session factory::
+
+        >>> from sqlalchemy.event import listen
+        >>> listen(MyScopedSession, 'before_commit', enqueue_new_waivers)
+
+    Args:
+        session (sqlalchemy.orm.Session): The session that is being committed.
+    """
+    # Pending waivers are otherwise flushed only after this hook.
+    session.flush()
+    waivers = pop_new_waivers(session)
+    if waivers:
+        session.execute(OutboxMessage.__table__.insert(), [
+            {'body': json.dumps(serialize_waiver(waiver))} for waiver in waivers
+        ])
+
+
+@contextmanager
+def _message_sender():
+    """
+    Yields a function which publishes a message body using the configured
+    MESSAGE_PUBLISHER.
+    """
+    publisher = current_app.config['MESSAGE_PUBLISHER']
+    if publisher == 'stomp':
+        with stomp_connection() as conn:
+            destination = current_app.config['STOMP_CONFIGS']['destination']
+
+            def send(body):
+                kwargs = dict(body=json.dumps(body), headers={}, destination=destination)
+                if stomp.__version__[0] < 4:
+                    kwargs['message'] = kwargs.pop('body')  # On EL7, different sig.
+                conn.send(**kwargs)
+
+            yield send
+
+    elif publisher == 'fedmsg':
+        yield lambda body: publish(Message(topic=FEDMSG_TOPIC, body=body))
+
+    else:
+        raise RuntimeError('Unhandled MESSAGE_PUBLISHER %r' % publisher)
+
+
+def dispatch_outbox_messages(session, batch_size):
+    """
+    Publishes a batch of the oldest unpublished messages from the outbox and
+    marks them as sent.
+
+    Publishing stops at the first failure, which is recorded in the failed
+    message, so the remaining messages are retried later in the same order.
+    Concurrent dispatchers skip messages locked by each other (PostgreSQL
+    only).
+
+    Args:
+        session (sqlalchemy.orm.Session): Session used to read and update
+            the outbox. It is committed.
+        batch_size (int): Maximum number of messages to publish.
+
+    Returns:
+        Number of published messages.
+    """
+    messages = session.query(OutboxMessage)\
+        .filter(OutboxMessage.sent.is_(None))\
+        .order_by(OutboxMessage.id)\
+        .limit(batch_size)\
+        .with_for_update(skip_locked=True)\
+        .all()
+
+    sent = 0
+    message = None
+    try:
+        if messages:
+            with _message_sender() as send:
+                for message in messages:
+                    monitor.messaging_tx_to_send_counter.inc()
+                    message.attempts += 1
+                    send(json.loads(message.body))
+                    message.sent = datetime.datetime.utcnow()
+                    message.error = None
+                    monitor.messaging_tx_sent_ok_counter.inc()
+                    sent += 1
+    except Exception as e:
+        _log.exception('Failed to publish message %r from outbox', message)
+        monitor.messaging_tx_failed_counter.inc()
+        if message is not None and message.sent is None:
+            message.error = str(e)
+
+    session.commit()
+    return sent
+
+
+def purge_outbox_messages(session, sent_before):
+    """
+    Deletes messages from the outbox which were published before the given
+    time.
+
+    Returns:
+        Number of deleted messages.
+    """
+    count = session.query(OutboxMessage)\
+        .filter(OutboxMessage.sent < sent_before)\
+        .delete(synchronize_session=False)
+    session.commit()
+    return count
@@ -1,8 +1,12 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import json
+from operator import attrgetter
+
 from flask_restful import fields
+from sqlalchemy.engine import Row
 
-from waiverdb.models.waivers import subject_type_identifier_to_dict
+from waiverdb.models.waivers import Waiver, subject_type_identifier_to_dict
 
 
 class BackwardsCompatibleSubjectField(fields.Raw):
@@ -26,3 +30,145 @@ waiver_fields = {
     'comment': fields.String,
     'timestamp': fields.DateTime(dt_format='iso8601'),
 }
+
+# Columns needed by serialize_waiver(). Selecting these instead of the Waiver
+# entity avoids building ORM objects for rows which are only serialized.
+waiver_columns = (
+    Waiver.id,
+    Waiver.subject_type,
+    Waiver.subject_identifier,
+    Waiver.testcase,
+    Waiver.username,
+    Waiver.scenario,
+    Waiver.proxied_by,
+    Waiver.product_version,
+    Waiver.waived,
+    Waiver.comment,
+    Waiver.timestamp,
+)
+
+_waiver_attributes = attrgetter(*(column.key for column in waiver_columns))
+
+
+def serialize_waiver(waiver):
+    """
+    Returns the same output as ``marshal(waiver, waiver_fields)``, only much
+    faster.
+
+    Accepts a Waiver object or a row selected with ``waiver_columns``.
+    """
+    # Unpacking is much cheaper than attribute lookup on rows.
+    values = waiver if isinstance(waiver, Row) else _waiver_attributes(waiver)
+    (waiver_id, subject_type, subject_identifier, testcase, username, scenario, proxied_by,
+     product_version, waived, comment, timestamp) = values
+    return {
+        'id': 0 if waiver_id is None else waiver_id,
+        'subject_type': subject_type,
+        'subject_identifier': subject_identifier,
+        'subject': subject_type_identifier_to_dict(subject_type, subject_identifier),
+        'testcase': testcase,
+        'username': username,
+        'scenario': scenario,
+        'proxied_by': proxied_by,
+        'product_version': product_version,
+        'waived': None if waived is None else bool(waived),
+        'comment': comment,
+        'timestamp': None if timestamp is None else timestamp.isoformat(),
+    }
+
+
+def _optional(convert):
+    return lambda value: None if value is None else convert(value)
+
+
+def _identity(value):
+    return value
+
+
+# Columns and conversion of their values for each field in waiver_fields.
+_field_sources = {
+    'id': ((Waiver.id,), lambda value: 0 if value is None else value),
+    'subject_type': ((Waiver.subject_type,), _identity),
+    'subject_identifier': ((Waiver.subject_identifier,), _identity),
+    'subject': ((Waiver.subject_type, Waiver.subject_identifier),
+                subject_type_identifier_to_dict),
+    'testcase': ((Waiver.testcase,), _identity),
+    'username': ((Waiver.username,), _identity),
+    'scenario': ((Waiver.scenario,), _identity),
+    'proxied_by': ((Waiver.proxied_by,), _identity),
+    'product_version': ((Waiver.product_version,), _identity),
+    'waived': ((Waiver.waived,), _optional(bool)),
+    'comment': ((Waiver.comment,), _identity),
+    'timestamp': ((Waiver.timestamp,), _optional(lambda value: value.isoformat())),
+}
+
+
+def valid_field_names(value):
+    """
+    Parses the 'fields' parameter, which is either a comma-separated string
+    or a list of field names in waiver_fields.
+
+    Returns list of unique field names or None if all fields are requested.
+    """
+    if isinstance(value, str):
+        names = [name.strip() for name in value.split(',') if name.strip()]
+    elif isinstance(value, list) and all(isinstance(name, str) for name in value):
+        names = value
+    else:
+        raise ValueError('Must be a list of field names or a comma-separated string')
+
+    unknown = [name for name in names if name not in waiver_fields]
+    if unknown:
+        raise ValueError('Unknown fields: {}; choose from: {}'.format(
+            ', '.join(unknown), ', '.join(waiver_fields)))
+
+    return list(dict.fromkeys(names)) or None
+
+
+def waiver_projection(names=None):
+    """
+    Returns a tuple (columns, serialize) for serializing only the given
+    fields of waivers. The function serialize() accepts rows starting with
+    the columns and returns a dict with the given fields.
+
+    If ``names`` is None, all fields are serialized with serialize_waiver().
+    """
+    if names is None:
+        return waiver_columns, serialize_waiver
+
+    columns = []
+    keys = []
+    getters = []
+    for name in names:
+        field_columns, convert = _field_sources[name]
+        indexes = []
+        for column in field_columns:
+            if column.key not in keys:
+                columns.append(column)
+                keys.append(column.key)
+            indexes.append(keys.index(column.key))
+        getters.append((name, indexes, convert))
+
+    def serialize(row):
+        return {
+            name: convert(*(row[index] for index in indexes))
+            for name, indexes, convert in getters
+        }
+
+    return tuple(columns), serialize
+
+
+def serialize_job(job):
+    """
+    Returns status of a WaiverJob with result of each waiver once processed.
+    """
+    return {
+        'id': job.id,
+        'username': job.username,
+        'status': job.status,
+        'created': job.created.isoformat(),
+        'finished': None if job.finished is None else job.finished.isoformat(),
+        'items': None if job.result is None else json.loads(job.result),
+        'error': job.error,
+        'attempts': job.attempts,
+    }
@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Group commit of new waivers from concurrent requests.
+
+The first request submitting a waiver becomes the leader of a new group. It
+waits for a short window while other requests (threads of the same process)
+add their waivers to the group, then stores all of them in its own
+transaction. The other requests wait for the result of the commit.
+"""
+
+import threading
+from concurrent.futures import Future
+
+from flask import current_app
+
+import waiverdb.monitor as monitor
+
+
+class _Group(object):
+    def __init__(self):
+        self.items = []
+        self.closed = threading.Event()
+        self.result = Future()
+
+
+class GroupCommit(object):
+    """
+    Coalesces items submitted by concurrent threads into a single call of a
+    commit function.
+
+    Args:
+        window (float): Seconds the leader waits for other items.
+        max_size (int): Maximum number of items in a group. A full group is
+            committed without waiting for the rest of the window.
+    """
+    def __init__(self, window=0.005, max_size=100):
+        self.window = window
+        self.max_size = max_size
+        self._group = None
+        self._lock = threading.Lock()
+
+    def submit(self, item, commit):
+        """
+        Adds the item to the current group and returns its result.
+
+        If this starts a new group, the calling thread commits the group
+        by calling ``commit`` with the list of items once the window is
+        over or the group is full. The function must return a list with a
+        result for each item. If it raises an exception, the exception is
+        raised in all threads of the group.
+        """
+        with self._lock:
+            group = self._group
+            leader = group is None
+            if leader:
+                group = self._group = _Group()
+            index = len(group.items)
+            group.items.append(item)
+            if len(group.items) >= self.max_size:
+                self._group = None
+                group.closed.set()
+
+        if leader:
+            group.closed.wait(self.window)
+            with self._lock:
+                if self._group is group:
+                    self._group = None
+
+            monitor.group_commit_size.observe(len(group.items))
+            try:
+                group.result.set_result(commit(group.items))
+            except BaseException as e:
+                group.result.set_exception(e)
+                raise
+
+        return group.result.result()[index]
+
+
+def configure_group_commit(app):
+    """
+    Creates the group commit of new waivers of single-waiver POST requests
+    to the application.
+    """
+    app.extensions['waiverdb_group_commit'] = GroupCommit(
+        app.config['GROUP_COMMIT_WINDOW'], app.config['GROUP_COMMIT_MAX_SIZE'])
+
+
+def get_group_commit():
+    """
+    Returns the group commit of new waivers of the current application.
+    """
+    return current_app.extensions['waiverdb_group_commit']
@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Processing of waivers submitted asynchronously (see :class:`WaiverJob`).
+"""
+
+import datetime
+import json
+import logging
+
+from flask import current_app
+from sqlalchemy import or_
+from werkzeug.exceptions import HTTPException
+
+from waiverdb.api_v1 import create_job_waivers
+from waiverdb.models import WaiverJob
+from waiverdb.models.jobs import JOB_DONE, JOB_FAILED, JOB_PENDING
+from waiverdb.models.waivers import pop_new_waivers
+
+_log = logging.getLogger(__name__)
+
+
+def process_next_job(session):
+    """
+    Creates waivers of the oldest pending job and stores the result of each
+    of them in the job, in a single transaction.
+
+    If the job cannot be processed, the error is stored in the job instead.
+    After a server error (e.g. ResultsDB is not reachable), the job stays
+    pending and is retried with exponential backoff (``JOB_RETRY_DELAY``)
+    until it fails ``JOB_MAX_ATTEMPTS`` times.
+    Concurrent workers skip jobs locked by each other (PostgreSQL only).
+
+    Args:
+        session (sqlalchemy.orm.Session): Session used to process the job.
+            It is committed.
+
+    Returns:
+        The processed job or None if there is no pending job.
+    """
+    now = datetime.datetime.utcnow()
+    job = session.query(WaiverJob)\
+        .filter(WaiverJob.status == JOB_PENDING)\
+        .filter(or_(WaiverJob.next_attempt.is_(None), WaiverJob.next_attempt <= now))\
+        .order_by(WaiverJob.id)\
+        .with_for_update(skip_locked=True)\
+        .first()
+    if job is None:
+        session.commit()
+        return None
+
+    savepoint = session.begin_nested()
+    try:
+        result = create_job_waivers(job)
+        savepoint.commit()
+    except Exception as e:
+        _log.exception('Failed to process job %r', job)
+        savepoint.rollback()
+        # Waivers inserted in the savepoint must not be published.
+        pop_new_waivers(session)
+        job.error = str(e)
+        job.attempts += 1
+        if _should_retry(e, job.attempts):
+            delay = current_app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+            session.commit()
+            return job
+        job.status = JOB_FAILED
+    else:
+        job.status = JOB_DONE
+        job.result = json.dumps(result)
+        job.error = None
+
+    job.finished = datetime.datetime.utcnow()
+    session.commit()
+    return job
+
+
+def _should_retry(error, attempts):
+    """
+    Returns True if a job failing with the error should be processed again.
+    """
+    return (isinstance(error, HTTPException) and error.code >= 500
+            and attempts < current_app.config['JOB_MAX_ATTEMPTS'])
+
+
+def purge_jobs(session, finished_before):
+    """
+    Deletes jobs finished before the given time.
+    """
+    session.query(WaiverJob)\
+        .filter(WaiverJob.finished < finished_before)\
+        .delete(synchronize_session=False)
+    session.commit()
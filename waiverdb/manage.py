@@ -1,10 +1,18 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import datetime
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 import click
+from flask import current_app
 from flask.cli import FlaskGroup
+from sqlalchemy import func, insert, select
 from sqlalchemy.exc import OperationalError
-from waiverdb.models import db
+from waiverdb.events import dispatch_outbox_messages, purge_outbox_messages
+from waiverdb.jobs import process_next_job, purge_jobs
+from waiverdb.models import db, CurrentWaiver, IdempotencyKey, Waiver
+from waiverdb.models.waivers import CURRENT_WAIVER_KEY
 
 
 def create_waiver_app(_):
@@ -35,5 +43,113 @@ def wait_for_db():
             break
 
 
+@cli.command(name='check-current-waivers')
+@click.option('--fix', is_flag=True,
+              help='Rebuild the current_waiver table if it is inconsistent.')
+def check_current_waivers(fix):
+    """
+    Verify that the current_waiver table points to the most recent waiver for
+    each subject, test case, username and product version.
+    """
+    waiver_key = [getattr(Waiver, field) for field in CURRENT_WAIVER_KEY]
+    current_key = [getattr(CurrentWaiver, field) for field in CURRENT_WAIVER_KEY]
+    expected = select(*waiver_key, func.max(Waiver.id)).group_by(*waiver_key)
+    actual = select(*current_key, CurrentWaiver.waiver_id)
+
+    missing = db.session.execute(expected.except_(actual)).fetchall()
+    extra = db.session.execute(actual.except_(expected)).fetchall()
+    for row in missing:
+        click.echo('Missing current waiver: {}'.format(tuple(row)))
+    for row in extra:
+        click.echo('Unexpected current waiver: {}'.format(tuple(row)))
+
+    if not missing and not extra:
+        click.echo('The current_waiver table is consistent.')
+        return
+
+    if not fix:
+        click.echo('The current_waiver table is inconsistent, use --fix to rebuild it.')
+        sys.exit(1)
+
+    db.session.execute(CurrentWaiver.__table__.delete())
+    db.session.execute(insert(CurrentWaiver.__table__).from_select(
+        list(CURRENT_WAIVER_KEY) + ['waiver_id'], expected))
+    db.session.commit()
+    click.echo('The current_waiver table was rebuilt.')
+
+
+@cli.command(name='dispatch-messages')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Maximum number of messages published in a transaction.')
+@click.option('--interval', default=1.0, show_default=True,
+              help='Seconds to wait when there are no messages or publishing failed.')
+@click.option('--keep-days', default=7, show_default=True,
+              help='Days after which published messages are deleted.')
+@click.option('--once', is_flag=True,
+              help='Exit when there are no more messages to publish.')
+def dispatch_messages(batch_size, interval, keep_days, once):
+    """
+    Publish messages stored in the outbox (see MESSAGE_OUTBOX option).
+    """
+    while True:
+        sent = dispatch_outbox_messages(db.session, batch_size)
+        if sent:
+            click.echo('Published {} messages.'.format(sent))
+        if sent == batch_size:
+            continue
+
+        sent_before = datetime.datetime.utcnow() - datetime.timedelta(days=keep_days)
+        purge_outbox_messages(db.session, sent_before)
+        if once:
+            break
+        time.sleep(interval)
+
+
+@cli.command(name='process-jobs')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of jobs processed concurrently.')
+@click.option('--interval', default=1.0, show_default=True,
+              help='Seconds to wait when there are no jobs to process.')
+@click.option('--keep-days', default=7, show_default=True,
+              help='Days after which finished jobs are deleted.')
+@click.option('--once', is_flag=True,
+              help='Exit when there are no more jobs to process.')
+def process_jobs(workers, interval, keep_days, once):
+    """
+    Create waivers submitted asynchronously (with "Prefer: respond-async").
+    """
+    app = current_app._get_current_object()
+
+    def work():
+        with app.app_context():
+            while True:
+                job = process_next_job(db.session)
+                if job is not None:
+                    click.echo('Processed job {} ({}).'.format(job.id, job.status))
+                    continue
+
+                finished_before = datetime.datetime.utcnow() - datetime.timedelta(days=keep_days)
+                purge_jobs(db.session, finished_before)
+                if once:
+                    break
+                time.sleep(interval)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(work) for _ in range(workers)]
+    for future in futures:
+        future.result()
+
+
+@cli.command(name='purge-idempotency-keys')
+def purge_idempotency_keys():
+    """
+    Delete expired idempotency keys of requests creating waivers.
+    """
+    deleted = IdempotencyKey.query.filter(
+        IdempotencyKey.expires <= datetime.datetime.utcnow()).delete()
+    db.session.commit()
+    click.echo('Deleted {} expired idempotency keys.'.format(deleted))
+
+
 if __name__ == '__main__':
     cli()  # pylint: disable=E1120
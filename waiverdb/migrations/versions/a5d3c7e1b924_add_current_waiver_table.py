@@ -0,0 +1,41 @@
+"""Add current_waiver table
+
+Revision ID: a5d3c7e1b924
+Revises: 3868a8118458
+Create Date: 2026-10-16 09:12:31.412907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a5d3c7e1b924'
+down_revision = '3868a8118458'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'current_waiver',
+        sa.Column('subject_type', sa.Text(), nullable=False),
+        sa.Column('subject_identifier', sa.Text(), nullable=False),
+        sa.Column('testcase', sa.Text(), nullable=False),
+        sa.Column('username', sa.String(length=255), nullable=False),
+        sa.Column('product_version', sa.String(length=200), nullable=False),
+        sa.Column('waiver_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['waiver_id'], ['waiver.id']),
+        sa.PrimaryKeyConstraint(
+            'subject_type', 'subject_identifier', 'testcase', 'username', 'product_version'),
+        sa.UniqueConstraint('waiver_id'),
+    )
+    op.execute("""
+        INSERT INTO current_waiver
+            (subject_type, subject_identifier, testcase, username, product_version, waiver_id)
+        SELECT subject_type, subject_identifier, testcase, username, product_version, max(id)
+        FROM waiver
+        GROUP BY subject_type, subject_identifier, testcase, username, product_version
+    """)
+
+
+def downgrade():
+    op.drop_table('current_waiver')
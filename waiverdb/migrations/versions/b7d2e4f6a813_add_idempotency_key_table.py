@@ -0,0 +1,37 @@
+"""Add idempotency_key table
+
+Revision ID: b7d2e4f6a813
+Revises: e8f1a9c3b572
+Create Date: 2026-10-16 18:02:41.118730
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f6a813'
+down_revision = 'e8f1a9c3b572'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_key',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('username', sa.String(length=255), nullable=False),
+        sa.Column('request_hash', sa.String(length=64), nullable=False),
+        sa.Column('response', sa.Text(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('expires', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_idempotency_key_username_key', 'idempotency_key',
+                    ['username', 'key'], unique=True)
+    op.create_index('ix_idempotency_key_expires', 'idempotency_key', ['expires'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_key_expires', table_name='idempotency_key')
+    op.drop_index('ix_idempotency_key_username_key', table_name='idempotency_key')
+    op.drop_table('idempotency_key')
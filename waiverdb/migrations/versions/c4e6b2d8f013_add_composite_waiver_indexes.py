@@ -0,0 +1,37 @@
+"""Add composite waiver indexes
+
+Revision ID: c4e6b2d8f013
+Revises: a5d3c7e1b924
+Create Date: 2026-10-16 14:03:27.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e6b2d8f013'
+down_revision = 'a5d3c7e1b924'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Indexes are built without locking the table against writes, which is
+    # not possible inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_waiver_subject_testcase_product_version', 'waiver',
+            ['subject_type', 'subject_identifier', 'testcase', 'product_version',
+             sa.text('id DESC')],
+            postgresql_concurrently=True)
+        op.create_index(
+            'ix_waiver_timestamp_id', 'waiver', ['timestamp', 'id'],
+            postgresql_concurrently=True)
+    op.execute('ANALYZE waiver')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_waiver_timestamp_id', table_name='waiver',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_waiver_subject_testcase_product_version', table_name='waiver',
+                      postgresql_concurrently=True)
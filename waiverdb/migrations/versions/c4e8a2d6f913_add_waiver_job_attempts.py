@@ -0,0 +1,25 @@
+"""Add attempts and next_attempt to waiver_job
+
+Revision ID: c4e8a2d6f913
+Revises: d9c3f5a7b146
+Create Date: 2026-10-17 10:24:37.581903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d6f913'
+down_revision = 'd9c3f5a7b146'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('waiver_job', sa.Column('attempts', sa.Integer(), nullable=False,
+                                          server_default='0'))
+    op.add_column('waiver_job', sa.Column('next_attempt', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('waiver_job', 'next_attempt')
+    op.drop_column('waiver_job', 'attempts')
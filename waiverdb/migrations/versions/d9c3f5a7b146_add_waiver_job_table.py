@@ -0,0 +1,36 @@
+"""Add waiver_job table
+
+Revision ID: d9c3f5a7b146
+Revises: b7d2e4f6a813
+Create Date: 2026-10-16 19:11:52.402317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd9c3f5a7b146'
+down_revision = 'b7d2e4f6a813'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'waiver_job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=255), nullable=False),
+        sa.Column('request', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('finished', sa.DateTime(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_waiver_job_pending', 'waiver_job', ['id'],
+                    postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_waiver_job_pending', table_name='waiver_job')
+    op.drop_table('waiver_job')
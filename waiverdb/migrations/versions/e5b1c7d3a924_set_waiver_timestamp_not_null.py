@@ -0,0 +1,31 @@
+"""Set waiver timestamp not null
+
+Keyset pagination orders waivers by (timestamp, id), which skips waivers
+without a timestamp. Such waivers get the latest timestamp of the waivers
+inserted before them, so that they keep their position in the list.
+
+Revision ID: e5b1c7d3a924
+Revises: c4e8a2d6f913
+Create Date: 2026-10-17 11:02:13.604718
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5b1c7d3a924'
+down_revision = 'c4e8a2d6f913'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        UPDATE waiver SET timestamp = COALESCE(
+            (SELECT max(older.timestamp) FROM waiver AS older WHERE older.id < waiver.id),
+            '1970-01-01 00:00:00')
+        WHERE timestamp IS NULL
+    """)
+    op.alter_column('waiver', 'timestamp', nullable=False)
+
+
+def downgrade():
+    op.alter_column('waiver', 'timestamp', nullable=True)
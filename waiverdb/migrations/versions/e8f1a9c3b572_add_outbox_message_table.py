@@ -0,0 +1,34 @@
+"""Add outbox_message table
+
+Revision ID: e8f1a9c3b572
+Revises: c4e6b2d8f013
+Create Date: 2026-10-16 16:21:05.530671
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e8f1a9c3b572'
+down_revision = 'c4e6b2d8f013'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'outbox_message',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('sent', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_outbox_message_unsent', 'outbox_message', ['id'],
+                    postgresql_where=sa.text('sent IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_outbox_message_unsent', table_name='outbox_message')
+    op.drop_table('outbox_message')
@@ -0,0 +1,29 @@
+"""Add waiver_watermark table
+
+Revision ID: f7a3d9e1b245
+Revises: e5b1c7d3a924
+Create Date: 2026-10-17 14:21:45.118392
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f7a3d9e1b245'
+down_revision = 'e5b1c7d3a924'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    table = op.create_table(
+        'waiver_watermark',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('value', sa.BigInteger(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.bulk_insert(table, [{'id': 1, 'value': 0}])
+
+
+def downgrade():
+    op.drop_table('waiver_watermark')
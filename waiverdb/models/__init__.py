@@ -1,4 +1,7 @@
 # SPDX-License-Identifier: GPL-2.0+
 
 from .base import db  # noqa: F401
-from .waivers import Waiver  # noqa: F401
+from .waivers import Waiver, CurrentWaiver, WaiverWatermark  # noqa: F401
+from .outbox import OutboxMessage  # noqa: F401
+from .idempotency import IdempotencyKey  # noqa: F401
+from .jobs import WaiverJob  # noqa: F401
@@ -0,0 +1,30 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+from .base import db
+
+
+class IdempotencyKey(db.Model):
+    """
+    Response to a request creating waivers with an ``Idempotency-Key`` header.
+
+    The key is stored in the same transaction as the waivers. A retried
+    request with the same key gets the stored response instead of creating
+    the waivers again, until the key expires.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)
+    username = db.Column(db.String(255), nullable=False)
+    # SHA-256 of the request body, to reject reusing the key for a different request
+    request_hash = db.Column(db.String(64), nullable=False)
+    # JSON-encoded response body
+    response = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+    __table_args__ = (
+        db.Index('ix_idempotency_key_username_key', username, key, unique=True),
+    )
+
+    def __repr__(self):
+        return ('%s(key=%r, username=%r, created=%r, expires=%r)'
+                % (self.__class__.__name__, self.key, self.username, self.created, self.expires))
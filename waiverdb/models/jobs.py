@@ -0,0 +1,46 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+from .base import db
+
+# Status of a job waiting for ``waiverdb process-jobs``
+JOB_PENDING = 'pending'
+# Status of a processed job, some items may have failed
+JOB_DONE = 'done'
+# Status of a job which could not be processed
+JOB_FAILED = 'failed'
+
+
+class WaiverJob(db.Model):
+    """
+    Waivers submitted to be created asynchronously.
+
+    The job is processed by ``waiverdb process-jobs`` in a single transaction
+    with creating the waivers, so it is either still pending or all its
+    waivers are stored. A job failing because of a server error stays pending
+    and is retried later.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    # User who submitted the job
+    username = db.Column(db.String(255), nullable=False)
+    # JSON-encoded list of parsed arguments of each waiver
+    request = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=JOB_PENDING)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished = db.Column(db.DateTime)
+    # JSON-encoded list with result of each waiver
+    result = db.Column(db.Text)
+    # Error which prevented processing the job
+    error = db.Column(db.Text)
+    # Number of failed attempts to process the job
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # The job is not processed again before this time after a failed attempt
+    next_attempt = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_waiver_job_pending', id, postgresql_where=status == JOB_PENDING),
+    )
+
+    def __repr__(self):
+        return ('%s(id=%r, username=%r, status=%r, created=%r, attempts=%r)'
+                % (self.__class__.__name__, self.id, self.username, self.status, self.created,
+                   self.attempts))
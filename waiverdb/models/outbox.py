@@ -0,0 +1,31 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+from .base import db
+
+
+class OutboxMessage(db.Model):
+    """
+    Message about a new waiver waiting to be published to the message bus.
+
+    Messages are written in the same transaction as the waivers, so a
+    message is stored if and only if the waiver is, and are published later
+    by ``waiverdb dispatch-messages``.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    # JSON-encoded message body
+    body = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # Time when the message was published, NULL if not yet published
+    sent = db.Column(db.DateTime)
+    # Number of attempts to publish the message
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Error of the last failed attempt
+    error = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_outbox_message_unsent', id, postgresql_where=sent.is_(None)),
+    )
+
+    def __repr__(self):
+        return ('%s(id=%r, created=%r, sent=%r, attempts=%r)'
+                % (self.__class__.__name__, self.id, self.created, self.sent, self.attempts))
@@ -2,7 +2,36 @@
 
 import datetime
 from .base import db
-from sqlalchemy import or_, and_, false
+from sqlalchemy import DDL, event, or_, and_, false, func, literal, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+# A waiver obsoletes all older waivers with the same values of these fields.
+CURRENT_WAIVER_KEY = (
+    'subject_type',
+    'subject_identifier',
+    'testcase',
+    'username',
+    'product_version',
+)
+
+# A new waiver duplicates the current waiver with the same key if these fields
+# are also equal, i.e. inserting it would not change anything but the timestamp.
+DUPLICATE_WAIVER_FIELDS = (
+    'scenario',
+    'waived',
+    'comment',
+    'proxied_by',
+)
+
+# Session.info key of the list of waivers inserted in the current transaction
+NEW_WAIVERS_INFO_KEY = 'waiverdb_new_waivers'
+# Session.info key set if any waiver was inserted in the current transaction
+WAIVERS_INSERTED_INFO_KEY = 'waiverdb_waivers_inserted'
+
+# Maximum number of waivers inserted by a single statement. PostgreSQL allows
+# at most 65535 bind parameters per statement.
+BULK_INSERT_BATCH_SIZE = 1000
 
 
 def subject_dict_to_type_identifier(subject):
@@ -41,6 +70,14 @@ def subject_type_identifier_to_dict(subject_type, subject_identifier):
                           'actual value is: %r') % subject_type)
 
 
+def value_set_supported(query):
+    """
+    Returns True if :meth:`Waiver.by_value_set` can be used with the
+    database of the given query.
+    """
+    return query.session.get_bind().dialect.name == 'postgresql'
+
+
 class Waiver(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subject_type = db.Column(db.Text, nullable=False, index=True)
@@ -52,9 +89,15 @@ class Waiver(db.Model):
     waived = db.Column(db.Boolean, nullable=False, default=False)
     scenario = db.Column(db.String(255), nullable=True)
     comment = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
     __table_args__ = (
         db.Index('ix_waiver_subject_type_identifier', subject_type, subject_identifier),
+        # Filtering by subject, test case and optionally product version,
+        # most recent waivers first
+        db.Index('ix_waiver_subject_testcase_product_version',
+                 subject_type, subject_identifier, testcase, product_version, id.desc()),
+        # Listing waivers from the most recent (including keyset pagination)
+        db.Index('ix_waiver_timestamp_id', timestamp, id),
     )
 
     def __init__(self, subject_type, subject_identifier, testcase, username, product_version,
@@ -90,6 +133,21 @@ class Waiver(db.Model):
         Returns:
             Filtered query.
         """
+        rows = []
+        for result in results:
+            subject = result.get('subject', None)
+            testcase = result.get('testcase', None)
+            try:
+                rows.append(subject_dict_to_type_identifier(subject) + (testcase,))
+            except (AttributeError, TypeError, ValueError):
+                break
+            if not testcase:
+                break
+        else:
+            if rows and value_set_supported(query):
+                return cls.by_value_set(
+                    query, ['subject_type', 'subject_identifier', 'testcase'], rows)
+
         clauses = []
         for result in results:
             subject = result.get('subject', None)
@@ -110,3 +168,279 @@ class Waiver(db.Model):
             clauses.append(and_(*inner_clauses))
 
         return query.filter(or_(*clauses))
+
+    @classmethod
+    def by_value_set(cls, query, fields, rows):
+        """
+        Filter ``query`` by matching values of ``fields`` with at least one
+        of ``rows``.
+
+        Unlike OR-ing a clause for each row, the rows are passed as a single
+        array parameter per field and joined using ``unnest()``, so the size
+        of the SQL text, the number of bind parameters and the planning time
+        do not grow with the number of rows. Only works with PostgreSQL, see
+        :func:`value_set_supported`.
+
+        Args:
+            query (flask_sqlalchemy.BaseQuery)
+            fields (list): names of the columns to match
+            rows (list): tuples of strings, each containing a value for
+                every item in ``fields``
+
+        Returns:
+            Filtered query.
+        """
+        # Duplicate rows would join the same waiver multiple times.
+        rows = set(rows)
+        arrays = [
+            literal([row[i] for row in rows], postgresql.ARRAY(db.Text))
+            for i in range(len(fields))
+        ]
+        values = func.unnest(*arrays).table_valued(*fields)\
+            .render_derived(name='filter_values')
+        return query.join(values, and_(*(
+            getattr(cls, field) == values.c[field] for field in fields
+        )))
+
+
+class CurrentWaiver(db.Model):
+    """
+    Points to the most recent waiver for each combination of subject,
+    test case, username and product version, i.e. to the waivers which are
+    not obsolete.
+
+    Rows are maintained by :func:`update_current_waivers` in the same
+    transaction as the waivers are inserted.
+    """
+    subject_type = db.Column(db.Text, primary_key=True)
+    subject_identifier = db.Column(db.Text, primary_key=True)
+    testcase = db.Column(db.Text, primary_key=True)
+    username = db.Column(db.String(255), primary_key=True)
+    product_version = db.Column(db.String(200), primary_key=True)
+    waiver_id = db.Column(db.Integer, db.ForeignKey('waiver.id'), nullable=False, unique=True)
+
+    def __repr__(self):
+        return ('%s(subject_type=%r, subject_identifier=%r, testcase=%r, username=%r, '
+                'product_version=%r, waiver_id=%r)'
+                % (self.__class__.__name__, self.subject_type, self.subject_identifier,
+                   self.testcase, self.username, self.product_version, self.waiver_id))
+
+
+class WaiverWatermark(db.Model):
+    """
+    Single row counting transactions which inserted waivers.
+
+    The row is updated in the same transaction as the waivers right before it
+    is committed, so unlike the most recent waiver id, which is allocated
+    before concurrent transactions commit, it changes whenever new waivers
+    become visible. Results of waiver queries can be cached by its value.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    # Time of the last change
+    updated = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return ('%s(value=%r, updated=%r)'
+                % (self.__class__.__name__, self.value, self.updated))
+
+
+event.listen(WaiverWatermark.__table__, 'after_create',
+             DDL('INSERT INTO waiver_watermark (id, value) VALUES (1, 0)'))
+
+
+def current_waiver_watermark(session):
+    """
+    Returns the committed value and time of the last change of
+    :class:`WaiverWatermark`, or (None, None) if it does not exist.
+    """
+    watermark = session.query(WaiverWatermark.value, WaiverWatermark.updated)\
+        .filter(WaiverWatermark.id == 1).first()
+    return watermark or (None, None)
+
+
+def bump_waiver_watermark(connection):
+    """
+    Changes :class:`WaiverWatermark` in the transaction of the connection.
+
+    The row stays locked until the transaction ends, so this should be done
+    just before commit.
+    """
+    table = WaiverWatermark.__table__
+    connection.execute(table.update().where(table.c.id == 1).values(
+        value=table.c.value + 1, updated=datetime.datetime.utcnow()))
+
+
+def update_current_waivers(connection, waivers):
+    """
+    Marks newly inserted waivers as current, unless a more recent waiver with
+    the same key is already current.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): Connection in the
+            transaction which inserted the waivers.
+        waivers (list): Dicts with "id" and the :data:`CURRENT_WAIVER_KEY`
+            fields.
+    """
+    latest = {}
+    for waiver in waivers:
+        key = tuple(waiver[field] for field in CURRENT_WAIVER_KEY)
+        if key not in latest or latest[key] < waiver['id']:
+            latest[key] = waiver['id']
+    if not latest:
+        return
+
+    if connection.dialect.name == 'postgresql':
+        insert = postgresql.insert
+    else:
+        insert = sqlite.insert
+    table = CurrentWaiver.__table__
+    statement = insert(table).values([
+        dict(zip(CURRENT_WAIVER_KEY, key), waiver_id=waiver_id)
+        for key, waiver_id in latest.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=CURRENT_WAIVER_KEY,
+        set_={'waiver_id': statement.excluded.waiver_id},
+        where=table.c.waiver_id < statement.excluded.waiver_id,
+    )
+    connection.execute(statement)
+
+
+def bulk_insert_waivers(session, waivers):
+    """
+    Inserts new waivers with multi-row ``INSERT`` statements instead of a
+    statement per waiver, and adds them to the session as persistent
+    objects, so they are handled as any other waiver on commit.
+
+    Ids are allocated from the sequence of the table first, in the order of
+    the waivers, because the order of rows returned by ``INSERT ...
+    RETURNING`` is not guaranteed.
+
+    Falls back to :meth:`Session.add_all` with databases other than
+    PostgreSQL.
+
+    Args:
+        session (sqlalchemy.orm.Session)
+        waivers (list): New Waiver objects.
+    """
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql' or not waivers:
+        session.add_all(waivers)
+        return
+
+    table = Waiver.__table__
+    columns = [column for column in table.c if column.key != 'timestamp']
+    for start in range(0, len(waivers), BULK_INSERT_BATCH_SIZE):
+        batch = waivers[start:start + BULK_INSERT_BATCH_SIZE]
+        waiver_ids = sorted(connection.execute(
+            select(func.nextval(func.pg_get_serial_sequence(table.name, 'id')))
+            .select_from(func.generate_series(1, len(batch)))).scalars())
+        for waiver, waiver_id in zip(batch, waiver_ids):
+            waiver.id = waiver_id
+        statement = table.insert().values([
+            {column.key: getattr(waiver, column.key) for column in columns}
+            for waiver in batch
+        ]).returning(table.c.id, table.c.timestamp)
+        timestamps = dict(connection.execute(statement).all())
+        for waiver in batch:
+            waiver.timestamp = timestamps[waiver.id]
+            make_transient_to_detached(waiver)
+            session.add(waiver)
+
+        # The ORM events below are not triggered by Core statements.
+        update_current_waivers(connection, [
+            dict({field: getattr(waiver, field) for field in CURRENT_WAIVER_KEY}, id=waiver.id)
+            for waiver in batch
+        ])
+        _track_new_waivers(session, batch)
+
+
+def find_duplicate_waivers(session, waivers):
+    """
+    Finds the current waivers duplicating new waivers (see
+    :data:`DUPLICATE_WAIVER_FIELDS`).
+
+    A new waiver also duplicates an earlier new waiver in the list which
+    would be current once inserted.
+
+    Args:
+        session (sqlalchemy.orm.Session)
+        waivers (list): New Waiver objects.
+
+    Returns:
+        List with the duplicated waiver or None for each new waiver.
+    """
+    def key(waiver):
+        return tuple(getattr(waiver, field) for field in CURRENT_WAIVER_KEY)
+
+    keys = list({key(waiver) for waiver in waivers})
+    key_columns = tuple_(*(getattr(CurrentWaiver, field) for field in CURRENT_WAIVER_KEY))
+    current = {}
+    for start in range(0, len(keys), BULK_INSERT_BATCH_SIZE):
+        query = session.query(Waiver)\
+            .join(CurrentWaiver, CurrentWaiver.waiver_id == Waiver.id)\
+            .filter(key_columns.in_(keys[start:start + BULK_INSERT_BATCH_SIZE]))
+        current.update((key(waiver), waiver) for waiver in query)
+
+    duplicates = []
+    for waiver in waivers:
+        duplicate = current.get(key(waiver))
+        if duplicate is not None and all(
+                getattr(duplicate, field) == getattr(waiver, field)
+                for field in DUPLICATE_WAIVER_FIELDS):
+            duplicates.append(duplicate)
+        else:
+            current[key(waiver)] = waiver
+            duplicates.append(None)
+    return duplicates
+
+
+def pop_new_waivers(session):
+    """
+    Returns waivers inserted in the current transaction of the session since
+    the last call.
+    """
+    return session.info.pop(NEW_WAIVERS_INFO_KEY, [])
+
+
+def waivers_inserted(session):
+    """
+    Returns True if any waiver was inserted in the current transaction of
+    the session, even if it was already returned by :func:`pop_new_waivers`.
+    """
+    return session.info.get(WAIVERS_INSERTED_INFO_KEY, False)
+
+
+def _track_new_waivers(session, waivers):
+    if waivers:
+        session.info.setdefault(NEW_WAIVERS_INFO_KEY, []).extend(waivers)
+        session.info[WAIVERS_INSERTED_INFO_KEY] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_flushed_waivers(session, flush_context):
+    _track_new_waivers(session, [obj for obj in session.new if isinstance(obj, Waiver)])
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_waiver_watermark(session):
+    # Flush first, so that the watermark row is locked only after all waivers
+    # are inserted and only until the commit.
+    session.flush()
+    if waivers_inserted(session):
+        bump_waiver_watermark(session.connection())
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_new_waivers(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(NEW_WAIVERS_INFO_KEY, None)
+        session.info.pop(WAIVERS_INSERTED_INFO_KEY, None)
+
+
+@event.listens_for(Waiver, 'after_insert')
+def _update_current_waiver(mapper, connection, target):
+    values = {field: getattr(target, field) for field in CURRENT_WAIVER_KEY}
+    values['id'] = target.id
+    update_current_waivers(connection, [values])
@@ -64,7 +64,42 @@ db_transaction_rollback_counter = Counter(
     registry=registry)
 
 # Service-specific metrics
-# XXX: TODO
+resultsdb_lookup_latency = Histogram(
+    'resultsdb_lookup_latency',
+    'Latency of looking up a result in ResultsDB in seconds',
+    registry=registry)
+ldap_search_latency = Histogram(
+    'ldap_search_latency',
+    'Latency of searching groups of a user in LDAP in seconds',
+    registry=registry)
+ldap_connect_counter = Counter(
+    'ldap_connect',
+    'Number of new connections to LDAP server',
+    registry=registry)
+stomp_connect_counter = Counter(
+    'stomp_connect',
+    'Number of attempts to connect to STOMP broker',
+    registry=registry)
+cache_hit_counter = Counter(
+    'cache_hit',
+    'Number of cache hits',
+    ['cache'],
+    registry=registry)
+cache_miss_counter = Counter(
+    'cache_miss',
+    'Number of cache misses',
+    ['cache'],
+    registry=registry)
+cache_eviction_counter = Counter(
+    'cache_eviction',
+    'Number of items removed from cache because it was full or they expired',
+    ['cache'],
+    registry=registry)
+group_commit_size = Histogram(
+    'group_commit_size',
+    'Number of waivers from concurrent requests stored in a single transaction',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+    registry=registry)
 
 
 def db_hook_event_listeners(target=None):
@@ -1,24 +1,72 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import base64
+import binascii
+import datetime
 import functools
+import hashlib
+import json
+import logging
+import os
+import threading
 import stomp
-from flask import request, url_for, jsonify, current_app
-from flask_restful import marshal
-from waiverdb.fields import waiver_fields
+from flask import Response, request, url_for, jsonify, current_app, stream_with_context
+from flask_sqlalchemy import Pagination
+from sqlalchemy import tuple_
+import waiverdb.monitor as monitor
+from waiverdb.fields import waiver_projection
+from waiverdb.models import Waiver
 from werkzeug.exceptions import NotFound, HTTPException
+from werkzeug.http import http_date, quote_etag
 from contextlib import contextmanager
 
+_log = logging.getLogger(__name__)
 
-def json_collection(query, page=1, limit=10):
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Number of rows fetched from the server-side cursor at once when streaming
+STREAM_BATCH_SIZE = 1000
+# Default heart-beating (milliseconds) of STOMP connections, if not configured
+STOMP_HEARTBEATS = (10000, 10000)
+
+
+class UncountedPagination(Pagination):
+    """
+    Pagination with unknown total number of items.
+    """
+    def __init__(self, query, page, per_page, items, has_next):
+        super(UncountedPagination, self).__init__(query, page, per_page, None, items)
+        self._has_next = has_next
+
+    @property
+    def has_next(self):
+        return self._has_next
+
+
+def json_collection(query, page=1, limit=10, fields=None, count=True):
     """
     Helper function for Flask request handlers which want to return
     a collection of resources as JSON.
+
+    Only the columns needed for the given list of ``fields`` are selected
+    (see waiver_projection()).
+
+    If ``count`` is False, the matching rows are not counted. Instead, one
+    more row than requested is fetched to find out if there is a next page,
+    and the response does not contain the "last" link.
     """
-    try:
-        p = query.paginate(page, limit)
-    except NotFound:
-        return {'data': [], 'prev': None, 'next': None, 'first': None, 'last': None}
-    pages = {'data': marshal(p.items, waiver_fields)}
+    columns, serialize = waiver_projection(fields)
+    query = query.with_entities(*columns)
+    if count:
+        try:
+            p = query.paginate(page, limit)
+        except NotFound:
+            return {'data': [], 'prev': None, 'next': None, 'first': None, 'last': None}
+    else:
+        p = _uncounted_page(query, page, limit)
+        if p is None:
+            return {'data': [], 'prev': None, 'next': None, 'first': None}
+    pages = {'data': [serialize(row) for row in p.items]}
     query_pairs = request.args.copy()
     if query_pairs:
         # remove the page number
@@ -34,10 +82,148 @@ def json_collection(query, page=1, limit=10):
     else:
         pages['next'] = None
     pages['first'] = url_for(request.endpoint, page=1, _external=True, **query_pairs)
-    pages['last'] = url_for(request.endpoint, page=p.pages, _external=True, **query_pairs)
+    if count:
+        pages['last'] = url_for(request.endpoint, page=p.pages, _external=True, **query_pairs)
     return pages
 
 
+def _uncounted_page(query, page, limit):
+    """
+    Returns a page of the query like Query.paginate() but without counting
+    all the items, or None if the page does not exist.
+    """
+    if page < 1 or limit < 0:
+        return None
+    rows = query.limit(limit + 1).offset((page - 1) * limit).all()
+    if not rows and page != 1:
+        return None
+    return UncountedPagination(query, page, limit, rows[:limit], len(rows) > limit)
+
+
+def estimate_count(query):
+    """
+    Returns number of rows of the query as estimated by the PostgreSQL
+    planner from table statistics, or None with other databases.
+
+    This is much cheaper than counting the rows but can be way off if the
+    statistics are outdated.
+    """
+    session = query.session
+    if session.get_bind().dialect.name != 'postgresql':
+        return None
+    statement = query.order_by(None).with_entities(Waiver.id).statement
+    connection = session.connection()
+    compiled = statement.compile(dialect=connection.dialect)
+    plan = connection.exec_driver_sql(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def encode_cursor(waiver):
+    """
+    Returns an opaque keyset pagination token for the given waiver.
+    """
+    key = '{},{}'.format(waiver.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), waiver.id)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Inverse of encode_cursor().
+
+    Returns a tuple (timestamp, id) identifying position in the collection.
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, waiver_id = key.split(',', 1)
+        return datetime.datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(waiver_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Invalid pagination cursor: %r' % cursor)
+
+
+def json_cursor_collection(query, after=None, before=None, limit=10, fields=None):
+    """
+    Like json_collection() but uses keyset pagination over waivers ordered
+    from the newest to the oldest.
+
+    The ``after`` and ``before`` arguments are tuples (timestamp, id) as
+    returned by decode_cursor(). Only waivers older than ``after`` or newer
+    than ``before`` are returned. Each page costs a single indexed range scan
+    regardless of its position in the collection, because no OFFSET or
+    COUNT(*) is ever issued.
+    """
+    if limit < 1:
+        return {'data': [], 'prev': None, 'next': None, 'first': None}
+
+    columns, serialize = waiver_projection(fields)
+    # Cursors are encoded from these even if they are not serialized.
+    keys = {column.key for column in columns}
+    columns += tuple(column for column in (Waiver.timestamp, Waiver.id) if column.key not in keys)
+
+    key = tuple_(Waiver.timestamp, Waiver.id)
+    query = query.with_entities(*columns).order_by(None)
+    if before is not None:
+        rows = query.filter(key > before)\
+            .order_by(Waiver.timestamp.asc(), Waiver.id.asc())\
+            .limit(limit + 1).all()
+        items = rows[:limit][::-1]
+        has_prev = len(rows) > limit
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(key < after)
+        rows = query.order_by(Waiver.timestamp.desc(), Waiver.id.desc())\
+            .limit(limit + 1).all()
+        items = rows[:limit]
+        has_prev = after is not None
+        has_next = len(rows) > limit
+
+    pages = {'data': [serialize(row) for row in items]}
+    query_pairs = request.args.copy()
+    for arg in ('page', 'after', 'before'):
+        query_pairs.pop(arg, default=None)
+    pages['prev'] = None
+    pages['next'] = None
+    if has_prev:
+        # With an empty page, the page boundary is the requested cursor itself.
+        prev_cursor = encode_cursor(items[0]) if items else request.args['after']
+        pages['prev'] = url_for(request.endpoint, before=prev_cursor, _external=True,
+                                **query_pairs)
+    if has_next:
+        next_cursor = encode_cursor(items[-1]) if items else request.args['before']
+        pages['next'] = url_for(request.endpoint, after=next_cursor, _external=True,
+                                **query_pairs)
+    pages['first'] = url_for(request.endpoint, after='', _external=True, **query_pairs)
+    return pages
+
+
+def wants_ndjson():
+    """
+    Returns True if the client prefers newline-delimited JSON to JSON.
+    """
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_collection(query, fields=None):
+    """
+    Helper function for Flask request handlers which want to stream a large
+    collection of resources as newline-delimited JSON, one resource per line.
+
+    Rows are fetched in batches from a server-side cursor and serialized as
+    they arrive, so memory usage does not depend on the size of the result.
+    """
+    columns, serialize = waiver_projection(fields)
+
+    def generate():
+        for row in query.with_entities(*columns).yield_per(STREAM_BATCH_SIZE):
+            yield json.dumps(serialize(row)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
 def json_error(error):
     """
     Return error responses in JSON.
@@ -60,27 +246,179 @@ def json_error(error):
 
 
 def jsonp(func):
-    """Wraps Jsonified output for JSONP requests."""
+    """
+    Wraps Jsonified output for JSONP requests.
+
+    The wrapped handler can also return a tuple (body, status, headers) or
+    (body, status), the status and headers are kept in the JSONP response.
+    """
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         callback = request.args.get('callback', False)
         if callback:
-            resp = jsonify(func(*args, **kwargs))
+            result = func(*args, **kwargs)
+            status, headers = None, None
+            if isinstance(result, tuple):
+                result, status, *rest = result
+                headers = rest[0] if rest else None
+            resp = jsonify(result)
             resp.set_data('{}({})'.format(
                 str(callback),
-                resp.get_data()
+                resp.get_data(as_text=True)
             ))
             resp.mimetype = 'application/javascript'
+            if status is not None:
+                resp.status_code = status
+            if headers:
+                resp.headers.extend(headers)
             return resp
         else:
             return func(*args, **kwargs)
     return wrapped
 
 
+def conditional_get(validator, pass_version=False):
+    """
+    Decorator for GET request handlers which adds ETag and Last-Modified
+    headers and responds with 304 Not Modified to requests with a matching
+    If-None-Match header without calling the handler if the response would
+    not change. The Last-Modified header is informational only.
+
+    The ``validator`` is called with keyword arguments of the handler and
+    returns a tuple (version, last_modified). The version must change
+    whenever the response for the same URL changes. If it is None, the
+    request is not handled as conditional.
+
+    If ``pass_version`` is True, the version is passed to the handler as
+    ``version`` keyword argument, so it does not need to be looked up again.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            version, last_modified = validator(**kwargs)
+            if pass_version:
+                kwargs = dict(kwargs, version=version)
+            if version is None:
+                return func(*args, **kwargs)
+
+            key = '{}|{}'.format(version, request.url)
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()  # nosec
+            headers = {'ETag': quote_etag(etag)}
+            if last_modified:
+                last_modified = last_modified.replace(
+                    microsecond=0, tzinfo=datetime.timezone.utc)
+                headers['Last-Modified'] = http_date(last_modified)
+
+            # If-Modified-Since is ignored: Last-Modified has only one second
+            # precision and waivers are timestamped by the client host, so
+            # only the ETag identifies the response reliably (RFC 7232 §6).
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers=headers)
+
+            result = func(*args, **kwargs)
+            if isinstance(result, Response):
+                result.headers.extend(headers)
+                return result
+            if isinstance(result, tuple):
+                result, status, result_headers = result
+                return result, status, dict(result_headers, **headers)
+            return result, 200, headers
+        return wrapped
+    return decorator
+
+
+class StompConnectionManager(object):
+    """
+    Keeps a single long-lived STOMP connection per process, so that
+    publishing a message costs only a SEND frame instead of a new TCP
+    connection and CONNECT handshake.
+
+    The connection is heart-beating (unless configured otherwise) and it is
+    re-established on next use after it was lost or after any error while it
+    was used.
+
+    Attributes:
+        healthy (bool): False if the last attempt to connect or use the
+            connection failed.
+        last_error (Exception): The error of the last failed attempt.
+    """
+    def __init__(self):
+        self.healthy = True
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._configs = None
+        self._pid = None
+
+    @contextmanager
+    def connection(self, configs):
+        """
+        Yields a connected ``stomp.Connection`` for the given STOMP_CONFIGS.
+
+        Only one thread can use the connection at a time.
+        """
+        with self._lock:
+            try:
+                conn = self._connect(configs)
+                yield conn
+            except Exception as e:
+                self.healthy = False
+                self.last_error = e
+                self._close()
+                raise
+            self.healthy = True
+            self.last_error = None
+
+    def is_connected(self):
+        conn = self._conn
+        return conn is not None and conn.is_connected()
+
+    def close(self):
+        """
+        Disconnects from the broker.
+        """
+        with self._lock:
+            self._close()
+
+    def _connect(self, configs):
+        if self._conn is not None and self._pid != os.getpid():
+            # Connection inherited from parent process belongs to the parent.
+            self._conn = None
+        if self._conn is not None and (
+                self._configs != configs or not self._conn.is_connected()):
+            _log.info('Reconnecting to STOMP broker')
+            self._close()
+        if self._conn is None:
+            kwargs = dict(heartbeats=STOMP_HEARTBEATS)
+            kwargs.update(configs['connection'])
+            conn = stomp.Connection(**kwargs)
+            monitor.stomp_connect_counter.inc()
+            conn.connect(wait=True, **configs.get('credentials', {}))
+            self._conn = conn
+            self._configs = configs
+            self._pid = os.getpid()
+        return self._conn
+
+    def _close(self):
+        conn = self._conn
+        self._conn = None
+        if conn is not None:
+            try:
+                conn.disconnect()
+            except Exception:
+                _log.warning('Failed to disconnect from STOMP broker', exc_info=True)
+
+
+stomp_connections = StompConnectionManager()
+
+
 @contextmanager
 def stomp_connection():
     """
     Helper function for stomp connection.
+
+    The connection is shared by subsequent calls in the process (see
+    :class:`StompConnectionManager`).
     """
     if current_app.config.get('STOMP_CONFIGS'):
         configs = current_app.config.get('STOMP_CONFIGS')
@@ -90,12 +428,8 @@ def stomp_connection():
         if 'connection' not in configs or not configs['connection']:
             raise RuntimeError('stomp was configured to publish messages,, '
                                'but connection is not configured in STOMP_CONFIGS')
-        conn = stomp.Connection(**configs['connection'])
-        conn.connect(wait=True, **configs.get('credentials', {}))
-        try:
+        with stomp_connections.connection(configs) as conn:
             yield conn
-        finally:
-            conn.disconnect()
     else:
         raise RuntimeError('stomp was configured to publish messages, '
                            'but STOMP_CONFIGS is not configured')